@@ -0,0 +1,1295 @@
+#
+# MonitoringBench.py
+#
+# Micro-benchmarks for the Monitoring_zimKnives python code.
+#
+#    This file is part of the "Monitoring zimKnives" project, which is a collection
+#    of files, including this one.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of these words as published by the author.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  Use at your own risk.
+#
+# usage:
+#   python3 MonitoringBench.py limits [--parms N] [--rules N] [--loops N] [--changed F]
+#   python3 MonitoringBench.py ingest [--messages N] [--batch N]
+#   python3 MonitoringBench.py sites [--sites N,N,...] [--messages N]
+#   python3 MonitoringBench.py logging [--messages N] [--delay S]
+#   python3 MonitoringBench.py stress [--writers N] [--updates N]
+#   python3 MonitoringBench.py startup [--repeat N]
+#   python3 MonitoringBench.py parms [--sites N] [--passes N]
+#   python3 MonitoringBench.py edges [--transitions N] [--bounces N] [--glitches N]
+#   python3 MonitoringBench.py gpio [--passes N] [--every N]
+#   python3 MonitoringBench.py probe [--timeout S]
+#   python3 MonitoringBench.py spool [--messages N] [--appends N]
+#   python3 MonitoringBench.py suite [--parms N,N,...] [--rules N,N,...] [--rates N,N,...]
+#                                    [--out FILE] [--baseline FILE] [--threshold F]
+#
+# limits : the original process_limits() loop vs. the compiled LimitEngine
+#          with N parameters and N rules, where a fraction F of the
+#          parameters change between passes
+# ingest : messages/second decoded by the original on_message() vs. Env.ingest(),
+#          and samples/second when they come N to a packet (Env.ingest_batch())
+# sites  : memory per site (Env + compiled limits) and the cost of routing and
+#          decoding a message as the number of sites grows
+# logging: the cost of a logging.info() call to the caller, writing straight
+#          to the file (basicConfig) vs. through the queue (MonitoringLogging.py),
+#          with every write taking S extra seconds (a slow SD card)
+# stress : N threads toggle their own t/f parameter as fast as they can while
+#          the main loop consumes the events; counts the events the loop
+#          missed with the old unsynchronized updates vs. the posted updates
+#          (Env.apply_updates()), and what an update costs the writer
+# startup: in a fresh python each time, the time to import Monitoring_local.py
+#          and the time for its start() to set up the configured sites (with
+#          the stand-in broker and pins); also checks that the import alone
+#          didn't load paho, RPi.GPIO or the optional parts
+# parms  : N sites (the first with the pins) built with the original Parm
+#          (a __dict__ and a physical() lambda each, all visited every pass)
+#          vs. the __slots__ Parm and Env.io_list/pub_list: bytes per Parm,
+#          process RSS growth, and the cost of physical() + data_sync() per
+#          pass over all of the sites (each in a fresh python)
+# edges  : a noisy input (N real transitions, each with N bounces after it,
+#          and N short glitches in between, plus the doubled edges RPi.GPIO
+#          reports) through the edge filter (MonitoringEdges.py), on made up
+#          timestamps: transitions out vs. in and edges dropped, compared to
+#          what the old motion_edge() would have posted; and the cost of the
+#          RPi.GPIO callback
+# gpio   : N passes of the site with the pins, the light toggled every N
+#          passes: calls to RPi.GPIO per pass and the cost of physical(),
+#          polling the key switch and writing every output every pass (the
+#          original) vs. edges for the inputs and writing only changed outputs
+# probe  : a round of the network prober (MonitoringProbe.py) on local stand
+#          ins (a listening port, a closed port, a DNS server, and a port
+#          that never answers): how long a round takes compared to probing
+#          them one after another, and the quorum decision with one and
+#          with most of the "internet" targets down
+# spool  : N alarms sent during an internet outage (mail failing until it's
+#          over, one mail worker) with the original dispatcher, with the spool alone (the
+#          failures kept and flushed afterwards) and with the spool held
+#          while pingtest says the internet is down: messages delivered,
+#          lost, in order, and mail attempts; the messages left by a run
+#          that stopped during the outage, sent by the next one; and the
+#          cost of a message to the caller for each "SPOOL_FSYNC" policy.
+#          the exit status is 1 if the spool lost or reordered a message
+# suite  : the hot paths as the parameter count, rule count and message rate
+#          grow: messages/second through on_message() (flat out and paced at
+#          each rate, with the main loop running), and the cost per pass of
+#          process_stimuluses(), process_limits(), data_sync() and
+#          display_parameters(), and the startup times.  the results go to a json file (--out);
+#          with --baseline, anything worse than the baseline by more than the
+#          threshold is flagged (and the exit status is 1).  a baseline is
+#          just the --out file of an earlier run.
+#
+# the benchmarks use the stand-ins from MonitoringReplay.py for RPi.GPIO and
+# the broker, so they run anywhere (they still need Monitoring_conf.py)
+#
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+import platform
+import queue
+import random
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import types
+
+from MonitoringLimits import LimitEngine
+from MonitoringLogging import setup_logging
+from MonitoringReplay import install_gpio, percentile, FakeBroker, FakeClient, FakeMessage, StimulusQueue, MailStub
+
+
+class BenchParm:
+    """ just enough of a Parm for the benchmarks """
+
+    def __init__(self, label, value, units = ""):
+        self.label = label
+        self.value = value
+        self.units = units
+
+
+class BenchEnv:
+    """ just enough of an Env for the benchmarks; label lookup is the
+        original linear search """
+
+    def __init__(self, parms):
+        self.parm_list = parms
+
+    def get_parameter_by_label(self, label):
+        for attr in self.parm_list:
+            if attr.label == label:
+                return attr
+        return None
+
+
+def legacy_limits(checks, env):
+    """ the process_limits() loop from before the LimitEngine (less the sending) """
+
+    message = "LIMIT"
+    for item in checks:
+            parm = env.get_parameter_by_label(checks[item]["parm"])
+            if parm == None:
+                logging.info("Spurious label in LIMIT_CHECKS... ignored;  label = " + checks[item]["parm"])
+            else:
+                if checks[item]["sense"] == "high":
+                    if parm.value >= checks[item]["limit"]:
+                        logging.info("Limit message: " + checks[item]["message"] + \
+                        " (parm:" + checks[item]["parm"] + \
+                        " limit:" + str(checks[item]["limit"]) + \
+                        " value: " + str(parm.value) + " " + parm.units)
+                        message = message + "\n" + checks[item]["message"]
+
+                elif checks[item]["sense"] == "low":
+                    if parm.value <= checks[item]["limit"]:
+                        logging.info("Limit message: " + checks[item]["message"] + \
+                        " (parm:" + checks[item]["parm"] + \
+                        " limit:" + str(checks[item]["limit"]) + \
+                        " value: " + str(parm.value) + " " + parm.units)
+                        message = message + "\n" + checks[item]["message"]
+                else:
+                    logging.info("Bad sense in LIMIT_CHECKS ... ignored; sense = " + checks[item]["sense"])
+
+    if message == "LIMIT":
+        return None
+    return message
+
+
+def make_limits(nparms, nrules, seed = 1):
+    """ a repeatable set of parameters and LIMIT_CHECKS """
+
+    rnd = random.Random(seed)
+    parms = [BenchParm("parm" + str(i), rnd.uniform(0.0, 100.0), "units") for i in range(nparms)]
+    checks = {}
+    for i in range(nrules):
+        sense = rnd.choice(["high", "low"])
+        checks[str(i + 1)] = {"parm": "parm" + str(rnd.randrange(nparms)),
+                              "limit": rnd.uniform(0.0, 100.0),
+                              "sense": sense,
+                              "message": "rule " + str(i + 1) + " " + sense}
+    return parms, checks
+
+
+def bench_limits(nparms = 50, nrules = 500, loops = 2000, changed = 0.1):
+    """ time both implementations over the same sequence of values;
+        returns a dict of results """
+
+    parms, checks = make_limits(nparms, nrules)
+    env = BenchEnv(parms)
+    engine = LimitEngine(logging, checks, env)
+
+    # the same random walk for both
+    rnd = random.Random(2)
+    steps = []
+    for i in range(loops):
+        steps.append([(j, rnd.uniform(-5.0, 5.0)) for j in range(nparms) if rnd.random() < changed])
+
+    results = {}
+    for name, func in (("legacy", lambda: legacy_limits(checks, env)), ("compiled", engine.evaluate)):
+        start_values = [p.value for p in parms]
+        messages = []
+        t0 = time.perf_counter()
+        for step in steps:
+            for j, delta in step:
+                parms[j].value += delta
+            messages.append(func())
+        elapsed = time.perf_counter() - t0
+        for p, v in zip(parms, start_values):
+            p.value = v
+        results[name] = {"us_per_pass": 1e6 * elapsed / loops, "messages": messages}
+
+    # they had better agree
+    results["agree"] = results["legacy"]["messages"] == results["compiled"]["messages"]
+    for name in ("legacy", "compiled"):
+        del results[name]["messages"]
+    return results
+
+
+def legacy_on_message(env, message):
+    """ the on_message() decoding from before Env.ingest() """
+
+    logging.debug("MQTT message received:"+ message.topic)
+    logging.debug("Raw Payload:"+ str(message.payload))
+
+    parm = None
+    for attr in env.parm_list:
+        if attr.topic == message.topic:
+            parm = attr
+            break
+    if parm == None:
+        logging.info("Spurious topic data received ... ignored;  Topic = "+message.topic)
+    else:
+        logging.debug("Matched " + message.topic + " to " + parm.label)
+        parm.event = True
+        if parm.jflag == True:
+            jstring = message.payload.decode('utf-8')
+            jdict = json.loads(jstring)
+            value = jdict[list(jdict)[0]]["value"]
+            parm.when = jdict[list(jdict)[0]]["tstamp"]
+        else:
+            value = message.payload.decode('utf-8')
+
+        parm_type = type(parm.value)
+        logging.debug("Setting " + message.topic + " as " + str(parm_type) + " to " + str(value))
+        if parm_type == float:
+            parm.pvalue = parm.value
+            parm.value = float(value)
+        elif parm_type == bool:
+            if value == "True":
+                if parm.pvalue == False:
+                    parm.event = True
+                parm.pvalue = parm.value
+                parm.value = True
+            elif value == "False":
+                if parm.pvalue == True:
+                    parm.event = True
+                parm.pvalue = parm.value
+                parm.value = False
+            else:
+                logging.error("on_message():Strange value on bool from " + message.topic)
+        elif parm_type == int:
+            parm.pvalue = parm.value
+            parm.value =  int(value)
+        elif parm_type == str:
+            parm.pvalue = parm.value
+            parm.value = value
+
+
+def make_messages(env, count, seed = 3):
+    """ a repeatable mix of messages for the subscribed parameters of env """
+
+    rnd = random.Random(seed)
+    subs = [p for p in env.parm_list if p.direction == p.SUB]
+    messages = []
+    for i in range(count):
+        parm = rnd.choice(subs)
+        if type(parm.value) == bool:
+            payload = rnd.choice(["True", "False"]).encode()
+        elif parm.jflag:
+            if type(parm.value) == str:
+                value = "%02d:%02d:%02d" % (rnd.randrange(24), rnd.randrange(60), rnd.randrange(60))
+            else:
+                value = round(rnd.uniform(0.0, 100.0), 2)
+            payload = json.dumps({parm.label: {"value": value, "location": "bench", "tstamp": "12:00:00"}}).encode()
+        else:
+            payload = str(round(rnd.uniform(0.0, 100.0), 2)).encode()
+        messages.append(types.SimpleNamespace(topic = parm.topic, payload = payload))
+    return messages
+
+
+def bench_ingest(count = 50000, batch = 6):
+    """ messages/second through the original on_message() decoding and Env.ingest(),
+        and samples/second through Env.ingest_batch() """
+
+    from MonitoringParameters import Env
+
+    results = {}
+    for name in ("legacy", "ingest"):
+        env = Env(logging, None)
+        messages = make_messages(env, count)
+        t0 = time.perf_counter()
+        if name == "legacy":
+            for message in messages:
+                legacy_on_message(env, message)
+        else:
+            ingest = env.ingest
+            for message in messages:
+                ingest(message.topic, message.payload)
+        elapsed = time.perf_counter() - t0
+        results[name] = {"msgs_per_sec": count / elapsed}
+
+    # the same json samples, "batch" at a time in one packet
+    env = Env(logging, None)
+    samples = []
+    for message in make_messages(env, count):
+        if message.payload.startswith(b"{"):
+            samples.append(json.loads(message.payload))
+    packets = [json.dumps(samples[i:i + batch]).encode() for i in range(0, len(samples), batch)]
+    t0 = time.perf_counter()
+    for packet in packets:
+        env.ingest_batch(packet)
+    elapsed = time.perf_counter() - t0
+    results["batch"] = {"samples_per_sec": len(samples) / elapsed, "batch": batch}
+    return results
+
+
+def bench_sites(counts = (1, 10, 100), messages = 20000):
+    """ per-site memory and per-message route + decode cost for each site count """
+
+    from MonitoringParameters import Env, EnvRouter
+    from Monitoring_conf import conf
+
+    results = []
+    for count in counts:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        router = EnvRouter(logging)
+        keep = []
+        for i in range(count):
+            env = Env(logging, None, None, {"NAME": "site" + str(i), "PREFIX": "site" + str(i)})
+            keep.append(LimitEngine(logging, conf["LIMIT_CHECKS"], env))
+            router.add(env)
+        per_site = (tracemalloc.get_traced_memory()[0] - before) / count
+        tracemalloc.stop()
+
+        # the same mix of messages spread over all of the sites
+        rnd = random.Random(4)
+        mix = []
+        for env in router.envs:
+            mix.extend(make_messages(env, max(1, messages // count)))
+        rnd.shuffle(mix)
+        mix = mix[:messages]
+
+        t0 = time.perf_counter()
+        for message in mix:
+            router.route(message.topic).ingest(message.topic, message.payload)
+        elapsed = time.perf_counter() - t0
+        results.append({"sites": count, "bytes_per_site": per_site, "us_per_msg": 1e6 * elapsed / len(mix)})
+    return results
+
+
+class SlowFile:
+    """ a file where every write takes a while (like a busy SD card) """
+
+    def __init__(self, f, delay):
+        self.f = f
+        self.delay = delay
+
+    def write(self, text):
+        time.sleep(self.delay)
+        return self.f.write(text)
+
+    def flush(self):
+        self.f.flush()
+
+
+def bench_logging(count = 20000, delay = 0.0):
+    """ microseconds per logging.info() call as seen by the caller """
+
+    root = logging.getLogger()
+    saved = (root.handlers[:], root.level)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.log")
+        fmt = '%(asctime)s - bench - %(levelname)s - %(message)s'
+        for name in ("direct", "queue", "queue_repeats"):
+            f = open(path, "w")
+            stream = SlowFile(f, delay) if delay > 0.0 else f
+            for old in root.handlers[:]:
+                root.removeHandler(old)
+            listener = None
+            if name == "direct":
+                handler = logging.StreamHandler(stream)
+                handler.setFormatter(logging.Formatter(fmt))
+                root.addHandler(handler)
+                root.setLevel(logging.INFO)
+            else:
+                listener = setup_logging(stream = stream, format = fmt, window = 60.0)
+
+            t0 = time.perf_counter()
+            for i in range(count):
+                if name == "queue_repeats":
+                    # the same few messages over and over (e.g. spurious topics)
+                    logging.info("Spurious topic data received ... ignored;  Topic = %s", "x/" + str(i % 4))
+                else:
+                    logging.info("Setting %s to %s", "parm" + str(i % 50), i)
+            elapsed = time.perf_counter() - t0
+            if listener is not None:
+                listener.stop()   # (not timed: this is the listener catching up)
+            f.close()
+            results[name] = {"us_per_call": 1e6 * elapsed / count, "bytes": os.path.getsize(path)}
+
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    for handler in saved[0]:
+        root.addHandler(handler)
+    root.setLevel(saved[1])
+    return results
+
+
+def bench_stress(writers = 4, updates = 20000):
+    """ lost events and writer cost: unsynchronized writes vs. posted updates """
+
+    from MonitoringParameters import Env, Parm
+
+    results = {}
+    for name in ("legacy", "posted"):
+        events = queue.Queue()
+        env = Env(logging, None, events, {"NAME": "stress", "LOCATION": "stress", "PREFIX": "stress", "PINS": False})
+        parms = []
+        for w in range(writers):
+            parms.append(env.register(Parm("s" + str(w), False, False, "t/f", "00:00:00", Parm.SUB, "stress/s" + str(w))))
+        seen = [[] for w in range(writers)]
+        cost = [0.0] * writers
+
+        def write(w):
+            parm = parms[w]
+            topic = parm.topic
+            t0 = time.perf_counter()
+            for i in range(updates):
+                payload = b"True" if i % 2 == 0 else b"False"
+                if name == "legacy":
+                    # what on_message() used to do, from paho's thread
+                    target = env.lookup(topic)
+                    target.event = True
+                    target.set(target.convert(payload.decode("utf-8")))
+                else:
+                    env.ingest(topic, payload)
+                env.notify()
+            cost[w] = time.perf_counter() - t0
+
+        threads = [threading.Thread(target = write, args = (w,)) for w in range(writers)]
+        for thread in threads:
+            thread.start()
+
+        def consume():
+            # the alarm logic: act on each event once and clear it
+            if name == "posted":
+                env.apply_updates()
+            for w in range(writers):
+                if parms[w].event:
+                    seen[w].append(parms[w].value)
+                    parms[w].event = False
+
+        while any([thread.is_alive() for thread in threads]):
+            try:
+                events.get(timeout = 0.01)
+            except queue.Empty:
+                pass
+            consume()
+        while env.inbox:
+            consume()
+        consume()
+
+        # each writer alternates, so every event should show the other value from the one before
+        lost = 0
+        for w in range(writers):
+            lost += updates - len(seen[w])
+            lost += sum([1 for a, b in zip(seen[w], seen[w][1:]) if a == b])
+        results[name] = {"lost": lost, "events": writers * updates,
+                         "us_per_update": 1e6 * sum(cost) / (writers * updates),
+                         "deferred": env.deferred}
+    return results
+
+
+class LegacyParm:
+    """ the Parm from before __slots__ (a __dict__ each, and a do nothing
+        physical() lambda instead of None) """
+
+    SUB = 1
+    PUB = 2
+    LOCAL = 1
+    REMOTE = 2
+
+    def __init__(self, label, value, pvalue, units, when, direction, topic, event = False, jflag = False, physical = None, io_pin = -1, io_dir = 1, deadband = 0.0):
+        from MonitoringParameters import CONVERTERS, identity
+        self.label = label
+        self.value = value
+        self.pvalue = pvalue
+        self.units = units
+        self.when = when
+        self.direction = direction
+        self.topic = topic
+        self.event = event
+        self.jflag = jflag
+        self.physical = physical if physical is not None else lambda x: None
+        self.io_pin = io_pin
+        self.io_dir = io_dir
+        self.deadband = deadband
+        self.pub_value = None
+        self.pub_time = 0.0
+        self.series = None
+        self.convert = CONVERTERS.get(type(value), identity)
+        self.store = None
+
+    from MonitoringParameters import Parm
+    set = Parm.set
+    changed = Parm.changed
+    del Parm
+
+
+def legacy_physical(env):
+    """ Env.physical() before Env.io_list """
+
+    for attr in env.parm_list:
+        attr.physical(attr)
+
+
+def rss():
+    """ resident set size of this process (bytes) """
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def legacy_write_pin(env, attr):
+    """ Env.write_pin() before it only wrote changes """
+
+    env.logging.debug("Setting " + attr.label + " to " + str(attr.value) + " on pin " + str(attr.io_pin))
+    env.gpio("output", attr.io_pin, attr.value)
+
+
+def legacy_read_pin(env, attr):
+    """ the original Env.read_pin(), polling an input every pass """
+
+    env.logging.debug("Setting " + attr.label + " to " + str(attr.value) + " from pin " + str(attr.io_pin))
+    value = bool(env.gpio("input", attr.io_pin))
+    if value != attr.value:
+        attr.set(value)
+        attr.event = True
+    else:
+        attr.pvalue = attr.value
+
+
+def bench_gpio(passes = 10000, every = 100):
+    """ RPi.GPIO calls and physical() cost per pass, polled/always written vs. edges/changes only """
+
+    from MonitoringParameters import Env
+    from MonitoringSites import Site, ManageAlarms
+    from MonitoringTimers import TimerQueue
+
+    results = {}
+    for name in ("legacy", "changes"):
+        events = queue.Queue()
+        timers = TimerQueue()
+        client = FakeClient(FakeBroker(), "bench")
+        env = Env(logging, client, events, {"NAME": "bench", "PREFIX": "bench", "PINS": True})
+        site = Site(env, ManageAlarms(env, MailStub(), timers))
+        env.physical_init(timers)
+        if name == "legacy":
+            env.keysw.physical = lambda attr: legacy_read_pin(env, attr)
+            env.light.physical = env.ovrled.physical = lambda attr: legacy_write_pin(env, attr)
+            env.io_list = [env.keysw, env.light, env.ovrled]
+
+        calls = env.gpio_calls
+        cost = 0.0
+        for n in range(passes):
+            if n % every == 0:
+                env.post(env.o_light, not env.o_light.value)
+            env.apply_updates()
+            site.alarms.process_stimuluses()
+            site.alarms.process_overrides()
+            t0 = time.perf_counter()
+            env.physical()
+            cost += time.perf_counter() - t0
+        results[name] = {"calls_per_pass": (env.gpio_calls - calls) / passes, "us_per_pass": 1e6 * cost / passes}
+    return results
+
+
+def bench_probe(timeout = 0.5):
+    """ prober round time and quorum decisions against local stand ins """
+
+    import asyncio
+    import socket
+    from MonitoringProbe import Prober, Target
+
+    listening = socket.socket()
+    listening.bind(("127.0.0.1", 0))
+    listening.listen(16)
+    closed = socket.socket()
+    closed.bind(("127.0.0.1", 0))          # bound, not listening: refused
+    silent = socket.socket()
+    silent.bind(("127.0.0.1", 0))
+    silent.listen(0)                        # a full backlog: connects hang
+    hold = [socket.socket() for i in range(4)]
+    for h in hold:
+        h.setblocking(False)
+        h.connect_ex(silent.getsockname())
+    dns = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    dns.bind(("127.0.0.1", 0))
+
+    def answer():
+        while True:
+            try:
+                data, addr = dns.recvfrom(512)
+            except OSError:
+                return
+            # NOERROR, the question and one A record
+            dns.sendto(data[:2] + b"\x81\x80\x00\x01\x00\x01\x00\x00\x00\x00" + data[12:] +
+                       b"\xc0\x0c\x00\x01\x00\x01\x00\x00\x00\x3c\x00\x04\x7f\x00\x00\x01", addr)
+    threading.Thread(target = answer, name = "bench-dns", daemon = True).start()
+
+    def targets(down):
+        """ 1 local and 4 internet targets, the first "down" internet ones not answering """
+        internet = [Target("dns", "dns", "127.0.0.1", dns.getsockname()[1], query = "example.com"),
+                    Target("open", "tcp", "127.0.0.1", listening.getsockname()[1]),
+                    Target("refused", "tcp", "127.0.0.1", closed.getsockname()[1]),
+                    Target("open2", "tcp", "127.0.0.1", listening.getsockname()[1])]
+        for t in internet[:down]:
+            t.kind, t.port = "tcp", silent.getsockname()[1]
+        return [Target("broker", "tcp", "127.0.0.1", listening.getsockname()[1], "local")] + internet
+
+    results = {}
+    try:
+        for down in (0, 1, 3):
+            prober = Prober(logging, targets(down), timeout, quorum = 2)
+            t0 = time.perf_counter()
+            state = asyncio.run(prober.round())
+            elapsed = time.perf_counter() - t0
+            serial = sum([t.results[-1][1] for t in prober.targets])
+            results[down] = {"round_ms": 1000.0 * elapsed, "serial_ms": 1000.0 * serial,
+                             "internet": state["internet"], "up": state["up"], "of": state["of"]}
+    finally:
+        for s in [listening, closed, silent, dns] + hold:
+            s.close()
+    return results
+
+
+class OutageDispatcher:
+    """ a Dispatcher whose mail fails while the internet is down """
+
+    def __init__(self, dispatcher):
+        self.internet = False
+        self.delivered = []
+        self.attempts = 0
+        self.lock = threading.Lock()
+        dispatcher.deliver = self.deliver
+
+    def deliver(self, job):
+        with self.lock:
+            self.attempts += 1
+            if not self.internet:
+                return False
+            self.delivered.append(job.message)
+        return True
+
+
+def bench_spool(messages = 50, appends = 500):
+    """ messages lost to an outage without and with the spool, and the
+        cost of spooling a message """
+
+    from MonitoringDispatch import Dispatcher
+    from MonitoringSpool import Spool
+
+    # (every failure is logged; not what's being measured)
+    quiet = logging.getLogger("bench.spool")
+    quiet.setLevel(logging.CRITICAL)
+
+    def wait_for(condition, timeout = 10.0):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        sent = ["alarm %d" % i for i in range(messages)]
+        for name in ("legacy", "spool", "held"):
+            spool = None
+            if name != "legacy":
+                spool = Spool(quiet, os.path.join(directory, name + ".jsonl"))
+                spool.load()
+            dispatcher = Dispatcher(quiet, 1, messages, retries = 2, backoff = 0.01, spool = spool)
+            outage = OutageDispatcher(dispatcher)
+            if name == "held":
+                dispatcher.set_online(False)   # what check_network() does
+            dispatcher.start()
+            for message in sent:
+                dispatcher.send("Alarm", message, ["bench@localhost"])
+            # the outage lasts until the retries are used up
+            wait_for(lambda: dispatcher.stats["failed"] + dispatcher.stats["spooled"] >= messages, 1.0)
+            outage.internet = True
+            if name == "held":
+                dispatcher.set_online(True)
+            elif spool is not None:
+                dispatcher.flush()             # the "SPOOL_RETRY" timer
+            wait_for(lambda: len(outage.delivered) >= messages, 2.0)
+            dispatcher.stop()
+            results[name] = {"delivered": len(outage.delivered), "lost": messages - len(set(outage.delivered)),
+                             "in_order": outage.delivered == sent[:len(outage.delivered)],
+                             "attempts": outage.attempts,
+                             "left": len(spool.pending()) if spool is not None else 0}
+            if spool is not None:
+                spool.close()
+
+        # stopped during the outage: the next run sends what's left
+        path = os.path.join(directory, "restart.jsonl")
+        spool = Spool(quiet, path)
+        spool.load()
+        dispatcher = Dispatcher(quiet, 1, messages, spool = spool)
+        dispatcher.set_online(False)
+        dispatcher.start()
+        for message in sent:
+            dispatcher.send("Alarm", message, ["bench@localhost"])
+        dispatcher.stop()
+        spool.close()
+        spool = Spool(quiet, path)
+        recovered = spool.load()
+        dispatcher = Dispatcher(quiet, 1, messages, spool = spool)
+        outage = OutageDispatcher(dispatcher)
+        outage.internet = True
+        dispatcher.start()
+        wait_for(lambda: len(outage.delivered) >= messages, 2.0)
+        dispatcher.stop()
+        spool.close()
+        results["restart"] = {"recovered": recovered, "delivered": len(outage.delivered),
+                              "in_order": outage.delivered == sent, "bytes_left": os.path.getsize(path)}
+
+        # what a message costs the caller (append + ack)
+        for policy in ("always", "batch", "never"):
+            spool = Spool(quiet, os.path.join(directory, policy + ".jsonl"), policy)
+            spool.load()
+            t0 = time.perf_counter()
+            for i in range(appends):
+                spool.append("Alarm", "ALERT: Temp is very high", ["bench@localhost"])
+            append = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            for seq in range(1, appends + 1):
+                spool.ack(seq)
+            ack = time.perf_counter() - t0
+            spool.close()
+            results[policy] = {"append_us": 1e6 * append / appends, "ack_us": 1e6 * ack / appends}
+    return results
+
+
+def noisy_edges(pin, transitions, bounces, glitches, seed = 6):
+    """ made up edges (pin, level, time) of a noisy input, in time order,
+        with 1 s between the real transitions """
+
+    rnd = random.Random(seed)
+    edges = []
+    level = False
+    for i in range(transitions):
+        t = i + 1.0
+        level = not level
+        edges.append((pin, level, t))
+        # contact bounce right after it (within 2 ms)
+        for b in range(bounces):
+            t += rnd.uniform(0.0001, 0.0002)
+            edges.append((pin, not level, t))
+            t += rnd.uniform(0.0001, 0.0002)
+            edges.append((pin, level, t))
+        # the same edge reported twice now and then
+        if rnd.random() < 0.3:
+            edges.append((pin, level, t + 0.0001))
+        # short spikes later on (under 1 ms)
+        for g in range(glitches):
+            t = i + 1.0 + rnd.uniform(0.1, 0.9)
+            edges.append((pin, not level, t))
+            edges.append((pin, level, t + rnd.uniform(0.0001, 0.0009)))
+    edges.sort(key = lambda e: e[2])
+    return edges
+
+
+def bench_edges(transitions = 1000, bounces = 5, glitches = 3, glitch = 0.002, debounce = 0.01):
+    """ transitions out of the edge filter vs. the old motion_edge() for a noisy input,
+        and the cost of the callback """
+
+    from MonitoringEdges import EdgeFilter
+    from MonitoringParameters import Parm
+
+    parm = Parm("motion", False, False, "t/f", "00:00:00", Parm.PUB, "bench/motion", io_pin = 4)
+    edges = noisy_edges(4, transitions, bounces, glitches)
+
+    # the old motion_edge(): every change of the level is posted
+    legacy = 0
+    level = False
+    for pin, value, t in edges:
+        if value != level:
+            level = value
+            legacy += 1
+
+    # the filter, drained every 5 ms (a busy main loop)
+    levels = {4: False}
+    f = EdgeFilter(logging, levels.get)
+    f.watch(parm, glitch, debounce)
+    out = []
+    i = 0
+    now = 0.0
+    end = edges[-1][2] + 1.0
+    while now < end:
+        now += 0.005
+        while i < len(edges) and edges[i][2] <= now:
+            f.edges.append(edges[i])
+            i += 1
+        out.extend([level for p, level in f.drain(now)[0]])
+    alternate = all([a != b for a, b in zip(out, out[1:])])
+    accepted, rejected = f.counts()["motion"]
+
+    # the callback: read the pin, queue the edge, wake the loop
+    gpio = sys.modules["RPi.GPIO"]
+    events = queue.Queue()
+    f = EdgeFilter(logging, gpio.input, lambda: events.put_nowait((time.monotonic(), None)))
+    count = 20000
+    t0 = time.perf_counter()
+    for n in range(count):
+        f.edge(4)
+    callback = 1e6 * (time.perf_counter() - t0) / count
+
+    return {"edges": len(edges), "transitions": transitions, "legacy": legacy, "filtered": len(out),
+            "alternate": alternate, "rejected": rejected, "callback_us": callback}
+
+
+# run by bench_parms() in a fresh python: prints the results as json
+PARMS_SCRIPT = """
+import json, logging, sys, time, tracemalloc
+from MonitoringReplay import install_gpio, FakeBroker, FakeClient
+install_gpio()
+import MonitoringParameters
+import MonitoringBench
+legacy, nsites, passes = sys.argv[1] == "legacy", int(sys.argv[2]), int(sys.argv[3])
+if legacy:
+    MonitoringParameters.Parm = MonitoringBench.LegacyParm
+Parm = MonitoringParameters.Parm
+
+client = FakeClient(FakeBroker(), "bench")
+rss = MonitoringBench.rss()
+envs = [MonitoringParameters.Env(logging, client, None, {"NAME": "s" + str(i), "PREFIX": "s" + str(i), "PINS": i == 0})
+        for i in range(nsites)]
+grown = MonitoringBench.rss() - rss
+
+tracemalloc.start()
+before = tracemalloc.get_traced_memory()[0]
+parms = [Parm("p" + str(i), 0.0, 0.0, "units", "00:00:00", Parm.PUB, "bench/p" + str(i)) for i in range(10000)]
+per_parm = (tracemalloc.get_traced_memory()[0] - before) / len(parms)
+tracemalloc.stop()
+del parms
+for env in envs:
+    env.physical_init()
+    env.data_sync(client)
+
+physical = MonitoringBench.legacy_physical if legacy else MonitoringParameters.Env.physical
+t0 = time.perf_counter()
+for n in range(passes):
+    for env in envs:
+        physical(env)
+        env.data_sync(client)
+elapsed = time.perf_counter() - t0
+print(json.dumps({"bytes_per_parm": per_parm, "rss_per_site": grown / nsites,
+                  "us_per_pass": 1e6 * elapsed / passes, "visited": sum([len(env.parm_list if legacy else env.io_list) for env in envs])}))
+"""
+
+
+def bench_parms(nsites = 100, passes = 2000):
+    """ the original Parm vs. the __slots__ one, each in a fresh python """
+
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join([p for p in sys.path if p]))
+    results = {}
+    for variant in ("legacy", "slots"):
+        result = subprocess.run([sys.executable, "-c", PARMS_SCRIPT, variant, str(nsites), str(passes)], env = env,
+                                stdout = subprocess.PIPE, stderr = subprocess.PIPE, check = True)
+        results[variant] = json.loads(result.stdout.decode("utf-8").splitlines()[-1])
+    return results
+
+
+# run by bench_startup() in a fresh python: prints the times as json
+STARTUP_SCRIPT = """
+import json, sys, time
+t0 = time.perf_counter()
+import Monitoring_local
+t1 = time.perf_counter()
+loaded = [m for m in ("paho.mqtt.client", "RPi.GPIO", "http.server", "multiprocessing", "MonitoringHistory", "asyncio")
+          if m in sys.modules]
+
+from MonitoringReplay import install_gpio, FakeBroker, FakeClient
+from Monitoring_conf import conf
+install_gpio()
+for key in ("HISTORY_DIR", "CHECKPOINT_FILE", "SPOOL_FILE", "PROBE_STATE_FILE"):
+    conf.pop(key, None)
+conf.update(SHARDS = 0, METRICS_PORT = 0, METRICS_PUBLISH = 0)
+t2 = time.perf_counter()
+loop = Monitoring_local.start(FakeClient(FakeBroker()))
+t3 = time.perf_counter()
+Monitoring_local.shutdown(loop)
+print(json.dumps({"import": t1 - t0, "setup": t3 - t2, "sites": len(Monitoring_local.sites), "loaded": loaded}))
+"""
+
+
+def bench_startup(repeat = 5):
+    """ import and set up times of Monitoring_local.py (best of repeat fresh processes) """
+
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join([p for p in sys.path if p]))
+    best = None
+    for r in range(repeat):
+        result = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], env = env,
+                                stdout = subprocess.PIPE, stderr = subprocess.PIPE, check = True)
+        run = json.loads(result.stdout.decode("utf-8").splitlines()[-1])
+        if best is None:
+            best = run
+        else:
+            best["import"] = min(best["import"], run["import"])
+            best["setup"] = min(best["setup"], run["setup"])
+    return {"import_ms": 1000.0 * best["import"], "setup_ms": 1000.0 * best["setup"],
+            "sites": best["sites"], "loaded": best["loaded"]}
+
+
+def make_site(nparms, nrules, events = None, seed = 5):
+    """ a site with (at least) nparms parameters and nrules LIMIT_CHECKS on
+        them, on a broker with nobody listening; returns (site, router, timers) """
+
+    from MonitoringParameters import Env, EnvRouter, Parm
+    from MonitoringSeries import Series
+    from MonitoringSites import Site, ManageAlarms
+    from MonitoringTimers import TimerQueue
+    from Monitoring_conf import conf
+
+    client = FakeClient(FakeBroker(), "bench")
+    if events is None:
+        events = queue.Queue()
+    timers = TimerQueue(lambda: events.put_nowait((time.monotonic(), None)))
+    site_conf = {"NAME": "bench", "LOCATION": "bench", "PREFIX": "bench", "PINS": False}
+    env = Env(logging, client, events, site_conf)
+
+    # extra numeric parameters: every other one is from a remote sensor (json)
+    # and the rest are published by us
+    for i in range(nparms - len(env.parm_list)):
+        direction = Parm.SUB if i % 2 == 0 else Parm.PUB
+        parm = Parm("x" + str(i), 0.0, 0.0, "units", "00:00:00", direction, "bench/x" + str(i),
+                    False, direction == Parm.SUB)
+        parm.series = Series(conf.get("SERIES_LEN", 512))
+        env.register(parm)
+
+    # rules on the numeric parameters
+    rnd = random.Random(seed)
+    numeric = [p.label for p in env.parm_list if type(p.value) == float]
+    checks = {}
+    for i in range(nrules):
+        sense = rnd.choice(["high", "low"])
+        checks[str(i + 1)] = {"parm": rnd.choice(numeric), "limit": rnd.uniform(0.0, 100.0),
+                              "sense": sense, "message": "rule " + str(i + 1) + " " + sense}
+    site_conf["LIMIT_CHECKS"] = checks
+
+    router = EnvRouter(logging)
+    router.add(env)
+    env.subscribe(client)
+    return Site(env, ManageAlarms(env, MailStub(), timers)), router, timers
+
+
+def bench_passes(nparms, nrules, passes = 500, changed = 0.1):
+    """ microseconds per call of each step of a main loop pass, with a
+        fraction of the parameters changing between passes """
+
+    site, router, timers = make_site(nparms, nrules)
+    env = site.env
+    alarms = site.alarms
+    numeric = [p for p in env.parm_list if type(p.value) == float]
+    rnd = random.Random(6)
+    steps = []
+    for i in range(passes):
+        steps.append([(p, rnd.uniform(0.0, 100.0)) for p in numeric if rnd.random() < changed])
+
+    costs = {"process_stimuluses": 0.0, "process_limits": 0.0, "data_sync": 0.0, "display_parameters": 0.0}
+    clock = time.perf_counter
+    for step in steps:
+        for parm, value in step:
+            parm.event = True
+            parm.set(value)
+        t0 = clock()
+        alarms.process_stimuluses()
+        t1 = clock()
+        alarms.process_limits()
+        t2 = clock()
+        env.data_sync(env.mqtt_client)
+        t3 = clock()
+        env.display_parameters()
+        t4 = clock()
+        costs["process_stimuluses"] += t1 - t0
+        costs["process_limits"] += t2 - t1
+        costs["data_sync"] += t3 - t2
+        costs["display_parameters"] += t4 - t3
+        # let the limit messages go out again (the holdoff would stop them)
+        alarms.limit_sent = False
+
+    return dict([(name, 1e6 * total / passes) for name, total in costs.items()])
+
+
+def bench_on_message(nparms, count = 20000):
+    """ messages/second through on_message() (route, decode, notify) flat out """
+
+    site, router, timers = make_site(nparms, 0)
+    messages = [FakeMessage(m.topic, m.payload) for m in make_messages(site.env, count)]
+    deliver = router.deliver
+    t0 = time.perf_counter()
+    for message in messages:
+        deliver(message.topic, message.payload)
+    return count / (time.perf_counter() - t0)
+
+
+def bench_rate(nparms, nrules, rate, seconds = 2.0):
+    """ offer messages to on_message() at rate/second, with the main loop
+        running, for a while; returns what was absorbed and the latency """
+
+    from MonitoringSites import EventLoop
+
+    events = StimulusQueue()
+    site, router, timers = make_site(nparms, nrules, events)
+    count = max(1, int(rate * seconds))
+    messages = make_messages(site.env, count)
+    loop = EventLoop([site], events, timers)
+    done = threading.Event()
+    lag = [0.0]
+
+    def inject():
+        start = time.monotonic()
+        for i, message in enumerate(messages):
+            due = start + i / rate
+            wait = due - time.monotonic()
+            if wait > 0.0:
+                time.sleep(wait)
+            else:
+                lag[0] = max(lag[0], -wait)
+            events.current.t = time.monotonic()
+            router.deliver(message.topic, message.payload)
+            events.current.t = None
+        done.set()
+
+    injector = threading.Thread(target = inject, name = "bench-inject")
+    latencies = []
+    t0 = time.monotonic()
+    injector.start()
+    while not (done.is_set() and events.empty()):
+        loop.run_once()
+        end = time.monotonic()
+        latencies.extend([end - t for t in events.taken])
+        del events.taken[:]
+        site.alarms.limit_sent = False
+    elapsed = time.monotonic() - t0
+    injector.join()
+
+    latencies.sort()
+    return {"msgs_per_sec": count / elapsed, "lat_p99_ms": 1000.0 * percentile(latencies, 0.99),
+            "lag_max_ms": 1000.0 * lag[0], "passes": loop.stats["passes"]}
+
+
+def bench_suite(parm_counts, rule_counts, rates, repeat = 3):
+    """ run the matrix; returns {metric name: {"value", "unit", "better"}} """
+
+    results = {}
+
+    def record(name, value, unit, better):
+        # keep the best of the repeats
+        old = results.get(name)
+        if old is None or (better == "lower" and value < old["value"]) or (better == "higher" and value > old["value"]):
+            results[name] = {"value": value, "unit": unit, "better": better}
+
+    for r in range(repeat):
+        for nparms in parm_counts:
+            record("on_message[parms=%d]" % nparms, bench_on_message(nparms), "msgs/s", "higher")
+            for nrules in rule_counts:
+                for step, cost in bench_passes(nparms, nrules).items():
+                    record("%s[parms=%d,rules=%d]" % (step, nparms, nrules), cost, "us/pass", "lower")
+
+    # the paced runs take real time: once each, at the middle size
+    nparms = parm_counts[len(parm_counts) // 2]
+    nrules = rule_counts[len(rule_counts) // 2]
+    for rate in rates:
+        r = bench_rate(nparms, nrules, rate)
+        record("absorbed[rate=%d]" % rate, r["msgs_per_sec"], "msgs/s", "higher")
+        record("latency_p99[rate=%d]" % rate, r["lat_p99_ms"], "ms", "lower")
+
+    r = bench_startup(repeat)
+    record("startup_import", r["import_ms"], "ms", "lower")
+    record("startup_setup[sites=%d]" % r["sites"], r["setup_ms"], "ms", "lower")
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ the metrics worse than the baseline by more than threshold (a fraction) """
+
+    flagged = []
+    for name, r in sorted(results.items()):
+        b = baseline.get(name)
+        if b is None or b["value"] <= 0.0:
+            continue
+        if r["better"] == "lower":
+            change = r["value"] / b["value"] - 1.0
+        else:
+            change = b["value"] / r["value"] - 1.0 if r["value"] > 0.0 else float("inf")
+        if change > threshold:
+            flagged.append((name, b["value"], r["value"], r["unit"], change))
+    return flagged
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Monitoring_zimKnives micro-benchmarks")
+    sub = parser.add_subparsers(dest = "bench")
+
+    limits = sub.add_parser("limits", help = "LIMIT_CHECKS evaluation")
+    limits.add_argument("--parms", type = int, default = 50)
+    limits.add_argument("--rules", type = int, default = 500)
+    limits.add_argument("--loops", type = int, default = 2000)
+    limits.add_argument("--changed", type = float, default = 0.1, help = "fraction of parameters changing per pass")
+
+    ingest = sub.add_parser("ingest", help = "mqtt message decoding")
+    ingest.add_argument("--messages", type = int, default = 50000)
+    ingest.add_argument("--batch", type = int, default = 6, help = "samples per batch packet")
+
+    sites = sub.add_parser("sites", help = "many sites in one process")
+    sites.add_argument("--sites", default = "1,10,100", help = "comma separated site counts")
+    sites.add_argument("--messages", type = int, default = 20000)
+
+    logs = sub.add_parser("logging", help = "logging cost to the caller")
+    logs.add_argument("--messages", type = int, default = 20000)
+    logs.add_argument("--delay", type = float, default = 0.0, help = "extra seconds per write (slow disk)")
+
+    stress = sub.add_parser("stress", help = "lost events with concurrent writers")
+    stress.add_argument("--writers", type = int, default = 4)
+    stress.add_argument("--updates", type = int, default = 20000, help = "updates per writer")
+
+    startup = sub.add_parser("startup", help = "Monitoring_local.py import and set up times")
+    startup.add_argument("--repeat", type = int, default = 5, help = "keep the best of this many runs")
+
+    parms = sub.add_parser("parms", help = "Parm memory and per pass cost")
+    parms.add_argument("--sites", type = int, default = 100)
+    parms.add_argument("--passes", type = int, default = 2000)
+
+    edges = sub.add_parser("edges", help = "gpio edge filtering")
+    edges.add_argument("--transitions", type = int, default = 1000)
+    edges.add_argument("--bounces", type = int, default = 5, help = "bounces after each transition")
+    edges.add_argument("--glitches", type = int, default = 3, help = "short spikes between transitions")
+
+    gpio = sub.add_parser("gpio", help = "RPi.GPIO calls per pass")
+    gpio.add_argument("--passes", type = int, default = 10000)
+    gpio.add_argument("--every", type = int, default = 100, help = "toggle the light every N passes")
+
+    probe = sub.add_parser("probe", help = "network prober rounds")
+    probe.add_argument("--timeout", type = float, default = 0.5)
+
+    spool = sub.add_parser("spool", help = "messages kept through an outage")
+    spool.add_argument("--messages", type = int, default = 50, help = "alarms sent during the outage")
+    spool.add_argument("--appends", type = int, default = 500, help = "messages timed per fsync policy")
+
+    suite = sub.add_parser("suite", help = "the hot paths, recorded and compared to a baseline")
+    suite.add_argument("--parms", default = "14,100,1000", help = "comma separated parameter counts")
+    suite.add_argument("--rules", default = "10,100,1000", help = "comma separated rule counts")
+    suite.add_argument("--rates", default = "100,1000,10000", help = "comma separated messages/second")
+    suite.add_argument("--repeat", type = int, default = 3, help = "keep the best of this many runs")
+    suite.add_argument("--out", help = "write the results (json) here")
+    suite.add_argument("--baseline", help = "compare with the results in this file")
+    suite.add_argument("--threshold", type = float, default = 0.25, help = "fraction worse to flag")
+
+    args = parser.parse_args()
+
+    # the benchmarks shouldn't be timing the log file
+    logging.basicConfig(level = logging.WARNING)
+
+    # ... or touching the pins
+    install_gpio()
+
+    if args.bench == "limits":
+        r = bench_limits(args.parms, args.rules, args.loops, args.changed)
+        print("limits: %d parms, %d rules, %d passes, %.0f%% changing" %
+              (args.parms, args.rules, args.loops, 100.0 * args.changed))
+        print("  legacy   : %9.1f us/pass" % r["legacy"]["us_per_pass"])
+        print("  compiled : %9.1f us/pass (%.1fx)" %
+              (r["compiled"]["us_per_pass"], r["legacy"]["us_per_pass"] / r["compiled"]["us_per_pass"]))
+        print("  results agree: %s" % r["agree"])
+    elif args.bench == "ingest":
+        r = bench_ingest(args.messages, args.batch)
+        print("ingest: %d messages" % args.messages)
+        print("  legacy on_message : %9.0f msgs/s" % r["legacy"]["msgs_per_sec"])
+        print("  Env.ingest        : %9.0f msgs/s (%.1fx)" %
+              (r["ingest"]["msgs_per_sec"], r["ingest"]["msgs_per_sec"] / r["legacy"]["msgs_per_sec"]))
+        print("  Env.ingest_batch  : %9.0f samples/s (%d per packet)" %
+              (r["batch"]["samples_per_sec"], r["batch"]["batch"]))
+    elif args.bench == "sites":
+        print("sites: %d messages" % args.messages)
+        for r in bench_sites([int(n) for n in args.sites.split(",")], args.messages):
+            print("  %4d sites : %8.0f bytes/site, %6.2f us/msg (route + decode)" %
+                  (r["sites"], r["bytes_per_site"], r["us_per_msg"]))
+    elif args.bench == "logging":
+        r = bench_logging(args.messages, args.delay)
+        print("logging: %d messages, %.1f ms per write" % (args.messages, 1000.0 * args.delay))
+        print("  direct to the file : %8.2f us/call" % r["direct"]["us_per_call"])
+        print("  through the queue  : %8.2f us/call (%.1fx)" %
+              (r["queue"]["us_per_call"], r["direct"]["us_per_call"] / r["queue"]["us_per_call"]))
+        print("  repeats collapsed  : %8.2f us/call, %d bytes written instead of %d" %
+              (r["queue_repeats"]["us_per_call"], r["queue_repeats"]["bytes"], r["queue"]["bytes"]))
+    elif args.bench == "stress":
+        r = bench_stress(args.writers, args.updates)
+        print("stress: %d writers x %d updates" % (args.writers, args.updates))
+        print("  unsynchronized : %6d of %d events lost, %6.2f us/update" %
+              (r["legacy"]["lost"], r["legacy"]["events"], r["legacy"]["us_per_update"]))
+        print("  posted updates : %6d of %d events lost, %6.2f us/update (%d passes held back)" %
+              (r["posted"]["lost"], r["posted"]["events"], r["posted"]["us_per_update"], r["posted"]["deferred"]))
+        if r["posted"]["lost"]:
+            sys.exit(1)
+    elif args.bench == "startup":
+        r = bench_startup(args.repeat)
+        print("startup: best of %d" % args.repeat)
+        print("  import Monitoring_local : %8.1f ms" % r["import_ms"])
+        print("  start() (%d sites)       : %8.1f ms" % (r["sites"], r["setup_ms"]))
+        print("  loaded by the import    : %s" % (", ".join(r["loaded"]) or "nothing extra"))
+        if r["loaded"]:
+            sys.exit(1)
+    elif args.bench == "parms":
+        r = bench_parms(args.sites, args.passes)
+        print("parms: %d sites, %d passes" % (args.sites, args.passes))
+        for name, title in (("legacy", "original Parm  "), ("slots", "__slots__ Parm ")):
+            print("  %s: %6.0f bytes/parm, %8.0f bytes RSS/site, %8.1f us/pass (physical + data_sync), %d handlers visited" %
+                  (title, r[name]["bytes_per_parm"], r[name]["rss_per_site"], r[name]["us_per_pass"], r[name]["visited"]))
+    elif args.bench == "edges":
+        r = bench_edges(args.transitions, args.bounces, args.glitches)
+        print("edges: %d edges for %d real transitions" % (r["edges"], r["transitions"]))
+        print("  old motion_edge() : %6d transitions posted" % r["legacy"])
+        print("  edge filter       : %6d transitions posted, %d edges dropped (alternating: %s)" %
+              (r["filtered"], r["rejected"], r["alternate"]))
+        print("  callback          : %6.2f us/edge" % r["callback_us"])
+        if r["filtered"] != r["transitions"] or not r["alternate"]:
+            sys.exit(1)
+    elif args.bench == "gpio":
+        r = bench_gpio(args.passes, args.every)
+        print("gpio: %d passes, the light toggled every %d" % (args.passes, args.every))
+        print("  polled, always written : %6.3f calls/pass, %6.2f us/pass" %
+              (r["legacy"]["calls_per_pass"], r["legacy"]["us_per_pass"]))
+        print("  edges, changes written : %6.3f calls/pass, %6.2f us/pass" %
+              (r["changes"]["calls_per_pass"], r["changes"]["us_per_pass"]))
+    elif args.bench == "probe":
+        r = bench_probe(args.timeout)
+        print("probe: 5 targets, %.0f ms timeout, quorum 2" % (1000.0 * args.timeout))
+        for down, x in sorted(r.items()):
+            print("  %d not answering: round %6.1f ms (%6.1f ms one at a time), %d of %d up -> internet %s" %
+                  (down, x["round_ms"], x["serial_ms"], x["up"], x["of"], "up" if x["internet"] else "down"))
+    elif args.bench == "spool":
+        r = bench_spool(args.messages, args.appends)
+        print("spool: %d alarms sent during an outage" % args.messages)
+        for name, title in (("legacy", "no spool          "), ("spool", "spool, flushed    "), ("held", "spool, held       ")):
+            x = r[name]
+            print("  %s: %4d delivered, %4d lost, in order: %-5s %5d mail attempts" %
+                  (title, x["delivered"], x["lost"], x["in_order"], x["attempts"]))
+        x = r["restart"]
+        print("  stopped, restarted: %4d recovered from the spool, %4d delivered, in order: %s (%d bytes left)" %
+              (x["recovered"], x["delivered"], x["in_order"], x["bytes_left"]))
+        for policy in ("always", "batch", "never"):
+            print("  SPOOL_FSYNC %-6s : %8.1f us/message, %8.1f us/ack" %
+                  (policy, r[policy]["append_us"], r[policy]["ack_us"]))
+        if any([r[name]["lost"] or not r[name]["in_order"] for name in ("spool", "held")]) or \
+           r["restart"]["delivered"] != args.messages or not r["restart"]["in_order"]:
+            sys.exit(1)
+    elif args.bench == "suite":
+        results = bench_suite([int(n) for n in args.parms.split(",")], [int(n) for n in args.rules.split(",")],
+                              [int(n) for n in args.rates.split(",")], args.repeat)
+        for name, r in sorted(results.items()):
+            print("  %-48s %12.2f %s" % (name, r["value"], r["unit"]))
+        if args.out:
+            with open(args.out, "w") as f:
+                json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                           "time": time.strftime("%Y-%m-%d %H:%M:%S"), "args": vars(args),
+                           "results": results}, f, indent = 1, sort_keys = True)
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)["results"]
+            flagged = compare(results, baseline, args.threshold)
+            for name, was, now, unit, change in flagged:
+                print("REGRESSION %s: %.2f -> %.2f %s (%.0f%% worse)" % (name, was, now, unit, 100.0 * change))
+            print("%d of %d metrics worse than the baseline by more than %.0f%%" %
+                  (len(flagged), len(results), 100.0 * args.threshold))
+            if flagged:
+                sys.exit(1)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#
+# MonitoringCheckpoint.py
+#
+# Save the state of the Monitoring_zimKnives sites now and then (and at the
+# end) so that a restart or a reboot picks up where it left off.
+#
+#    This file is part of the "Monitoring zimKnives" project, which is a collection
+#    of files, including this one.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of these words as published by the author.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  Use at your own risk.
+#
+# The checkpoint is a small json file:
+#
+#   {"version": 1, "time": <time.time() when written>,
+#    "sites": {"zkshop": {"parms": {"temp": [21.5, "12:00:00"], ...},
+#                         "alarms": {"motion": <deadline or null>, ...}}}}
+#
+# The holdoffs are kept as wall clock deadlines (time.monotonic() starts
+# over after a reboot).  The file is written to a temporary name, fsync'ed
+# and renamed over the old one, so a power cut leaves the old or the new
+# one, never half of one.
+#
+
+import json
+import os
+import time
+
+VERSION = 1
+
+
+class Checkpoint:
+    """ write and read the checkpoint file for a list of sites """
+
+    def __init__(self, logging, path, max_age = 3600.0):
+        self.logging = logging
+        self.path = path
+        self.max_age = max_age    # older parameter values aren't restored
+
+    def save(self, sites):
+        """ write the state of the sites (from the main loop, so it's consistent) """
+
+        state = {"version": VERSION, "time": time.time(), "sites": {}}
+        for site in sites:
+            state["sites"][site.name] = {"parms": site.env.checkpoint(), "alarms": site.alarms.checkpoint()}
+
+        temp = self.path + ".tmp"
+        try:
+            with open(temp, "w") as f:
+                json.dump(state, f, separators = (",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self.path)
+        except (OSError, TypeError, ValueError) as err:
+            self.logging.error("Checkpoint not written to %s: %s", self.path, err)
+            return False
+        return True
+
+    def load(self):
+        """ the saved state (None if there isn't a usable one) """
+
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as err:
+            self.logging.error("Checkpoint %s not used: %s", self.path, err)
+            return None
+        if not isinstance(state, dict) or state.get("version") != VERSION:
+            self.logging.error("Checkpoint %s not used: wrong version", self.path)
+            return None
+        return state
+
+    def restore(self, state, site):
+        """ put the saved state back into a site (before it starts running) """
+
+        if state is None:
+            return False
+        saved = state["sites"].get(site.name)
+        if saved is None:
+            return False
+
+        age = time.time() - state["time"]
+        if age <= self.max_age:
+            restored = site.env.restore(saved.get("parms", {}))
+        else:
+            restored = 0
+            self.logging.info("%s: checkpoint is %.0f s old, parameter values not restored", site.name, age)
+        armed = site.alarms.restore(saved.get("alarms", {}))
+        self.logging.info("%s: restored %d parameters and %d holdoffs from %.0f s ago", site.name, restored, armed, age)
+        return True
@@ -0,0 +1,258 @@
+#
+# MonitoringDispatch.py
+#
+# Send the text/email messages for the Monitoring_zimKnives project
+# without holding up the main loop.
+#
+#    This file is part of the "Monitoring zimKnives" project, which is a collection
+#    of files, including this one.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of these words as published by the author.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  Use at your own risk.
+#
+# Messages are put on a bounded queue and a small pool of worker threads
+# does the actual sending.  All of the recipients of a message get it from
+# a single "mail" command.  If mail fails (e.g. the MTA is down) the message
+# is retried later with an increasing delay, a limited number of times.
+#
+# With a spool (MonitoringSpool.py) each message is written to disk before
+# it's queued and acknowledged once it's sent, so nothing is lost to an
+# outage or a restart:
+#
+#   - a message that's still failing after its retries (or doesn't fit on
+#     the queue) stays in the spool instead of being dropped
+#   - while the internet is down (set_online(False)) nothing is sent; when
+#     it's back the messages in the spool are sent again, oldest first
+#   - the messages left in the spool by the last run are sent at start up
+#
+
+import threading
+import collections
+import heapq
+import time
+from MonitoringMetrics import registry
+
+# what's counted/timed here (see MonitoringMetrics.py)
+MAIL_TIME = registry.histogram("zk_mail_seconds", "time for one mail command")
+MAIL_DELIVERY = registry.histogram("zk_mail_delivery_seconds", "from queueing a message to sending it")
+MAIL = registry.counter("zk_mail_total", "mail messages by what happened to them", ["result"])
+
+
+class MailJob:
+    """ one message on its way to a list of recipients """
+
+    def __init__(self, subject, message, addrs, spooled = None):
+        self.subject = subject
+        self.message = message
+        self.addrs = list(addrs)
+        self.spooled = spooled         # its sequence number in the spool
+        self.queued = time.monotonic() # used to report the delivery latency
+        self.attempts = 0
+
+
+class Dispatcher:
+    """ queue messages and send them from a pool of worker threads """
+
+    def __init__(self, logging, workers = 2, maxlen = 100, retries = 3, backoff = 30.0, timeout = 60.0, spool = None):
+        self.logging = logging
+        self.nworkers = workers
+        self.maxlen = maxlen     # max number of messages waiting (incl. retries)
+        self.retries = retries   # number of times to retry a failed delivery
+        self.backoff = backoff   # seconds before the first retry; doubles each time
+        self.timeout = timeout   # seconds to wait for the mail command
+        self.spool = spool       # keeps the messages on disk until they're sent
+
+        self.cond = threading.Condition()
+        self.pending = collections.deque()
+        self.retry = []          # heap of (when, seq, job)
+        self.seq = 0             # tie breaker for the heap
+        self.stopping = False
+        self.online = True       # False holds the messages (the internet is down)
+        self.held = set()        # spool sequence numbers queued or being sent
+        self.workers = []
+
+        # delivery statistics
+        self.stats = {"queued": 0, "sent": 0, "retried": 0, "failed": 0, "dropped": 0, "spooled": 0,
+                      "lat_sum": 0.0, "lat_max": 0.0}
+
+    def start(self):
+        """ start the worker threads (and queue what's left in the spool) """
+
+        self.flush()
+        for i in range(self.nworkers):
+            worker = threading.Thread(target=self.work, name="dispatch-" + str(i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self, timeout = 5.0):
+        """ send what's already queued (up to timeout seconds) and stop the workers """
+
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+        if self.spool is not None:
+            left = len(self.spool.pending())
+            if left:
+                self.logging.warning("%d message(s) kept in the spool to send later", left)
+        elif self.retry:
+            self.logging.error("%d message(s) abandoned waiting for retry", len(self.retry))
+
+    def send(self, subject, message, addrs):
+        """ queue a message for the recipients; returns right away
+            False if it couldn't be queued (or spooled) """
+
+        if len(addrs) == 0:
+            return True
+
+        # on disk first (not holding the queue up while it's written)
+        spooled = self.spool.append(subject, message, addrs) if self.spool is not None else None
+
+        with self.cond:
+            if len(self.pending) + len(self.retry) >= self.maxlen:
+                if spooled is not None:
+                    self.stats["spooled"] += 1
+                    MAIL.inc("spooled")
+                    self.logging.warning("Message queue full, kept in the spool: %s", subject)
+                    return True
+                self.stats["dropped"] += 1
+                MAIL.inc("dropped")
+                self.logging.error("Message queue full, dropped: %s", subject)
+                return False
+            self.pending.append(MailJob(subject, message, addrs, spooled))
+            if spooled is not None:
+                self.held.add(spooled)
+            self.stats["queued"] += 1
+            self.cond.notify()
+        return True
+
+    def flush(self):
+        """ queue the messages in the spool that aren't queued already (e.g.
+            the ones that failed, or were left by the last run), in order;
+            returns how many """
+
+        if self.spool is None:
+            return 0
+        with self.cond:
+            # (the spool is read holding cond: a worker acknowledges a
+            # message before it lets go of it in held)
+            jobs = [MailJob(r["subject"], r["message"], r["addrs"], r["seq"])
+                    for r in self.spool.pending() if r["seq"] not in self.held]
+            if jobs:
+                for job in jobs:
+                    self.held.add(job.spooled)
+                self.pending = collections.deque(sorted(list(self.pending) + jobs, key = lambda job: job.spooled))
+                self.cond.notify_all()
+        if jobs:
+            self.logging.info("%d message(s) from the spool queued", len(jobs))
+        return len(jobs)
+
+    def set_online(self, online):
+        """ hold the messages while the internet is down; send what's in the
+            spool when it comes back """
+
+        with self.cond:
+            if online == self.online:
+                return
+            self.online = online
+            self.cond.notify_all()
+        self.logging.info("Messages %s", "sent again" if online else "held until the internet is back")
+        if online:
+            self.flush()
+
+    def next_job(self):
+        """ wait for a job that is ready to go (None when stopping) """
+
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                while self.retry and self.retry[0][0] <= now:
+                    self.pending.append(heapq.heappop(self.retry)[2])
+                if self.pending and self.online:
+                    return self.pending.popleft()
+                if self.stopping:
+                    return None
+                if self.retry:
+                    self.cond.wait(self.retry[0][0] - now)
+                else:
+                    self.cond.wait()
+
+    def work(self):
+        """ worker thread: deliver jobs, reschedule the failures """
+
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+
+            job.attempts += 1
+            start = time.monotonic()
+            sent = self.deliver(job)
+            MAIL_TIME.observe(time.monotonic() - start)
+            if sent:
+                latency = time.monotonic() - job.queued
+                MAIL_DELIVERY.observe(latency)
+                MAIL.inc("sent")
+                if job.spooled is not None:
+                    self.spool.ack(job.spooled)
+                with self.cond:
+                    self.held.discard(job.spooled)
+                    self.stats["sent"] += 1
+                    self.stats["lat_sum"] += latency
+                    if latency > self.stats["lat_max"]:
+                        self.stats["lat_max"] = latency
+                self.logging.info("%s message sent to %d recipient(s) in %.2f s (attempt %d)",
+                                  job.subject, len(job.addrs), latency, job.attempts)
+
+            elif job.attempts <= self.retries and not self.stopping:
+                delay = self.backoff * (2 ** (job.attempts - 1))
+                MAIL.inc("retried")
+                self.logging.warning("%s message failed, retrying in %.1f s", job.subject, delay)
+                with self.cond:
+                    self.stats["retried"] += 1
+                    self.seq += 1
+                    heapq.heappush(self.retry, (time.monotonic() + delay, self.seq, job))
+                    self.cond.notify()
+
+            elif job.spooled is not None:
+                # it stays in the spool for flush()
+                MAIL.inc("spooled")
+                with self.cond:
+                    self.stats["spooled"] += 1
+                    self.held.discard(job.spooled)
+                self.logging.error("%s message failed after %d attempt(s), kept in the spool: %s",
+                                   job.subject, job.attempts, job.message)
+
+            else:
+                MAIL.inc("failed")
+                with self.cond:
+                    self.stats["failed"] += 1
+                self.logging.error("%s message failed after %d attempt(s): %s",
+                                   job.subject, job.attempts, job.message)
+
+    def deliver(self, job):
+        """ send one message to all of its recipients with a single mail command """
+
+        import subprocess   # (not until there's mail to send; it's slow to import)
+        try:
+            result = subprocess.run(["mail", "-s" + job.subject] + job.addrs,
+                                    input = job.message.encode("utf-8"),
+                                    stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                                    timeout = self.timeout)
+        except (OSError, subprocess.SubprocessError) as err:
+            self.logging.error("mail attempt failed: %s", err)
+            return False
+
+        if result.returncode != 0:
+            self.logging.error("mail attempt failed, rc = %d; err = %s", result.returncode, result.stderr)
+            return False
+
+        self.logging.debug("output from mail attempt, output = %s; err = %s", result.stdout, result.stderr)
+        return True
@@ -0,0 +1,145 @@
+#
+# MonitoringEdges.py
+#
+# Clean up the edges from the inputs on the Pi's pins (motion detector,
+# key switch, ...) for the Monitoring_zimKnives project.
+#
+#    This file is part of the "Monitoring zimKnives" project, which is a collection
+#    of files, including this one.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of these words as published by the author.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  Use at your own risk.
+#
+# The RPi.GPIO callback (edge()) only reads the level and queues
+# (pin, level, time.monotonic()); it runs on RPi.GPIO's thread and a noisy
+# input can call it a lot.  The main loop takes the queued edges (drain())
+# and filters them per pin:
+#
+#   glitch   : a new level has to last this long to count (shorter pulses
+#              are dropped)
+#   debounce : after a transition, the next one isn't taken for this long
+#              (the level at the end of it is, if it's different)
+#
+# An edge that doesn't change the level (RPi.GPIO sometimes reports both
+# edges, or the same one twice) is dropped too.  Everything dropped is
+# counted per parameter.
+#
+
+import collections
+import time
+from MonitoringMetrics import registry
+
+# what's counted here (see MonitoringMetrics.py)
+EDGES = registry.counter("zk_gpio_edges_total", "input edges by what the filter did with them", ["parm", "result"])
+
+
+class PinFilter:
+    """ the filter state of one input """
+
+    def __init__(self, parm, level, glitch, debounce):
+        self.parm = parm
+        self.glitch = glitch       # seconds a new level has to last
+        self.debounce = debounce   # seconds after a transition before the next one
+        self.level = level         # the filtered level (what the parameter was told)
+        self.raw = level           # the level of the last edge
+        self.since = 0.0           # when raw changed (time.monotonic())
+        self.hold = 0.0            # no transition before this (time.monotonic())
+        self.pending = 0           # edges since the last transition
+        self.accepted = 0
+        self.rejected = 0
+
+    def due(self):
+        """ when the raw level can become the filtered level """
+
+        return max(self.since + self.glitch, self.hold)
+
+
+class EdgeFilter:
+    """ queue the edges from the RPi.GPIO callbacks and turn them into clean
+        transitions, on the main loop """
+
+    def __init__(self, logging, read, notify = None):
+        self.logging = logging
+        self.read = read           # e.g. GPIO.input
+        self.notify = notify       # wake up the main loop (from the callback thread)
+        self.edges = collections.deque()
+        self.pins = {}             # pin -> PinFilter
+
+    def watch(self, parm, glitch = 0.0, debounce = 0.0):
+        """ filter the edges of the parameter's pin; returns its current level """
+
+        level = bool(self.read(parm.io_pin))
+        self.pins[parm.io_pin] = PinFilter(parm, level, glitch, debounce)
+        return level
+
+    def edge(self, channel):
+        """ the RPi.GPIO callback: queue the edge, nothing else """
+
+        self.edges.append((channel, self.read(channel), time.monotonic()))
+        if self.notify is not None:
+            self.notify()
+
+    def accept(self, f, when, transitions):
+        f.level = f.raw
+        f.hold = when + f.debounce
+        f.accepted += 1
+        if f.pending > 1:
+            f.rejected += f.pending - 1
+            EDGES.inc(f.parm.label, "rejected", amount = f.pending - 1)
+        f.pending = 0
+        EDGES.inc(f.parm.label, "accepted")
+        transitions.append((f.parm, f.level))
+
+    def drain(self, now = None):
+        """ (main loop) filter the queued edges; returns the transitions
+            [(parm, level), ...] and the seconds until a level that's
+            waiting out its glitch/debounce time is due (None if there
+            isn't one) """
+
+        if now is None:
+            now = time.monotonic()
+        transitions = []
+        edges = self.edges
+        while edges:
+            pin, level, when = edges.popleft()
+            f = self.pins.get(pin)
+            if f is None:
+                continue
+            level = bool(level)
+
+            # a level that lasted long enough before this edge came
+            if f.raw != f.level and when >= f.due():
+                self.accept(f, f.due(), transitions)
+
+            if level == f.raw:
+                f.rejected += 1
+                EDGES.inc(f.parm.label, "rejected")
+                continue
+            f.raw = level
+            f.since = when
+            f.pending += 1
+
+            # back where it was before it lasted: a glitch (or bounce)
+            if f.raw == f.level:
+                f.rejected += f.pending
+                EDGES.inc(f.parm.label, "rejected", amount = f.pending)
+                f.pending = 0
+
+        wait = None
+        for f in self.pins.values():
+            if f.raw != f.level:
+                due = f.due()
+                if now >= due:
+                    self.accept(f, now, transitions)
+                elif wait is None or due - now < wait:
+                    wait = due - now
+        return transitions, wait
+
+    def counts(self):
+        """ {label: (accepted, rejected)} """
+
+        return dict([(f.parm.label, (f.accepted, f.rejected)) for f in self.pins.values()])
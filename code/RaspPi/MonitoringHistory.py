@@ -0,0 +1,285 @@
+#
+# MonitoringHistory.py
+#
+# Keep the history of the parameter values on disk for the
+# Monitoring_zimKnives project, so that it survives a restart.
+#
+#    This file is part of the "Monitoring zimKnives" project, which is a collection
+#    of files, including this one.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of these words as published by the author.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  Use at your own risk.
+#
+# Layout of the history directory:
+#
+#   labels            - one name per line (Env uses the parameter's topic);
+#                       the line number is the id stored in the records
+#   <start>.seg       - fixed size binary records (RECORD below), appended in
+#                       the order they come.  A new segment is started every
+#                       "segment" seconds; <start> is the (epoch) time it
+#                       begins, and each record is in the segment of its own
+#                       timestamp.
+#   <start>.idx       - sparse index for the segment: (timestamp, file offset)
+#                       of every "index_every"th record.  the timestamp is the
+#                       latest one in the segment up to and including that
+#                       record, so it never goes down.
+#
+# The timestamps are wall clock time, which can step (a pi has no RTC: the
+# clock is set by NTP some time after boot), so the records in a segment
+# aren't necessarily in time order.  The index only skips records that are
+# all older than asked for, and a read goes through to the end of the segment.
+#
+# Writes are collected in memory and written out a page or so at a time, and
+# fsync'ed at most every "flush" seconds, to go easy on the SD card.  Up to
+# "flush" seconds of samples can be lost if the power goes out.
+#
+# Reads mmap the segment files and use the index to skip to the first
+# record of interest, so nothing is parsed except the records asked for.
+#
+
+import os
+import mmap
+import struct
+import threading
+import time
+from bisect import bisect_left
+
+RECORD = struct.Struct("<dHd")  # timestamp, label id, value
+INDEX = struct.Struct("<dQ")    # timestamp, byte offset into the segment
+WRITE_SIZE = 4096               # write to the file when this much is buffered
+
+
+class HistoryStore:
+    """ append-only, segmented history of (time, label, value) records """
+
+    def __init__(self, logging, directory, segment = 86400, flush = 60.0, index_every = 256, keep = 30):
+        self.logging = logging
+        self.directory = directory
+        self.segment = int(segment)   # seconds per segment file
+        self.flush_interval = flush   # max seconds between fsync's
+        self.index_every = index_every
+        self.keep = keep              # number of segments to keep (0 for all)
+
+        self.lock = threading.Lock()
+        self.buf = bytearray()        # records not yet written
+        self.ibuf = bytearray()       # index entries not yet written
+        self.seg_start = None         # start time of the current segment
+        self.seg_records = 0          # records in the current segment (incl. buffered)
+        self.seg_offset = 0           # bytes of the current segment on disk
+        self.seg_latest = None        # latest timestamp in the current segment
+        self.last_sync = time.monotonic()
+        self.dirty = False            # written but not fsync'ed
+
+        os.makedirs(directory, exist_ok = True)
+
+        # label <-> id mapping
+        self.ids = {}
+        self.labels = []
+        path = os.path.join(directory, "labels")
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    self.ids[line.strip()] = len(self.labels)
+                    self.labels.append(line.strip())
+
+    def seg_path(self, start, ext):
+        return os.path.join(self.directory, "%010d.%s" % (start, ext))
+
+    def segments(self):
+        """ sorted list of the segment start times on disk """
+
+        starts = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".seg"):
+                starts.append(int(name[:-4]))
+        starts.sort()
+        return starts
+
+    def label_id(self, label):
+        """ id of the label, adding (and saving) it if new; call with the lock held """
+
+        lid = self.ids.get(label)
+        if lid is None:
+            lid = len(self.labels)
+            with open(os.path.join(self.directory, "labels"), "a") as f:
+                f.write(label + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.ids[label] = lid
+            self.labels.append(label)
+        return lid
+
+    ### writing
+
+    def append(self, label, when, value):
+        """ add a record (any thread) """
+
+        with self.lock:
+            start = int(when) - int(when) % self.segment
+            if start != self.seg_start:
+                self.rotate(start)
+
+            if self.seg_latest is None or when > self.seg_latest:
+                self.seg_latest = when
+            if self.seg_records % self.index_every == 0:
+                offset = self.seg_offset + len(self.buf)
+                self.ibuf += INDEX.pack(self.seg_latest, offset)
+            self.buf += RECORD.pack(when, self.label_id(label), value)
+            self.seg_records += 1
+
+            if len(self.buf) >= WRITE_SIZE:
+                self.write()
+
+    def rotate(self, start):
+        """ finish the current segment and start a new one; lock held """
+
+        if self.seg_start is not None:
+            self.write()
+            self.sync()
+
+        self.seg_start = start
+        path = self.seg_path(start, "seg")
+        self.seg_offset = os.path.getsize(path) if os.path.isfile(path) else 0
+        self.seg_records = self.seg_offset // RECORD.size
+        # a partly written record (power loss) would throw off everything after it
+        if self.seg_offset % RECORD.size != 0:
+            self.logging.error("History segment %s has a partial record ... truncating", path)
+            self.seg_offset = self.seg_records * RECORD.size
+            os.truncate(path, self.seg_offset)
+        self.seg_latest = self.latest(start) if self.seg_offset else None
+
+        if self.keep > 0:
+            for old in self.segments()[:-self.keep]:
+                os.remove(self.seg_path(old, "seg"))
+                if os.path.isfile(self.seg_path(old, "idx")):
+                    os.remove(self.seg_path(old, "idx"))
+
+    def latest(self, start):
+        """ latest timestamp in a segment on disk (from its last index entry
+            and the records after it); lock held """
+
+        latest = None
+        offset = 0
+        ipath = self.seg_path(start, "idx")
+        if os.path.isfile(ipath):
+            with open(ipath, "rb") as f:
+                ibytes = f.read()
+            ibytes = ibytes[:len(ibytes) - len(ibytes) % INDEX.size]
+            if ibytes:
+                latest, offset = INDEX.unpack(ibytes[-INDEX.size:])
+        with open(self.seg_path(start, "seg"), "rb") as f:
+            f.seek(offset)
+            tail = f.read()
+        for when, lid, value in RECORD.iter_unpack(tail[:len(tail) - len(tail) % RECORD.size]):
+            if latest is None or when > latest:
+                latest = when
+        return latest
+
+    def write(self):
+        """ write out the buffered records and index entries; lock held """
+
+        if self.buf:
+            with open(self.seg_path(self.seg_start, "seg"), "ab") as f:
+                f.write(self.buf)
+            self.seg_offset += len(self.buf)
+            self.buf = bytearray()
+            self.dirty = True
+        if self.ibuf:
+            with open(self.seg_path(self.seg_start, "idx"), "ab") as f:
+                f.write(self.ibuf)
+            self.ibuf = bytearray()
+
+    def sync(self):
+        """ fsync what has been written to the current segment; lock held """
+
+        if self.dirty:
+            for ext in ("seg", "idx"):
+                path = self.seg_path(self.seg_start, ext)
+                if os.path.isfile(path):
+                    fd = os.open(path, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+            self.dirty = False
+        self.last_sync = time.monotonic()
+
+    def tick(self):
+        """ called periodically: write and fsync if it's been long enough """
+
+        if time.monotonic() - self.last_sync >= self.flush_interval:
+            with self.lock:
+                if self.seg_start is not None:
+                    self.write()
+                    self.sync()
+
+    def close(self):
+        """ write and fsync everything """
+
+        with self.lock:
+            if self.seg_start is not None:
+                self.write()
+                self.sync()
+
+    ### reading
+
+    def scan(self, t0, t1, label = None):
+        """ yield (time, label, value) for records with t0 <= time <= t1,
+            optionally only those for one label (in the order they were
+            added, segment by segment) """
+
+        # make sure the buffered records can be seen
+        with self.lock:
+            if self.seg_start is not None:
+                self.write()
+            want = None
+            if label is not None:
+                want = self.ids.get(label)
+                if want is None:
+                    return
+            labels = list(self.labels)
+
+        for start in self.segments():
+            if start + self.segment <= t0 or start > t1:
+                continue
+
+            # find where to start from the sparse index (everything before
+            # the entry is no later than its timestamp)
+            offset = 0
+            ipath = self.seg_path(start, "idx")
+            if os.path.isfile(ipath):
+                with open(ipath, "rb") as f:
+                    ibytes = f.read()
+                ibytes = ibytes[:len(ibytes) - len(ibytes) % INDEX.size]
+                entries = list(INDEX.iter_unpack(ibytes))
+                i = bisect_left([e[0] for e in entries], t0) - 1
+                if i >= 0:
+                    offset = entries[i][1]
+
+            path = self.seg_path(start, "seg")
+            size = os.path.getsize(path)
+            size -= size % RECORD.size
+            if size <= offset:
+                continue
+            with open(path, "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+                    chunk = memoryview(mm)[offset:size]
+                    records = RECORD.iter_unpack(chunk)
+                    try:
+                        for when, lid, value in records:
+                            # (not in time order if the clock stepped: look at them all)
+                            if t0 <= when <= t1 and (want is None or lid == want):
+                                yield (when, labels[lid], value)
+                    finally:
+                        # the mmap can't be closed while these still point into it
+                        del records
+                        chunk.release()
+
+    def query(self, label, t0, t1):
+        """ list of (time, value) for the label between t0 and t1 """
+
+        return [(when, value) for when, lbl, value in self.scan(t0, t1, label)]
@@ -0,0 +1,112 @@
+#
+# MonitoringLimits.py
+#
+# Check parameter values against the "LIMIT_CHECKS" from the configuration
+# file for the Monitoring_zimKnives project.
+#
+#    This file is part of the "Monitoring zimKnives" project, which is a collection
+#    of files, including this one.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of these words as published by the author.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  Use at your own risk.
+#
+# The checks are "compiled" once, at start up, into a table per parameter:
+# the "high" limits sorted ascending and the "low" limits sorted descending
+# (stored negated, so both can be bisected the same way).  A value then
+# exceeds the first k high limits, where k comes from one bisect, and the
+# same for the lows.
+#
+# A table is only looked at again when its parameter's value is different
+# from the last time it was checked.
+#
+
+from bisect import bisect_right
+
+
+class LimitRule:
+    """ one entry from "LIMIT_CHECKS" """
+
+    def __init__(self, order, key, parm, limit, sense, message):
+        self.order = order     # position in the config, used to keep the message order
+        self.key = key         # the config line number
+        self.parm = parm
+        self.limit = limit
+        self.sense = sense
+        self.message = message
+
+
+class LimitTable:
+    """ the rules for a single parameter, sorted for bisecting """
+
+    def __init__(self, parm, rules):
+        self.parm = parm
+        self.highs = sorted([r for r in rules if r.sense == "high"], key = lambda r: r.limit)
+        self.lows = sorted([r for r in rules if r.sense == "low"], key = lambda r: -r.limit)
+        self.high_limits = [r.limit for r in self.highs]  # ascending
+        self.low_limits = [-r.limit for r in self.lows]   # descending limits, negated
+        self.checked = False
+        self.last = None     # value when last checked
+        self.active = []     # rules exceeded by that value
+
+
+class LimitEngine:
+    """ evaluate the limit checks incrementally """
+
+    def __init__(self, logging, checks, env):
+        self.logging = logging
+        self.tables = []
+        self.message = None  # combined message for the active rules (None if none)
+
+        rules = {}
+        for order, key in enumerate(checks):
+            check = checks[key]
+            parm = env.get_parameter_by_label(check["parm"])
+            if parm is None:
+                logging.info("Spurious label in LIMIT_CHECKS... ignored;  label = %s", check["parm"])
+                continue
+            if check["sense"] not in ("high", "low"):
+                logging.info("Bad sense in LIMIT_CHECKS ... ignored; sense = %s", check["sense"])
+                continue
+            rule = LimitRule(order, key, parm, check["limit"], check["sense"], check["message"])
+            rules.setdefault(id(parm), (parm, []))[1].append(rule)
+
+        for parm, parm_rules in rules.values():
+            self.tables.append(LimitTable(parm, parm_rules))
+
+    def evaluate(self):
+        """ re-check the parameters that changed; returns the message to send
+            ("LIMIT" followed by a line per exceeded limit) or None """
+
+        changed = False
+        for table in self.tables:
+            value = table.parm.value
+            if table.checked and value == table.last:
+                continue
+            table.checked = True
+            table.last = value
+
+            active = table.highs[:bisect_right(table.high_limits, value)] + \
+                     table.lows[:bisect_right(table.low_limits, -value)]
+            if active != table.active:
+                for rule in active:
+                    if rule not in table.active:
+                        self.logging.info("Limit message: %s (parm:%s limit:%s value: %s %s)",
+                                          rule.message, table.parm.label, rule.limit, value, table.parm.units)
+                table.active = active
+                changed = True
+
+        if changed:
+            active = []
+            for table in self.tables:
+                active.extend(table.active)
+            if active:
+                active.sort(key = lambda r: r.order)
+                self.message = "LIMIT\n" + "\n".join([r.message for r in active])
+            else:
+                self.message = None
+
+        return self.message
@@ -0,0 +1,131 @@
+#
+# MonitoringLogging.py
+#
+# Logging for the Monitoring_zimKnives project that doesn't make the mqtt
+# callbacks or the main loop wait for the SD card.
+#
+#    This file is part of the "Monitoring zimKnives" project, which is a collection
+#    of files, including this one.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of these words as published by the author.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  Use at your own risk.
+#
+# setup_logging() replaces logging.basicConfig(): the root logger gets a
+# handler that only puts the record on a queue, and a listener thread
+# formats and writes the records to a rotating log file (or a stream).
+#
+# The listener also collapses repeats: the same message (at the same level)
+# again within "window" seconds isn't written, and when it next is, a line
+# says how many were left out.
+#
+
+import logging
+import logging.handlers
+import queue
+import time
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """ put the record on the queue as is; the listener does the formatting """
+
+    def prepare(self, record):
+        return record
+
+
+class CollapsingHandler(logging.Handler):
+    """ pass records to another handler, leaving out repeats within a window """
+
+    def __init__(self, target, window = 60.0):
+        super().__init__()
+        self.target = target
+        self.window = window
+        self.recent = {}          # (level, message) -> [time first written, times left out]
+        self.purged = time.time()
+
+    def summary(self, key, entry, now):
+        level, message = key
+        record = logging.LogRecord("root", level, "", 0, "(repeated %d more times in %.0f s) %s",
+                                   (entry[1], now - entry[0], message), None)
+        record.created = now
+        self.target.handle(record)
+
+    def emit(self, record):
+        now = record.created
+        try:
+            key = (record.levelno, record.getMessage())
+        except Exception:
+            self.target.handle(record)
+            return
+
+        entry = self.recent.get(key)
+        if entry is not None and now - entry[0] < self.window:
+            entry[1] += 1
+            return
+        if entry is not None and entry[1] > 0:
+            self.summary(key, entry, now)
+        self.recent[key] = [now, 0]
+        self.target.handle(record)
+
+        # forget the old ones now and then (saying how many were left out)
+        if now - self.purged >= self.window:
+            self.purged = now
+            for old in [k for k, e in self.recent.items() if now - e[0] >= self.window]:
+                entry = self.recent.pop(old)
+                if entry[1] > 0:
+                    self.summary(old, entry, now)
+
+    def flush(self):
+        self.target.flush()
+
+    def close(self):
+        now = time.time()
+        for key, entry in self.recent.items():
+            if entry[1] > 0:
+                self.summary(key, entry, now)
+        self.recent.clear()
+        self.target.close()
+        super().close()
+
+
+class LogListener(logging.handlers.QueueListener):
+    """ the listener thread; stop() also closes the handler (writing what's left) """
+
+    def stop(self):
+        super().stop()
+        for handler in self.handlers:
+            handler.close()
+
+
+def setup_logging(filename = None, level = logging.INFO, format = None, stream = None,
+                  max_bytes = 0, backups = 5, window = 60.0):
+    """ send the root logger's records through a queue to a listener thread
+        writing filename (rotated at max_bytes, if not 0) or stream;
+        returns the listener (stop() it at the end to write what's left) """
+
+    if filename:
+        if max_bytes > 0:
+            target = logging.handlers.RotatingFileHandler(filename, maxBytes = max_bytes, backupCount = backups)
+        else:
+            target = logging.FileHandler(filename)
+    else:
+        target = logging.StreamHandler(stream)
+    target.setFormatter(logging.Formatter(format))
+
+    handler = target
+    if window > 0.0:
+        handler = CollapsingHandler(target, window)
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(LazyQueueHandler(records))
+    root.setLevel(level)
+
+    listener = LogListener(records, handler)
+    listener.start()
+    return listener
@@ -0,0 +1,222 @@
+#
+# MonitoringMetrics.py
+#
+# Counters and latency histograms for the Monitoring_zimKnives project,
+# served over http in the Prometheus text format and (optionally) published
+# to mqtt as json for Node-RED.
+#
+#    This file is part of the "Monitoring zimKnives" project, which is a collection
+#    of files, including this one.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of these words as published by the author.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  Use at your own risk.
+#
+# Like logging, there is one registry for the process ("registry" below) and
+# each module creates its metrics when it's imported, e.g.
+#
+#   DECODE = registry.histogram("zk_decode_seconds", "time to decode a payload")
+#   ...
+#   DECODE.observe(seconds)
+#
+# The histograms have fixed buckets, so recording is a bisect and a few
+# additions; nothing is allocated per sample.
+#
+
+import bisect
+import json
+import threading
+
+# upper bounds (seconds) of the latency buckets: 50 us to 10 s
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+           0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def label_text(names, values):
+    """ {a="x",b="y"} for the Prometheus text format """
+
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append('%s="%s"' % (name, value))
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """ a count (per set of label values) that only goes up """
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self, lines):
+        with self.lock:
+            items = sorted(self.values.items())
+        for labels, value in items:
+            lines.append("%s%s %s" % (self.name, label_text(self.labels, labels), repr(float(value))))
+
+    def snapshot(self):
+        with self.lock:
+            return dict([(",".join(labels), value) for labels, value in self.values.items()])
+
+
+class Histogram:
+    """ how many observations (usually seconds) fell in each of the fixed buckets """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels = (), buckets = BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}   # labels -> [counts per bucket (+ one for +Inf), sum, max]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+            if value > entry[2]:
+                entry[2] = value
+
+    def render(self, lines):
+        with self.lock:
+            items = sorted([(labels, (list(e[0]), e[1])) for labels, e in self.values.items()])
+        names = self.labels + ("le",)
+        for labels, (counts, total) in items:
+            running = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                running += count
+                lines.append("%s_bucket%s %d" % (self.name, label_text(names, labels + (bound,)), running))
+            lines.append("%s_sum%s %r" % (self.name, label_text(self.labels, labels), total))
+            lines.append("%s_count%s %d" % (self.name, label_text(self.labels, labels), running))
+
+    def snapshot(self):
+        with self.lock:
+            snap = {}
+            for labels, (counts, total, most) in self.values.items():
+                count = sum(counts)
+                snap[",".join(labels)] = {"count": count, "sum": total, "max": most,
+                                          "avg": total / count if count else 0.0}
+            return snap
+
+
+class Registry:
+    """ all of the metrics of the process """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def add(self, metric):
+        with self.lock:
+            # importing a module twice (e.g. as __main__) mustn't make two of them
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels = ()):
+        return self.add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels = (), buckets = BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """ the Prometheus text exposition format """
+
+        lines = []
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key = lambda m: m.name)
+        for metric in metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            metric.render(lines)
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """ everything as a dict (for json) """
+
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return dict([(metric.name, metric.snapshot()) for metric in metrics])
+
+
+registry = Registry()
+
+
+def metrics_handler():
+    """ the http handler class for GET /metrics (http.server is only imported
+        when the endpoint is started) """
+
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """ GET /metrics """
+
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # not in the log file every time it's scraped
+
+    return MetricsHandler
+
+
+class MetricsServer:
+    """ serve the registry over http from a thread """
+
+    def __init__(self, logging, port, addr = "127.0.0.1"):
+        self.logging = logging
+        self.port = port
+        self.addr = addr
+        self.server = None
+
+    def start(self):
+        from http.server import HTTPServer
+        try:
+            self.server = HTTPServer((self.addr, self.port), metrics_handler())
+        except OSError as err:
+            self.logging.error("Metrics http server not started on %s:%d: %s", self.addr, self.port, err)
+            return False
+        thread = threading.Thread(target = self.server.serve_forever, name = "metrics-http")
+        thread.daemon = True
+        thread.start()
+        self.logging.info("Metrics on http://%s:%d/metrics", self.addr, self.server.server_address[1])
+        return True
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def publish(mqtt_client, topic):
+    """ publish the registry as json (e.g. on a timer) """
+
+    mqtt_client.publish(topic, json.dumps(registry.snapshot(), sort_keys = True))
@@ -34,8 +34,66 @@
 # Env() sets up.
 #
 
-import RPi.GPIO as GPIO
+import time
+import collections
+import importlib
 from Monitoring_conf import conf
+from MonitoringSeries import Series
+from MonitoringMetrics import registry
+from MonitoringEdges import EdgeFilter
+
+# use a faster json decoder if one is installed (all of these take bytes)
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        from json import loads as json_loads
+
+
+def to_bool(raw):
+    """ convert "True"/"False" (or a json true/false) ... be careful using bool() on strings ! """
+
+    if raw is True or raw == "True":
+        return True
+    if raw is False or raw == "False":
+        return False
+    raise ValueError("strange value on bool: " + repr(raw))
+
+
+def identity(raw):
+    return raw
+
+
+class LazyGPIO:
+    """ RPi.GPIO, imported the first time a function of it is used, so that
+        the parameters (and the sites without pins) don't need the Pi's
+        hardware.  the constants used here are RPi.GPIO's own values. """
+
+    IN = 1
+    OUT = 0
+    BCM = 11
+    BOTH = 33
+
+    def __init__(self, name = "RPi.GPIO"):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+
+GPIO = LazyGPIO()
+
+
+# how to convert an incoming value, by the type of the parameter
+CONVERTERS = {float: float, int: int, bool: to_bool, str: identity}
+
+# posted to Env.inbox by mark_stale() in place of an update
+STALE = ("stale",)
 
 class Parm:
     """ class to hold a parameter and it's meta data """
@@ -48,7 +106,13 @@ class Parm:
     LOCAL = 1
     REMOTE = 2
 
-    def __init__(self, label, value, pvalue, units, when, direction, topic, event = False, jflag = False, physical=lambda x: None, io_pin = -1, io_dir = GPIO.IN):
+    # no per-instance __dict__: a site has a lot of these and a Pi Zero
+    # doesn't have a lot of memory
+    __slots__ = ("label", "value", "pvalue", "units", "when", "direction", "topic", "event", "jflag",
+                 "physical", "io_pin", "io_dir", "deadband", "pub_value", "pub_time", "series",
+                 "convert", "store")
+
+    def __init__(self, label, value, pvalue, units, when, direction, topic, event = False, jflag = False, physical = None, io_pin = -1, io_dir = GPIO.IN, deadband = 0.0):
         self.label = label # human readable label
         self.value = value # actual value of the parameter
         self.pvalue = pvalue # previous value; used for s/w edge detection
@@ -58,10 +122,149 @@ class Parm:
         self.topic = topic # mqtt topic
         self.event = event # was an asynchronous event received
         self.jflag = jflag # decode incoming as json or not
-        self.physical = physical # function used to acquire/set locally hosted parameters
+        self.physical = physical # function used to acquire/set locally hosted parameters (or None)
                                # Note: some parameters are aquired by asynchronous callbacks
         self.io_pin = io_pin # in the case of physical i/o
         self.io_dir = io_dir # for physical i/o is the pin in or out
+        self.deadband = deadband # numeric change smaller than this isn't published
+        self.pub_value = None # value last published (None: never published)
+        self.pub_time = 0.0   # when it was last published (time.monotonic())
+        self.series = None    # recent history (numeric parameters only, see Env)
+        self.convert = CONVERTERS.get(type(value), identity) # incoming (mqtt) value -> value
+        self.store = None     # on-disk history (see Env.attach_store())
+
+    def set(self, value, now = None):
+        """ update the value, keeping the previous one and recording the history """
+
+        self.pvalue = self.value
+        self.value = value
+        if self.series is not None:
+            if now is None:
+                now = time.time()
+            self.series.append(now, value)
+            if self.store is not None:
+                self.store.append(self.topic, now, value)
+
+    def changed(self):
+        """ has the value moved (beyond the deadband) since it was last published """
+
+        if self.pub_value is None:
+            return True
+        if self.deadband > 0.0 and type(self.value) in (float, int):
+            return abs(self.value - self.pub_value) > self.deadband
+        return self.value != self.pub_value
+
+
+class TopicTrie:
+    """ route mqtt topics to parameters, including wildcard ('+', '#') patterns
+
+        each level of a topic is a node in the tree, so a lookup costs
+        the depth of the topic rather than the number of parameters
+    """
+
+    def __init__(self):
+        self.root = {}
+
+    def insert(self, pattern, parm):
+        """ add a parameter at the node for the (possibly wildcarded) pattern """
+
+        node = self.root
+        for level in pattern.split("/"):
+            node = node.setdefault(level, {})
+        node.setdefault(None, []).append(parm)  # None key holds the parameters
+
+    def match(self, topic):
+        """ return the list of parameters whose patterns match the topic """
+
+        found = []
+        levels = topic.split("/")
+        depth = len(levels)
+        nodes = [(self.root, 0)]
+        while nodes:
+            node, i = nodes.pop()
+            # '#' matches this level and everything below it (including nothing)
+            # ... but, per mqtt, wildcards don't match the "$" system topics
+            if "#" in node and not (i == 0 and topic.startswith("$")):
+                found.extend(node["#"].get(None, []))
+            if i == depth:
+                found.extend(node.get(None, []))
+                continue
+            child = node.get(levels[i])
+            if child is not None:
+                nodes.append((child, i + 1))
+            if "+" in node and not (i == 0 and topic.startswith("$")):
+                nodes.append((node["+"], i + 1))
+
+        return found
+
+
+# what's counted/timed here (see MonitoringMetrics.py)
+MESSAGES = registry.counter("zk_messages_total", "mqtt messages received", ["topic"])
+DECODE = registry.histogram("zk_decode_seconds", "time to decode and apply an mqtt message")
+PUBLISHED = registry.counter("zk_published_total", "values published", ["site"])
+GPIO_CALLS = registry.counter("zk_gpio_calls_total", "calls to RPi.GPIO", ["call"])
+
+
+def site_list():
+    """ the sites (locations) from the configuration file, or just the one
+        from "LOCATION" if "SITES" isn't there """
+
+    if conf.get("SITES"):
+        return conf["SITES"]
+    return [{"NAME": "zkshop", "LOCATION": conf["LOCATION"], "PREFIX": "zk-env", "PINS": True,
+             "BATCH_TOPIC": conf.get("BATCH_TOPIC", "zk-env/batch")}]
+
+
+class EnvRouter:
+    """ find the site (Env) that an mqtt topic belongs to, by its prefix """
+
+    def __init__(self, logging):
+        self.logging = logging
+        self.trie = TopicTrie()
+        self.cache = {}
+        self.envs = []
+
+    def add(self, env):
+        self.trie.insert(env.prefix + "/#", env)
+        self.cache.clear()
+        self.envs.append(env)
+
+    def route(self, topic):
+        """ the Env for the topic, or None """
+
+        env = self.cache.get(topic)
+        if env is None:
+            matches = self.trie.match(topic)
+            if not matches:
+                return None
+            env = matches[0]
+            if len(self.cache) >= Env.ROUTE_CACHE_MAX:
+                self.cache.clear()
+            self.cache[topic] = env
+        return env
+
+    def deliver(self, topic, payload):
+        """ decode an mqtt message into its site and wake up the main loop
+            returns True if it was used """
+
+        env = self.route(topic)
+        if env is None:
+            MESSAGES.inc("(spurious)")
+            self.logging.info("Spurious topic data received ... ignored;  Topic = %s", topic)
+            return False
+        MESSAGES.inc(topic)
+
+        start = time.perf_counter()
+        if topic == env.batch_topic:
+            applied = env.ingest_batch(payload)
+        else:
+            applied = env.ingest(topic, payload)
+        DECODE.observe(time.perf_counter() - start)
+
+        # wake up the main loop to act on it
+        if applied:
+            env.notify()
+        return bool(applied)
 
 
 class Env:
@@ -69,10 +272,50 @@ class Env:
     
     # flag so that we only subscribe once
     subscribed = False
+
+    # limit on the number of wildcard-resolved topics remembered
+    ROUTE_CACHE_MAX = 1024
     
-    def __init__(self, logging, mqtt_client):
+    def __init__(self, logging, mqtt_client, events = None, site = None):
         self.logging = logging
         self.mqtt_client = mqtt_client
+        self.events = events # queue to wake up the main loop on changes (or None)
+
+        # which site (location) this is; see site_list()
+        if site is None:
+            site = site_list()[0]
+        self.site = site
+        self.name = site["NAME"]
+        self.location = site.get("LOCATION", conf["LOCATION"])
+        self.prefix = site.get("PREFIX", "zk-env")
+        self.has_pins = site.get("PINS", False)
+
+        # the callbacks (mqtt, gpio) don't touch the parameters: they post
+        # updates here and the main loop applies them at the start of a pass
+        # (apply_updates()), so it always works on a consistent set of values.
+        # an update is a tuple of (parm, value, tstamp or None, time.time())
+        # tuples, applied all together (or STALE, see mark_stale()); appending
+        # to a deque needs no lock.
+        self.inbox = collections.deque()
+        self.version = 0    # the number of updates applied so far
+        self.deferred = 0   # updates held back for another pass (see apply_updates())
+
+        # the edges of the input pins, filtered on the main loop (see physical_init())
+        self.edges = None
+        self.timers = None
+        self.edge_timer = None
+
+        # the level last written to each output pin, and the calls to RPi.GPIO
+        self.driven = {}
+        self.gpio_calls = 0
+
+        # topic for packets holding many samples at once (see ingest_batch())
+        self.batch_topic = site.get("BATCH_TOPIC", self.prefix + "/batch")
+        self.batch_prefix = self.batch_topic.rpartition("/")[0] + "/"
+
+        # publish statistics from data_sync()
+        self.pub_count = 0
+        self.pub_suppressed = 0
 
         #
         # >>> ADD NEW PARAMETERS HERE ... ADD HANDLERS DOWN BELOW
@@ -99,36 +342,69 @@ class Env:
         # Note that since these keys have some location info, the "location" that
         # is sent with the json packet is a bit redundant.
         #
+        # the topics all start with the site's prefix (p below, e.g. "zk-env/")
+        # and only the site with "PINS" has the locally connected hardware
+        #
+        p = self.prefix + "/"
+        wr = self.write_pin if self.has_pins else None
+        #
         #                    label       value  pvalue  units     when      direction  topic             event   jflag   physical       pin
         #                                                                                               (false) (false)   (None)        (-1)
         #                    -----       -----  ------  -----     ----      ---------  -----             -----  -----    --------       ---
         # temp, humidity, combustable gasses from the remote environmental sensor
-        self.temp     = Parm("temp",     0.0,   0.0,   "deg C", "00:00:00", Parm.SUB, "zk-env/temp",     False,  True)
-        self.humidity = Parm("humidity", 0.0,   0.0,   "\%",    "00:00:00", Parm.SUB, "zk-env/humidity", False,  True)
-        self.gasrw    = Parm("gasraw",   0.0,   0.0,   "bits",  "00:00:00", Parm.SUB, "zk-env/gasrw",    False,  True)
-        self.gasco    = Parm("gasco",    0.0,   0.0,   "PPM",   "00:00:00", Parm.SUB, "zk-env/gasco",    False,  True)
-        self.gaspr    = Parm("gaspr",    0.0,   0.0,   "PPM",   "00:00:00", Parm.SUB, "zk-env/gaspr",    False,  True)
-        self.tstamp   = Parm("tstamp",   "nul", "nul", "time",  "00:00:00", Parm.SUB, "zk-env/time",     False,  True)
+        self.temp     = Parm("temp",     0.0,   0.0,   "deg C", "00:00:00", Parm.SUB, p+"temp",          False,  True)
+        self.humidity = Parm("humidity", 0.0,   0.0,   "\%",    "00:00:00", Parm.SUB, p+"humidity",      False,  True)
+        self.gasrw    = Parm("gasraw",   0.0,   0.0,   "bits",  "00:00:00", Parm.SUB, p+"gasrw",         False,  True)
+        self.gasco    = Parm("gasco",    0.0,   0.0,   "PPM",   "00:00:00", Parm.SUB, p+"gasco",         False,  True)
+        self.gaspr    = Parm("gaspr",    0.0,   0.0,   "PPM",   "00:00:00", Parm.SUB, p+"gaspr",         False,  True)
+        self.tstamp   = Parm("tstamp",   "nul", "nul", "time",  "00:00:00", Parm.SUB, p+"time",          False,  True)
         # light and auto switch override command parameters
-        self.o_light  = Parm("o_light",  False, False, "t/f",   "00:00:00", Parm.SUB, "zk-env/o_light")
-        self.o_auto   = Parm("o_auto",   False, False, "t/f",   "00:00:00", Parm.SUB, "zk-env/o_auto")
+        self.o_light  = Parm("o_light",  False, False, "t/f",   "00:00:00", Parm.SUB, p+"o_light")
+        self.o_auto   = Parm("o_auto",   False, False, "t/f",   "00:00:00", Parm.SUB, p+"o_auto")
 
         # motion sensor, panic button, auto key switch hosted by the pi
-        self.motion   = Parm("motion",   False, False, "t/f",   "00:00:00", Parm.PUB, "zk-env/motion",   False, False, lambda x: None, conf["MOTION_PIN"], GPIO.IN)
-        self.panicbut = Parm("panicbut", False, False, "t/f",   "00:00:00", Parm.PUB, "zk-env/panicbut")
-        self.auto     = Parm("auto",     False, False, "t/f",   "00:00:00", Parm.PUB, "zk-env/auto")
-        self.keysw    = Parm("keysw",    False, False, "t/f",   "00:00:00", Parm.PUB, "zk-enf/keysw",    False, False, self.read_pin, conf["KEYSW_PIN"], GPIO.IN)
+        self.motion   = Parm("motion",   False, False, "t/f",   "00:00:00", Parm.PUB, p+"motion",        False, False, None,           self.pin("MOTION_PIN"), GPIO.IN)
+        self.panicbut = Parm("panicbut", False, False, "t/f",   "00:00:00", Parm.PUB, p+"panicbut")
+        self.auto     = Parm("auto",     False, False, "t/f",   "00:00:00", Parm.PUB, p+"auto")
+        self.keysw    = Parm("keysw",    False, False, "t/f",   "00:00:00", Parm.PUB, p+"keysw",         False, False, None,           self.pin("KEYSW_PIN"), GPIO.IN)
 
         # local control of the light (usually automatic)
-        self.light    = Parm("light",    False, False, "t/f",   "00:00:00", Parm.PUB, "zk-env/light",    False, False, self.write_pin, conf["SSR_PIN"], GPIO.OUT)
+        self.light    = Parm("light",    False, False, "t/f",   "00:00:00", Parm.PUB, p+"light",         False, False, wr,             self.pin("SSR_PIN"), GPIO.OUT)
 
         # automatic override indicator
-        self.ovrled   = Parm("ovrled",   False, False, "t/f",   "00:00:00", Parm.PUB, "zk-env/ovrled",   False, False, self.write_pin, conf["OVRLED_PIN"], GPIO.OUT)
+        self.ovrled   = Parm("ovrled",   False, False, "t/f",   "00:00:00", Parm.PUB, p+"ovrled",        False, False, wr,             self.pin("OVRLED_PIN"), GPIO.OUT)
 
         # used to loop through the parameters in other functions
-        self.parm_list = [self.temp, self.humidity, self.gasrw, self.gasco, self.gaspr, self.tstamp,
-                          self.o_light, self.o_auto, self.keysw,
-                          self.motion, self.panicbut, self.light, self.auto, self.ovrled]
+        self.parm_list = []
+        # ... and the ones that each pass of the main loop looks at: those
+        # published by data_sync() and those with a physical() handler
+        self.pub_list = []
+        self.io_list = []
+
+        # the registry: exact topics and labels are hashed, wildcard topics
+        # (e.g. "zk-env/+/temp") go into the trie.  topics resolved by the
+        # trie are remembered in route_cache so they only get walked once.
+        self.by_topic = {}
+        self.by_label = {}
+        self.trie = TopicTrie()
+        self.route_cache = {}
+
+        for attr in [self.temp, self.humidity, self.gasrw, self.gasco, self.gaspr, self.tstamp,
+                     self.o_light, self.o_auto, self.keysw,
+                     self.motion, self.panicbut, self.light, self.auto, self.ovrled]:
+            self.register(attr)
+
+        # keep a fixed amount of history for the numeric (and t/f) parameters
+        for attr in self.parm_list:
+            if type(attr.value) in (float, int, bool):
+                attr.series = Series(conf.get("SERIES_LEN", 512))
+
+        # optional per parameter deadbands for publishing numeric values
+        for label, deadband in conf.get("DEADBANDS", {}).items():
+            if label in self.by_label:
+                self.by_label[label].deadband = deadband
+            else:
+                self.logging.error("DEADBANDS: unknown label " + label)
 
 
 
@@ -136,6 +412,27 @@ class Env:
 ### this section has the code to manipulate the parameter data structure
 ### and interact with the MQTT data broker
 ### (code for physical i/o below)
+
+    def register(self, parm):
+        """ add a parameter to the list and the topic/label indexes """
+
+        if parm.topic in self.by_topic or parm.label in self.by_label:
+            self.logging.error("Duplicate topic/label ignored: " + parm.topic + " / " + parm.label)
+            return None
+
+        self.parm_list.append(parm)
+        if parm.direction == parm.PUB:
+            self.pub_list.append(parm)
+        if parm.physical is not None:
+            self.io_list.append(parm)
+        self.by_label[parm.label] = parm
+        if "+" in parm.topic or "#" in parm.topic:
+            self.trie.insert(parm.topic, parm)
+            self.route_cache.clear() # a new pattern may change earlier routes
+        else:
+            self.by_topic[parm.topic] = parm
+
+        return parm
         
     def subscribe(self, broker):
         """ subscribe to those parameters indicating so ... only once """
@@ -144,83 +441,281 @@ class Env:
                 if attr.direction == attr.SUB:
                     self.logging.debug("Subscribing: "+attr.label)
                     self.mqtt_client.subscribe(attr.topic)
+            if self.batch_topic:
+                self.logging.debug("Subscribing: %s", self.batch_topic)
+                self.mqtt_client.subscribe(self.batch_topic)
             self.subscribed = True
         else:
             self.logging.debug("Already subscribed ... ignoring")
         
 
-    def data_sync(self, broker):
-        """ sync all of the local data with the data broker """
+    def data_sync(self, broker, force = False):
+        """ sync all of the local data with the data broker
+
+            only changed values are published (retained, so that late
+            subscribers still get them) unless force is set or the value
+            hasn't been published for "PUB_REFRESH" seconds
+        """
+
+        now = time.monotonic()
+        refresh = conf.get("PUB_REFRESH", 0.0)
+        count = self.pub_count
 
         # publish the data values that this program is sourcing
-        for attr in self.parm_list:
-            if attr.direction == attr.PUB:
-                self.logging.debug("From data_sync() " + "Publishing: "+attr.label)
-                self.mqtt_client.publish(attr.topic, attr.value)
+        for attr in self.pub_list:
+            if force or attr.changed() or (refresh > 0.0 and (now - attr.pub_time) >= refresh):
+                self.logging.debug("From data_sync() Publishing: %s", attr.label)
+                self.mqtt_client.publish(attr.topic, attr.value, retain=True)
+                attr.pub_value = attr.value
+                attr.pub_time = now
+                self.pub_count += 1
+            else:
+                self.pub_suppressed += 1
+        if self.pub_count > count:
+            PUBLISHED.inc(self.name, amount = self.pub_count - count)
 
         # note that the subscribed values are updated asynchronously by on_message()
 
+    def mark_stale(self):
+        """ force all of the published values out on the next data_sync()
+            (e.g. after reconnecting to a broker that may have lost them);
+            safe from any thread: it's posted, and apply_updates() forgets
+            the published values on the main loop """
+
+        self.inbox.append(STALE)
+        self.notify()
 
 
     def get_parameter(self, topic):
         """ get the parameter instance for the provided topic """
-                
-        for attr in self.parm_list:
-            if attr.topic == topic:
-                return attr
 
-        self.logging.error("Can't find topic: "+topic)
-        return None
+        parm = self.lookup(topic)
+        if parm is None:
+            self.logging.error("Can't find topic: "+topic)
+        return parm
+
+    def lookup(self, topic):
+        """ get the parameter instance for the provided topic (None if not found) """
+
+        parm = self.by_topic.get(topic)
+        if parm is None:
+            parm = self.route_cache.get(topic)
+        if parm is None:
+            matches = self.trie.match(topic)
+            if matches:
+                parm = matches[0]
+                if len(self.route_cache) >= self.ROUTE_CACHE_MAX:
+                    self.route_cache.clear()
+                self.route_cache[topic] = parm
+
+        return parm
+
+    def ingest(self, topic, payload):
+        """ decode an mqtt payload (bytes) into the parameter for the topic
+            returns the parameter, or None if it wasn't used """
+
+        parm = self.lookup(topic)
+        if parm is None:
+            self.logging.info("Spurious topic data received ... ignored;  Topic = %s", topic)
+            return None
+
+        try:
+            if parm.jflag:
+                # only one object in the packet: {"parm_id" : {"value": ..., "tstamp": ...}}
+                sample = next(iter(json_loads(payload).values()))
+                value = parm.convert(sample["value"])
+                when = sample["tstamp"]
+            else:
+                value = parm.convert(payload.decode("utf-8"))
+                when = None
+        except (ValueError, TypeError, KeyError, AttributeError, StopIteration) as err:
+            self.logging.error("Bad payload from %s ignored: %s", topic, err)
+            return None
+
+        self.logging.debug("Setting %s to %s", parm.label, value)
+        self.inbox.append(((parm, value, when, time.time()),))
+        return parm
+
+    def ingest_batch(self, payload):
+        """ decode a packet with many samples, to be applied all at once
+
+            the packet is a json object with one entry per sample, or a list of them:
+            {"temp": {"value": 21.5, "location": "there", "tstamp": "00:00:00"},
+             "humidity": {"value": 45.0, ...}, ...}
+
+            "parm_id" is matched to the topic <batch topic prefix>/parm_id
+            (e.g. "zk-env/temp"), or else to a parameter label.
+            returns the number of samples applied
+        """
+
+        try:
+            packet = json_loads(payload)
+        except (ValueError, TypeError) as err:
+            self.logging.error("Bad batch packet ignored: %s", err)
+            return 0
+        if isinstance(packet, dict):
+            packet = [packet]
+        elif not isinstance(packet, list):
+            self.logging.error("Bad batch packet ignored: not an object or list")
+            return 0
+
+        # convert everything first, so a bad sample can't leave half a batch applied
+        updates = []
+        now = time.time()
+        for entry in packet:
+            if not isinstance(entry, dict):
+                self.logging.error("Bad batch entry ignored: %r", entry)
+                continue
+            for parm_id, sample in entry.items():
+                parm = self.lookup(self.batch_prefix + parm_id)
+                if parm is None:
+                    parm = self.by_label.get(parm_id)
+                if parm is None:
+                    self.logging.info("Spurious batch entry ... ignored;  parm_id = %s", parm_id)
+                    continue
+                try:
+                    updates.append((parm, parm.convert(sample["value"]), sample.get("tstamp"), now))
+                except (ValueError, TypeError, KeyError, AttributeError) as err:
+                    self.logging.error("Bad batch sample for %s ignored: %s", parm_id, err)
+
+        if updates:
+            self.inbox.append(tuple(updates))
+        return len(updates)
+
+    def post(self, parm, value):
+        """ post a new value for a parameter (safe from any thread) """
+
+        self.inbox.append(((parm, value, None, time.time()),))
+        self.notify()
+
+    def apply_updates(self):
+        """ (main loop only) apply the posted updates, oldest first, and
+            return how many were applied
+
+            a t/f parameter is only changed once per pass: if a later update
+            would change it again before the alarm logic has seen the first
+            one, it and everything after it waits for the next pass, so no
+            events get lost """
+
+        # the pin edges first: the clean transitions become updates
+        if self.edges is not None:
+            self.settle_edges()
+
+        inbox = self.inbox
+        changed = set()
+        applied = 0
+        while inbox:
+            updates = inbox[0]
+            if updates is STALE:
+                inbox.popleft()
+                for attr in self.pub_list:
+                    attr.pub_value = None
+                continue
+            if changed and any([u[0] in changed for u in updates]):
+                self.deferred += 1
+                self.notify()
+                break
+            inbox.popleft()
+            for parm, value, when, now in updates:
+                parm.event = True
+                if when is not None:
+                    parm.when = when
+                parm.set(value, now)
+                if type(value) == bool:
+                    changed.add(parm)
+            applied += 1
+        self.version += applied
+        return applied
     
     def get_parameter_type(self, topic):
         """ get the type of the parameter by topic  """
         
-        for attr in self.parm_list:
-            if attr.topic == topic:
-                return type(attr.value)
-
-        self.logging.error("Can't find topic: "+topic)
-        return type(None)
+        parm = self.get_parameter(topic)
+        if parm is None:
+            return type(None)
+        return type(parm.value)
 
     def get_parameter_by_label(self, label):
         """ get the parameter instance for the provided topic """
                 
-        for attr in self.parm_list:
-            if attr.label == label:
-                return attr
-
-        self.logging.error("Can't find topic: "+label)
-        return None
+        parm = self.by_label.get(label)
+        if parm is None:
+            self.logging.error("Can't find topic: "+label)
+        return parm
 
     def set_parameter(self, topic, value):
         """ set a single parameter value in the class attibute
             return False if topic not found
         """
 
-        found = False
-        
-        for attr in self.parm_list:
-            if attr.topic == topic:
-                attr.value = value
-                found = True
-
-        if found == False:
+        parm = self.by_topic.get(topic)
+        if parm is None:
             self.logging.debug("Can't set value for "+topic)
+            return False
 
-        return found
+        parm.value = value
+        return True
 
     def get_topic(self, label):
         """ find the topic for the provided label """
 
-        for attr in self.parm_list:
-            if attr.label == label:
-                return attr.topic
+        parm = self.by_label.get(label)
+        if parm is None:
+            return ""
+        return parm.topic
+
+    def attach_store(self, store, preload = 0.0):
+        """ record the numeric parameters to the on-disk history store (by topic) and
+            refill the in-memory history with the last preload seconds of it """
 
-        return ""
+        if preload > 0.0:
+            now = time.time()
+            for when, topic, value in store.scan(now - preload, now):
+                parm = self.by_topic.get(topic)
+                if parm is not None and parm.series is not None:
+                    parm.series.append(when, value)
+
+        for attr in self.parm_list:
+            if attr.series is not None:
+                attr.store = store
+
+    def checkpoint(self):
+        """ the values (and timestamps) of the parameters, for MonitoringCheckpoint """
+
+        return dict([(attr.label, [attr.value, attr.when]) for attr in self.parm_list])
+
+    def restore(self, saved):
+        """ put back values from checkpoint() (at start up, before the main loop
+            runs); the inputs on the pins are left to be read again.
+            returns the number restored """
+
+        count = 0
+        for label, (value, when) in saved.items():
+            attr = self.by_label.get(label)
+            if attr is None or (attr.io_pin >= 0 and attr.io_dir == GPIO.IN):
+                continue
+            if type(attr.value) == float and type(value) == int:
+                value = float(value)
+            if type(value) != type(attr.value):
+                self.logging.info("Checkpoint value for %s ignored: %r", label, value)
+                continue
+            attr.value = value
+            attr.pvalue = value
+            attr.when = when
+            count += 1
+        return count
+
+    def notify(self):
+        """ post a change event for this site to wake up the main loop (safe from any thread) """
+
+        if self.events is not None:
+            self.events.put_nowait((time.monotonic(), self))
 
     def display_parameters(self):
         """ for debugging, display all parameter values """
 
+        if not self.logging.getLogger().isEnabledFor(self.logging.DEBUG):
+            return
         self.logging.debug("============")
         for attr in self.parm_list:
             self.logging.debug(attr.label + " (" + attr.when + ")" + " = " + str(attr.value))
@@ -233,79 +728,102 @@ class Env:
 # >>> ADD YOUR HANDLERS FOR THE INDIVIDUAL PARAMETERS HERE
 #
 
-    def motion_edge(self, channel):
-        """ set the local motion_event flag based on edge detected """
-
-        # read the input to determine which edge
-        # do a little software debounce and double-check the value
-
-        # is the detector indicating motion?
-        if GPIO.input(self.motion.io_pin) == True:
-            self.logging.debug("Rising edge detected on %s" %channel)
-            
-            # was the last look indicating no motion (i.e. this is a clean transition)
-            if self.motion.value == False:
-                self.motion.pvalue = self.motion.value
-                self.motion.value = True
-            # if we were already in a "motion=yes" state, must have been noise
-            else:
-                self.logging.debug("Noise")
-
-        # edge change direction indicated : back to no motion
-        else:
-            self.logging.debug("Falling edge on %s" %channel)
-            # clean transition
-            if self.motion.value == True:
-                self.motion.pvalue = self.motion.value
-                self.motion.value = False
-            # noise
-            else:
-                self.logging.debug("Noise")
-
-    ### end of motion_edge()
-                
-    def physical_init(self):
-        """ initialize the physical i/o lines """
+    def settle_edges(self):
+        """ (main loop) post the clean transitions of the input pins and, if
+            a level is still waiting out its glitch/debounce time, make sure
+            the main loop comes back for it """
+
+        transitions, wait = self.edges.drain()
+        for parm, level in transitions:
+            self.post(parm, level)
+        if wait is not None and self.timers is not None:
+            if self.edge_timer is not None and self.edge_timer.due > time.monotonic() + wait:
+                self.timers.cancel(self.edge_timer)
+                self.edge_timer = None
+            if self.edge_timer is None:
+                self.edge_timer = self.timers.schedule(wait, self.edge_due)
+
+    def edge_due(self):
+        self.edge_timer = None
+        self.notify()
+
+    def pin(self, key):
+        """ the pin number from the configuration, if this site has the local hardware """
+
+        if self.has_pins:
+            return conf[key]
+        return -1
+
+    def physical_init(self, timers = None):
+        """ initialize the physical i/o lines (timers: the main loop's
+            TimerQueue, to come back for filtered edges) """
+
+        if not self.has_pins:
+            return
         
         # BCM numbering scheme for Pi pins
-        GPIO.setmode(GPIO.BCM)
+        self.gpio("setmode", GPIO.BCM)
         
         for attr in self.parm_list:
             if attr.io_pin > 0:
-                GPIO.setup(attr.io_pin, attr.io_dir)
+                self.gpio("setup", attr.io_pin, attr.io_dir)
                 if attr.io_dir == GPIO.OUT:
-                    GPIO.output(attr.io_pin, attr.value)
+                    self.gpio("output", attr.io_pin, attr.value)
+                    self.driven[attr.io_pin] = attr.value
+
         #
-        # There seems to be a bug where the edge detection triggers on both
-        # edges.  Compensate in the ISR.
+        # the inputs aren't polled: they're read on their edges.  There seems
+        # to be a bug where the edge detection triggers on both edges: the
+        # filter drops the edges that don't change the level (MonitoringEdges.py)
         #
-        GPIO.add_event_detect(self.motion.io_pin, GPIO.BOTH, callback=self.motion_edge)
+        self.timers = timers
+        self.edges = EdgeFilter(self.logging, self.read_input, self.notify)
+        filters = conf.get("EDGE_FILTERS", {})
+        for attr in self.parm_list:
+            if attr.io_pin > 0 and attr.io_dir == GPIO.IN and attr.physical is None:
+                f = filters.get(attr.label, {})
+                level = self.edges.watch(attr, f.get("glitch", conf.get("EDGE_GLITCH", 0.0)),
+                                         f.get("debounce", conf.get("EDGE_DEBOUNCE", 0.0)))
+                if level != attr.value:
+                    self.post(attr, level)
+                self.gpio("add_event_detect", attr.io_pin, GPIO.BOTH, callback=self.edges.edge)
         
             
     def physical(self):
         """ execute the functions to interact with physical i/o lines """
 
-        for attr in self.parm_list:
+        for attr in self.io_list:
             attr.physical(attr)
 
+    def gpio(self, call, *args, **kwargs):
+        """ call an RPi.GPIO function, counting it """
+
+        self.gpio_calls += 1
+        GPIO_CALLS.inc(call)
+        return getattr(GPIO, call)(*args, **kwargs)
+
+    def read_input(self, pin):
+        """ the level of an input pin (from the edge callback) """
+
+        return self.gpio("input", pin)
 
     def write_pin(self, attr):
-        """ output a value of the parameter to a physical i/o pin """
-        
-        self.logging.debug("Setting " + attr.label + " to " + str(attr.value) + " on pin " + str(attr.io_pin))
-        GPIO.output(attr.io_pin, attr.value)
+        """ output a value of the parameter to a physical i/o pin, if it
+            isn't already at that level """
 
-    def read_pin(self, attr):
-        """ input a value of the parameter to a physical i/o pin """
-        
-        self.logging.debug("Setting " + attr.label + " to " + str(attr.value) + " from pin " + str(attr.io_pin))
-        attr.pvalue = attr.value
-        attr.value = bool(GPIO.input(attr.io_pin))
-        if attr.value != attr.pvalue:
-            attr.event = True
+        if self.driven.get(attr.io_pin) == attr.value:
+            return
+        self.logging.debug("Setting %s to %s on pin %d", attr.label, attr.value, attr.io_pin)
+        self.gpio("output", attr.io_pin, attr.value)
+        self.driven[attr.io_pin] = attr.value
 
     def cleanup(self):
-        GPIO.cleanup()
+        if self.has_pins:
+            self.gpio("cleanup")
+            if self.edges is not None:
+                for label, (accepted, rejected) in sorted(self.edges.counts().items()):
+                    self.logging.info("%s: %s input edges: %d taken, %d filtered out", self.name, label, accepted, rejected)
+            self.logging.info("%s: %d calls to RPi.GPIO", self.name, self.gpio_calls)
 
 
 
@@ -0,0 +1,290 @@
+#
+# MonitoringProbe.py
+#
+# Check the network for the Monitoring_zimKnives project: the broker, the
+# gateway, a DNS server and a few hosts out on the internet, all at once.
+#
+#    This file is part of the "Monitoring zimKnives" project, which is a collection
+#    of files, including this one.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of these words as published by the author.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  Use at your own risk.
+#
+# Every round, all of the targets are probed concurrently (asyncio), each
+# with a short timeout, so a round takes at most the timeout however many
+# targets there are:
+#
+#   tcp : connect to host:port (a refused connection still means the host
+#         answered)
+#   dns : a query (UDP) for a name to a DNS server (port 53 unless given);
+#         it counts if the answer is NOERROR with at least one record (a
+#         home router's resolver still answers SERVFAIL/REFUSED with the
+#         WAN down)
+#
+# Each target keeps its last "window" results (latency, loss).  A target
+# is "local" (broker, gateway, the resolver from /etc/resolv.conf, usually
+# the router) or "internet"; the internet is up if at least
+# "quorum" of the internet targets answered, so one flaky host doesn't make
+# it look down.
+#
+# pingtest.py runs the rounds and writes the state (json) to a file after
+# each one; Monitoring_local.py reads it (read_state()).  asyncio is only
+# imported by the probing (it's slow to import and Monitoring_local.py
+# doesn't need it).
+#
+
+import collections
+import json
+import os
+import random
+import socket
+import struct
+import time
+
+
+class Target:
+    """ something to probe, and its recent results """
+
+    def __init__(self, name, kind, host, port = None, scope = "internet", query = None, window = 30):
+        self.name = name
+        self.kind = kind       # "tcp" or "dns"
+        self.host = host
+        self.port = port
+        self.scope = scope     # "local" or "internet"
+        self.query = query     # the name to look up (dns)
+        self.results = collections.deque(maxlen = window)   # (ok, seconds)
+
+    def up(self):
+        return bool(self.results) and self.results[-1][0]
+
+    def stats(self):
+        """ the recent results: last one, loss (fraction) and latency (ms) of the answers """
+
+        times = [seconds for ok, seconds in self.results if ok]
+        n = len(self.results)
+        return {"up": self.up(), "n": n,
+                "loss": (n - len(times)) / n if n else 0.0,
+                "avg_ms": 1000.0 * sum(times) / len(times) if times else None,
+                "max_ms": 1000.0 * max(times) if times else None}
+
+
+class DnsAnswer:
+    """ (asyncio datagram protocol) wait for the answer to one query """
+
+    def __init__(self, ident, done):
+        self.ident = ident
+        self.done = done
+
+    def connection_made(self, transport):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+    def datagram_received(self, data, addr):
+        if len(data) < 12 or self.done.done():
+            return
+        ident, flags, questions, answers = struct.unpack("!HHHH", data[:8])
+        if ident == self.ident:
+            # a response, NOERROR, with an answer
+            self.done.set_result(bool(flags & 0x8000) and flags & 0x000f == 0 and answers > 0)
+
+    def error_received(self, exc):
+        if not self.done.done():
+            self.done.set_exception(exc)
+
+
+def dns_query(ident, name):
+    """ a DNS query packet for the A record of name """
+
+    packet = struct.pack("!HHHHHH", ident, 0x0100, 1, 0, 0, 0)
+    for label in name.rstrip(".").split("."):
+        packet += bytes([len(label)]) + label.encode("ascii")
+    return packet + b"\0" + struct.pack("!HH", 1, 1)
+
+
+async def probe_tcp(host, port, timeout):
+    import asyncio
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except ConnectionRefusedError:
+        return True
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
+
+
+async def probe_dns(server, name, timeout, port = 53):
+    import asyncio
+    loop = asyncio.get_running_loop()
+    ident = random.randrange(65536)
+    done = loop.create_future()
+    try:
+        transport, protocol = await loop.create_datagram_endpoint(lambda: DnsAnswer(ident, done),
+                                                                  remote_addr = (server, port))
+    except OSError:
+        return False
+    try:
+        transport.sendto(dns_query(ident, name))
+        return await asyncio.wait_for(done, timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    finally:
+        transport.close()
+
+
+class Prober:
+    """ probe the targets in rounds and decide whether the internet is up """
+
+    def __init__(self, logging, targets, timeout = 0.8, quorum = 2):
+        self.logging = logging
+        self.targets = targets
+        self.timeout = timeout     # seconds for each probe
+        self.quorum = quorum       # internet targets that have to answer
+        self.rounds = 0
+        self.down_rounds = 0       # consecutive rounds with the internet down
+        self.down_since = None     # time.monotonic() of the first of them
+        self.internet = None
+        self.changed = time.time() # when self.internet last changed
+
+    async def check(self, target):
+        start = time.monotonic()
+        if target.kind == "dns":
+            ok = await probe_dns(target.host, target.query, self.timeout, target.port or 53)
+        else:
+            ok = await probe_tcp(target.host, target.port, self.timeout)
+        target.results.append((ok, time.monotonic() - start))
+        return ok
+
+    async def round(self):
+        """ probe all of the targets at once; returns the state """
+
+        import asyncio
+        await asyncio.gather(*[self.check(target) for target in self.targets])
+        self.rounds += 1
+
+        internet = [t for t in self.targets if t.scope == "internet"]
+        up = len([t for t in internet if t.up()])
+        now_up = up >= min(self.quorum, len(internet))
+        if now_up != self.internet:
+            if self.internet is not None:
+                self.logging.warning("Internet is %s: %d of %d targets answered (%s)", "up" if now_up else "down",
+                                     up, len(internet), ", ".join([t.name for t in internet if not t.up()]) or "all up")
+            self.internet = now_up
+            self.changed = time.time()
+        self.down_rounds = 0 if now_up else self.down_rounds + 1
+        if now_up:
+            self.down_since = None
+        elif self.down_since is None:
+            self.down_since = time.monotonic()
+        return self.state(up, len(internet))
+
+    def state(self, up, of):
+        return {"time": time.time(), "internet": self.internet, "up": up, "of": of, "quorum": self.quorum,
+                "since": self.changed, "rounds": self.rounds, "down_rounds": self.down_rounds,
+                "local": dict([(t.name, t.up()) for t in self.targets if t.scope == "local"]),
+                "targets": dict([(t.name, t.stats()) for t in self.targets])}
+
+    def down_for(self):
+        """ seconds the internet has been down (0.0 if it's up) """
+
+        return time.monotonic() - self.down_since if self.down_since is not None else 0.0
+
+    async def run(self, interval, down_for = None, path = None, on_round = None):
+        """ probe every interval seconds (writing the state to path and
+            calling on_round(state)) until the internet has been down for
+            down_for seconds (forever if None); returns the last state """
+
+        import asyncio
+        while True:
+            start = time.monotonic()
+            state = await self.round()
+            if path:
+                write_state(path, state, self.logging)
+            if on_round is not None:
+                on_round(state)
+            if down_for is not None and self.down_since is not None and self.down_for() >= down_for:
+                return state
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - start)))
+
+
+def default_gateway():
+    """ the default gateway (from /proc/net/route), or None """
+
+    try:
+        with open("/proc/net/route") as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                if fields[1] == "00000000" and int(fields[3], 16) & 2:
+                    return socket.inet_ntoa(struct.pack("<L", int(fields[2], 16)))
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def nameserver():
+    """ the first nameserver in /etc/resolv.conf, or None """
+
+    try:
+        with open("/etc/resolv.conf") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == "nameserver":
+                    return fields[1]
+    except OSError:
+        pass
+    return None
+
+
+def targets_from_conf(conf):
+    """ the targets in "PROBE_TARGETS", or the broker, the gateway and the
+        resolver (local), and "PINGTEST_URL" and a couple of public DNS
+        servers (internet, one of them asked for "PINGTEST_URL") """
+
+    window = conf.get("PROBE_WINDOW", 30)
+    if conf.get("PROBE_TARGETS"):
+        return [Target(t["name"], t.get("kind", "tcp"), t["host"], t.get("port"), t.get("scope", "internet"),
+                       t.get("query", conf["PINGTEST_URL"]), window) for t in conf["PROBE_TARGETS"]]
+
+    targets = [Target("broker", "tcp", conf["MQTT_BROKER_ADDR"], conf["MQTT_BROKER_PORT"], "local", window = window)]
+    gateway = default_gateway()
+    if gateway is not None:
+        targets.append(Target("gateway", "tcp", gateway, 53, "local", window = window))
+    server = conf.get("PROBE_DNS") or nameserver()
+    if server is not None:
+        targets.append(Target("dns", "dns", server, scope = "local", query = conf["PINGTEST_URL"], window = window))
+    targets.append(Target(conf["PINGTEST_URL"], "tcp", conf["PINGTEST_URL"], 443, "internet", window = window))
+    targets.append(Target("1.1.1.1", "dns", "1.1.1.1", scope = "internet", query = conf["PINGTEST_URL"], window = window))
+    targets.append(Target("8.8.8.8", "tcp", "8.8.8.8", 53, "internet", window = window))
+    return targets
+
+
+def write_state(path, state, logging):
+    """ write the state where Monitoring_local.py can read it (all or nothing) """
+
+    temp = path + ".tmp"
+    try:
+        with open(temp, "w") as f:
+            json.dump(state, f, separators = (",", ":"))
+        os.replace(temp, path)
+    except OSError as err:
+        logging.error("Network state not written to %s: %s", path, err)
+
+
+def read_state(path, max_age):
+    """ the last state written by pingtest.py, or None if there isn't one
+        newer than max_age seconds (e.g. pingtest isn't running) """
+
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(state, dict) or time.time() - state.get("time", 0.0) > max_age:
+        return None
+    return state
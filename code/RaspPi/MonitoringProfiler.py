@@ -0,0 +1,143 @@
+#
+# MonitoringProfiler.py
+#
+# A sampling profiler for the Monitoring_zimKnives project that can be
+# turned on while the program is running (mqtt command or SIGUSR1).
+#
+#    This file is part of the "Monitoring zimKnives" project, which is a collection
+#    of files, including this one.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of these words as published by the author.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  Use at your own risk.
+#
+# While it's running, a thread looks at the stack of every other thread
+# (main loop, paho, mail workers, ...) every "interval" seconds and counts
+# each distinct stack.  When it stops (after "duration" seconds at most),
+# the counts are written in the "collapsed stack" format, one line per stack:
+#
+#   thread;outer function (file:line);...;inner function (file:line) count
+#
+# which flamegraph.pl (or speedscope, etc.) turns into a flame graph.
+#
+# When it isn't running there is no thread and nothing is hooked into the
+# interpreter, so it costs nothing.
+#
+
+import os
+import sys
+import threading
+import time
+
+
+class SamplingProfiler:
+    """ sample the stacks of all of the threads for a while """
+
+    def __init__(self, logging, directory, interval = 0.01, duration = 60.0, name = "Monitoring_local"):
+        self.logging = logging
+        self.directory = directory   # where the .collapsed files go
+        self.interval = interval     # seconds between samples
+        self.duration = duration     # longest run (seconds)
+        self.name = name
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+        self.last = None             # the last file written
+
+    def running(self):
+        return self.thread is not None
+
+    def start(self, duration = None):
+        """ start sampling (for duration seconds, or the default); False if already running """
+
+        with self.lock:
+            if self.thread is not None:
+                return False
+            self.stopping.clear()
+            self.thread = threading.Thread(target = self.sample, name = "profiler",
+                                           args = (duration if duration else self.duration,))
+            self.thread.daemon = True
+            self.thread.start()
+        return True
+
+    def stop(self):
+        """ stop sampling early (the file is still written) """
+
+        self.stopping.set()
+
+    def toggle(self):
+        """ start if stopped, stop if started (e.g. from SIGUSR1) """
+
+        if not self.start():
+            self.stop()
+
+    def command(self, payload):
+        """ an mqtt command: "start", "start <seconds>" or "stop" """
+
+        words = payload.decode("utf-8", "replace").split()
+        if not words:
+            return
+        if words[0] == "start":
+            try:
+                duration = float(words[1]) if len(words) > 1 else None
+            except ValueError:
+                self.logging.error("Bad profiler command ignored: %s", payload)
+                return
+            if not self.start(duration):
+                self.logging.info("Profiler already running")
+        elif words[0] == "stop":
+            self.stop()
+        else:
+            self.logging.error("Bad profiler command ignored: %s", payload)
+
+    def sample(self, duration):
+        """ thread: take the samples, then write them """
+
+        self.logging.info("Profiler started: every %.0f ms for up to %.0f s", self.interval * 1000.0, duration)
+        me = threading.get_ident()
+        counts = {}
+        samples = 0
+        labels = {}   # code object -> "function (file:line)"
+        start = time.monotonic()
+        end = start + duration
+        try:
+            while not self.stopping.is_set() and time.monotonic() < end:
+                names = dict([(t.ident, t.name) for t in threading.enumerate()])
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        label = labels.get(code)
+                        if label is None:
+                            label = labels[code] = "%s (%s:%d)" % (code.co_name,
+                                                                  os.path.basename(code.co_filename), code.co_firstlineno)
+                        stack.append(label)
+                        frame = frame.f_back
+                    stack.append(names.get(ident, "thread-%d" % ident))
+                    stack.reverse()
+                    key = ";".join(stack)
+                    counts[key] = counts.get(key, 0) + 1
+                del frame
+                samples += 1
+                self.stopping.wait(self.interval)
+        finally:
+            self.write(counts, samples, time.monotonic() - start)
+            with self.lock:
+                self.thread = None
+
+    def write(self, counts, samples, elapsed):
+        path = os.path.join(self.directory, "%s-%s.collapsed" % (self.name, time.strftime("%Y%m%d-%H%M%S")))
+        try:
+            with open(path, "w") as f:
+                for stack, count in sorted(counts.items()):
+                    f.write("%s %d\n" % (stack, count))
+        except OSError as err:
+            self.logging.error("Profile not written to %s: %s", path, err)
+            return
+        self.last = path
+        self.logging.info("Profiler stopped: %d samples over %.1f s written to %s", samples, elapsed, path)
@@ -0,0 +1,487 @@
+#
+# MonitoringReplay.py
+#
+# Run the Monitoring_zimKnives sites off the Pi: an in-process stand-in for
+# the mqtt broker, a stand-in for RPi.GPIO, and a replay of recorded traffic
+# (mqtt messages and gpio edges) through the same code the Pi runs.
+#
+#    This file is part of the "Monitoring zimKnives" project, which is a collection
+#    of files, including this one.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of these words as published by the author.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  Use at your own risk.
+#
+# usage:
+#   python3 MonitoringReplay.py synth  FILE [--seconds N] [--period S] [--prefix P]
+#   python3 MonitoringReplay.py record FILE [--seconds N] [--topic T]
+#   python3 MonitoringReplay.py replay FILE [--speed X] [--json] [--log FILE]
+#
+# synth  : write a made up trace: remote sensor packets every S seconds,
+#          light overrides and motion edges, for N seconds
+# record : write the traffic seen on the real broker (from Monitoring_conf.py)
+#          for N seconds
+# replay : play a trace at X times real time (1 to 1000) through
+#          Monitoring_local.py (start(), on_message() and its main loop) with
+#          the sites configured in Monitoring_conf.py and report the stimulus-to-action
+#          latency (from a message or an edge arriving to the end of the main
+#          loop pass that acted on it: outputs written and published) and the
+#          throughput
+#
+# a trace is a file of json lines, one stimulus each, in time order:
+#   {"t": 12.5, "topic": "zk-env/o_light", "payload": "True"}
+#   {"t": 14.0, "pin": "MOTION_PIN", "level": 1}
+# "t" is seconds from the start; "pin" is a pin number or a Monitoring_conf.py key.
+#
+# note: the holdoff timers, the periodic tick and the input edge filters
+# ("EDGE_GLITCH", "EDGE_DEBOUNCE") still run in real time, so at high speeds
+# a holdoff covers more of the trace than it would on the Pi, and short
+# pulses on the pins may be filtered out.
+#
+
+import argparse
+import json
+import logging
+import math
+import queue
+import sys
+import threading
+import time
+import types
+
+
+class GPIOStub:
+    """ stands in for the RPi.GPIO module: pins are just levels in a dict,
+        and drive() changes an input the way the hardware would """
+
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self.levels = {}
+        self.callbacks = {}     # pin -> [(edge, callback)]
+        self.writes = 0         # calls to output()
+        self.reads = 0          # calls to input()
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down = None, initial = None):
+        self.levels.setdefault(pin, self.LOW if initial is None else int(bool(initial)))
+
+    def input(self, pin):
+        self.reads += 1
+        return self.levels.get(pin, self.LOW)
+
+    def output(self, pin, value):
+        self.writes += 1
+        self.levels[pin] = int(bool(value))
+
+    def add_event_detect(self, pin, edge, callback = None, bouncetime = None):
+        self.callbacks[pin] = []
+        if callback is not None:
+            self.callbacks[pin].append((edge, callback))
+
+    def add_event_callback(self, pin, callback):
+        self.callbacks.setdefault(pin, []).append((self.BOTH, callback))
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def cleanup(self, pin = None):
+        pass
+
+    def drive(self, pin, level):
+        """ set an input, calling the edge callbacks (on this thread) if it changed """
+
+        level = int(bool(level))
+        old = self.levels.get(pin, self.LOW)
+        self.levels[pin] = level
+        if level == old:
+            return
+        edge = self.RISING if level else self.FALLING
+        for wanted, callback in self.callbacks.get(pin, []):
+            if wanted == self.BOTH or wanted == edge:
+                callback(pin)
+
+
+def install_gpio():
+    """ make "import RPi.GPIO" find a GPIOStub (before the sites first use a pin) """
+
+    gpio = GPIOStub()
+    package = types.ModuleType("RPi")
+    package.GPIO = gpio
+    sys.modules["RPi"] = package
+    sys.modules["RPi.GPIO"] = gpio
+    return gpio
+
+
+class FakeMessage:
+    """ what paho passes to on_message() """
+
+    def __init__(self, topic, payload, qos = 0, retain = False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class FakeBroker:
+    """ an in-process stand-in for mosquitto: delivers each publish to the
+        clients subscribed to it, on the publisher's thread """
+
+    def __init__(self):
+        self.clients = []
+        self.retained = {}
+        self.published = 0
+        self.lock = threading.Lock()
+
+    def attach(self, client):
+        with self.lock:
+            if client not in self.clients:
+                self.clients.append(client)
+
+    def detach(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def subscribe(self, client, pattern):
+        with self.lock:
+            if pattern in client.patterns:
+                return
+            client.patterns.add(pattern)
+            client.trie.insert(pattern, pattern)
+            retained = [(t, p) for t, p in self.retained.items() if client.trie.match(t)]
+        for topic, payload in retained:
+            client.deliver(FakeMessage(topic, payload, retain = True))
+
+    def publish(self, topic, payload, retain = False):
+        # paho sends numbers (and t/f) as their text
+        if payload is None:
+            payload = b""
+        elif isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        elif not isinstance(payload, (bytes, bytearray)):
+            payload = str(payload).encode("utf-8")
+        with self.lock:
+            self.published += 1
+            if retain:
+                self.retained[topic] = payload
+            targets = [c for c in self.clients if c.trie.match(topic)]
+        for client in targets:
+            client.deliver(FakeMessage(topic, payload))
+
+
+class FakeClient:
+    """ just enough of paho.mqtt.client.Client, connected to a FakeBroker """
+
+    def __init__(self, broker, client_id = ""):
+        from MonitoringParameters import TopicTrie
+        self.broker = broker
+        self.client_id = client_id
+        self.patterns = set()
+        self.trie = TopicTrie()
+        self.published = 0
+        self.on_message = None
+        self.on_connect = None
+        self.on_disconnect = None
+
+    def connect(self, host = "localhost", port = 1883, keepalive = 60):
+        self.broker.attach(self)
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, 0)
+        return 0
+
+    connect_async = connect
+
+    def reconnect(self):
+        return self.connect()
+
+    def disconnect(self):
+        self.broker.detach(self)
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, None, 0)
+        return 0
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def subscribe(self, topic, qos = 0):
+        self.broker.subscribe(self, topic)
+        return (0, 0)
+
+    def publish(self, topic, payload = None, qos = 0, retain = False):
+        self.published += 1
+        self.broker.publish(topic, payload, retain)
+
+    def deliver(self, message):
+        if self.on_message is not None:
+            self.on_message(self, None, message)
+
+
+class StimulusQueue(queue.Queue):
+    """ the main loop's event queue, remembering which events came from a
+        replayed stimulus and when that stimulus was injected """
+
+    def __init__(self):
+        super().__init__()
+        self.current = threading.local()  # .t set by the injector while it's injecting
+        self.taken = []                   # injection times of the events the loop has taken
+
+    def _put(self, item):
+        super()._put((item, getattr(self.current, "t", None)))
+
+    def _get(self):
+        item, t = super()._get()
+        if t is not None:
+            self.taken.append(t)
+        return item
+
+
+class MailStub:
+    """ stands in for the Dispatcher: counts the messages instead of mailing them """
+
+    def __init__(self):
+        self.sent = 0
+
+    def send(self, subject, message, addrs):
+        self.sent += 1
+        return True
+
+
+def load_trace(path):
+    """ read a trace file; returns the list of stimuli (dicts) in time order """
+
+    trace = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                trace.append(json.loads(line))
+    trace.sort(key = lambda s: s["t"])
+    return trace
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(math.ceil(fraction * len(ordered))) - 1)]
+
+
+def replay(trace, speed = 1.0):
+    """ play the trace through the configured sites; returns the results (a dict) """
+
+    gpio = sys.modules["RPi.GPIO"]
+    from Monitoring_conf import conf
+    import Monitoring_local
+
+    # nothing on disk or on the network: no checkpoint, history, spool,
+    # pingtest state or metrics endpoint.  the sites run in this process
+    # (the latency is measured at its main loop), so no shards either
+    for key in ("CHECKPOINT_FILE", "HISTORY_DIR", "SPOOL_FILE", "PROBE_STATE_FILE"):
+        conf[key] = None
+    conf["METRICS_PORT"] = conf["METRICS_PUBLISH"] = conf["SHARDS"] = 0
+
+    broker = FakeBroker()
+    mqtt_client = FakeClient(broker, conf.get("MQTT_CLIENT", "replay"))
+    remote = FakeClient(broker, "replay")   # publishes the recorded traffic
+    events = StimulusQueue()
+
+    # Monitoring_local.py's own set up, on_message() and main loop, with the
+    # stand-in broker and the messages counted instead of mailed
+    Monitoring_local.events = events
+    loop = Monitoring_local.start(mqtt_client)
+    dispatcher = Monitoring_local.dispatcher
+    dispatcher.deliver = lambda job: True
+    mqtt_client.connect()
+    remote.connect()
+
+    # count what the sites do from here on
+    published = mqtt_client.published
+    writes = gpio.writes
+
+    stats = {"lag_max": 0.0}
+    done = threading.Event()
+
+    def inject():
+        """ thread: publish the messages and drive the pins on schedule """
+        start = time.monotonic()
+        for stimulus in trace:
+            due = start + stimulus["t"] / speed
+            wait = due - time.monotonic()
+            if wait > 0.0:
+                time.sleep(wait)
+            now = time.monotonic()
+            stats["lag_max"] = max(stats["lag_max"], now - due)
+            events.current.t = now
+            if "topic" in stimulus:
+                payload = stimulus["payload"]
+                if isinstance(payload, str):
+                    payload = payload.encode("utf-8", "surrogateescape")
+                remote.publish(stimulus["topic"], payload)
+            else:
+                pin = stimulus["pin"]
+                gpio.drive(conf[pin] if isinstance(pin, str) else pin, stimulus["level"])
+            events.current.t = None
+        done.set()
+
+    injector = threading.Thread(target = inject, name = "replay")
+    latencies = []
+    t0 = time.monotonic()
+    injector.start()
+    while not (done.is_set() and events.empty()):
+        loop.run_once()
+        end = time.monotonic()
+        latencies.extend([end - t for t in events.taken])
+        del events.taken[:]
+    elapsed = time.monotonic() - t0
+    injector.join()
+
+    Monitoring_local.shutdown(loop)
+
+    latencies.sort()
+    return {"speed": speed,
+            "stimuli": len(trace),
+            "events": len(latencies),
+            "seconds": elapsed,
+            "throughput": len(trace) / elapsed if elapsed > 0.0 else 0.0,
+            "passes": loop.stats["passes"],
+            "lat_avg": sum(latencies) / len(latencies) if latencies else 0.0,
+            "lat_p50": percentile(latencies, 0.50),
+            "lat_p90": percentile(latencies, 0.90),
+            "lat_p99": percentile(latencies, 0.99),
+            "lat_max": latencies[-1] if latencies else 0.0,
+            "lag_max": stats["lag_max"],
+            "published": mqtt_client.published - published,
+            "gpio_writes": gpio.writes - writes,
+            "mail": dispatcher.stats["sent"]}
+
+
+def synth(path, seconds, period, prefix):
+    """ write a made up trace """
+
+    lines = []
+    t = 0.0
+    n = 0
+    while t < seconds:
+        stamp = time.strftime("%H:%M:%S", time.gmtime(t))
+        temp = 20.0 + 5.0 * math.sin(t / 600.0)
+        for topic, label, value in [("temp", "temp", temp), ("humidity", "humidity", 45.0 + (n % 7)),
+                                    ("gasrw", "gasraw", 300.0 + (n % 11)), ("gasco", "gasco", 1.0),
+                                    ("gaspr", "gaspr", 2.0)]:
+            payload = json.dumps({label: {"value": round(value, 2), "location": "replay", "tstamp": stamp}})
+            lines.append({"t": round(t, 3), "topic": prefix + "/" + topic, "payload": payload})
+        if n % 12 == 0:
+            lines.append({"t": round(t + 0.5, 3), "topic": prefix + "/o_light", "payload": str(n % 24 == 0)})
+        if n % 9 == 0:
+            lines.append({"t": round(t + 1.0, 3), "pin": "MOTION_PIN", "level": 1})
+            lines.append({"t": round(t + 7.0, 3), "pin": "MOTION_PIN", "level": 0})
+        t += period
+        n += 1
+
+    lines.sort(key = lambda s: s["t"])
+    with open(path, "w") as f:
+        for line in lines:
+            f.write(json.dumps(line) + "\n")
+    print("%d stimuli over %.0f seconds written to %s" % (len(lines), seconds, path))
+
+
+def record(path, seconds, topic):
+    """ write what the real broker carries for a while """
+
+    import paho.mqtt.client as mqtt
+    from Monitoring_conf import conf
+
+    start = time.monotonic()
+    count = [0]
+    f = open(path, "w")
+
+    def on_message(client, userdata, message):
+        payload = message.payload.decode("utf-8", "surrogateescape")
+        f.write(json.dumps({"t": round(time.monotonic() - start, 3), "topic": message.topic, "payload": payload}) + "\n")
+        count[0] += 1
+
+    client = mqtt.Client(conf["MQTT_CLIENT"] + "-record")
+    client.on_message = on_message
+    client.connect(conf["MQTT_BROKER_ADDR"], conf["MQTT_BROKER_PORT"])
+    client.subscribe(topic)
+    client.loop_start()
+    time.sleep(seconds)
+    client.loop_stop()
+    client.disconnect()
+    f.close()
+    print("%d messages over %.0f seconds written to %s" % (count[0], seconds, path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Monitoring_zimKnives replay harness")
+    commands = parser.add_subparsers(dest = "command")
+
+    p = commands.add_parser("synth", help = "write a made up trace")
+    p.add_argument("file")
+    p.add_argument("--seconds", type = float, default = 3600.0)
+    p.add_argument("--period", type = float, default = 5.0, help = "seconds between remote packets")
+    p.add_argument("--prefix", default = "zk-env")
+
+    p = commands.add_parser("record", help = "record the traffic on the broker")
+    p.add_argument("file")
+    p.add_argument("--seconds", type = float, default = 600.0)
+    p.add_argument("--topic", default = "#")
+
+    p = commands.add_parser("replay", help = "replay a trace through the sites")
+    p.add_argument("file")
+    p.add_argument("--speed", type = float, default = 1.0, help = "times real time (1 to 1000)")
+    p.add_argument("--json", action = "store_true", help = "print the results as json")
+    p.add_argument("--log", help = "log (at INFO) to this file, as on the Pi")
+
+    args = parser.parse_args()
+    if args.command == "synth":
+        synth(args.file, args.seconds, args.period, args.prefix)
+    elif args.command == "record":
+        record(args.file, args.seconds, args.topic)
+    elif args.command == "replay":
+        if not 1.0 <= args.speed <= 1000.0:
+            parser.error("--speed must be from 1 to 1000")
+        if args.log:
+            logging.basicConfig(filename = args.log, level = logging.INFO,
+                                format = '%(asctime)s - Monitoring_replay - %(levelname)s - %(message)s')
+        else:
+            logging.basicConfig(stream = sys.stderr, level = logging.WARNING)
+        install_gpio()
+        results = replay(load_trace(args.file), args.speed)
+        if args.json:
+            print(json.dumps(results))
+        else:
+            print("replayed %(stimuli)d stimuli at %(speed)gx in %(seconds).2f s: %(throughput).0f stimuli/s, "
+                  "%(passes)d loop passes" % results)
+            print("stimulus-to-action latency: avg %.3f ms, p50 %.3f, p90 %.3f, p99 %.3f, max %.3f ms (%d events)" %
+                  (1000.0 * results["lat_avg"], 1000.0 * results["lat_p50"], 1000.0 * results["lat_p90"],
+                   1000.0 * results["lat_p99"], 1000.0 * results["lat_max"], results["events"]))
+            print("injector fell behind by up to %.3f ms; %d publishes, %d gpio writes, %d mail messages" %
+                  (1000.0 * results["lag_max"], results["published"], results["gpio_writes"], results["mail"]))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
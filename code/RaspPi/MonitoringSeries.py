@@ -0,0 +1,113 @@
+#
+# MonitoringSeries.py
+#
+# Keep a short, in-memory history of each parameter for the
+# Monitoring_zimKnives project.
+#
+#    This file is part of the "Monitoring zimKnives" project, which is a collection
+#    of files, including this one.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of these words as published by the author.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  Use at your own risk.
+#
+# Each Series is a fixed size ring buffer of (timestamp, value) pairs held
+# in two arrays of doubles, so the memory used by a parameter never grows
+# past 16 bytes * capacity.  Once full, the oldest sample is overwritten.
+#
+# Reads hand back memoryview slices of the arrays rather than copies.
+# Because the buffer wraps around, a window may come back as two pieces
+# (oldest first).  The views are only good until the next append.
+#
+
+from array import array
+
+
+class Series:
+    """ fixed capacity ring buffer of (timestamp, value) samples """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array("d", [0.0]) * capacity
+        self.values = array("d", [0.0]) * capacity
+        self.head = 0   # where the next sample goes
+        self.count = 0  # number of valid samples
+
+    def __len__(self):
+        return self.count
+
+    def nbytes(self):
+        """ memory used by the sample arrays """
+        return (self.times.itemsize + self.values.itemsize) * self.capacity
+
+    def append(self, when, value):
+        """ add a sample, overwriting the oldest when full """
+
+        self.times[self.head] = when
+        self.values[self.head] = value
+        self.head += 1
+        if self.head == self.capacity:
+            self.head = 0
+        if self.count < self.capacity:
+            self.count += 1
+
+    def latest(self):
+        """ the most recent (timestamp, value) or None if empty """
+
+        if self.count == 0:
+            return None
+        i = self.head - 1 if self.head > 0 else self.capacity - 1
+        return (self.times[i], self.values[i])
+
+    def time_at(self, n):
+        """ timestamp of the n'th oldest sample """
+        return self.times[(self.head - self.count + n) % self.capacity]
+
+    def views(self, n = None):
+        """ the last n samples (all if None) as a list of (times, values)
+            memoryview pairs, oldest first """
+
+        if n is None or n > self.count:
+            n = self.count
+        if n <= 0:
+            return []
+
+        start = (self.head - n) % self.capacity
+        tview = memoryview(self.times)
+        vview = memoryview(self.values)
+        if start + n <= self.capacity:
+            return [(tview[start:start + n], vview[start:start + n])]
+        # wrapped: the piece at the end of the arrays, then the piece at the start
+        return [(tview[start:], vview[start:]),
+                (tview[:self.head], vview[:self.head])]
+
+    def since(self, when):
+        """ views of the samples with timestamp >= when """
+
+        # timestamps go up in time order, so binary search the logical (unwrapped) order
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.time_at(mid) < when:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self.views(self.count - lo)
+
+    def rate(self, seconds, now):
+        """ rate of change (units/second) over the last seconds (None if < 2 samples) """
+
+        pieces = self.since(now - seconds)
+        if not pieces:
+            return None
+        first_t = pieces[0][0][0]
+        first_v = pieces[0][1][0]
+        last_t = pieces[-1][0][-1]
+        last_v = pieces[-1][1][-1]
+        if last_t <= first_t:
+            return None
+        return (last_v - first_v) / (last_t - first_t)
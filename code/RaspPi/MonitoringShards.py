@@ -0,0 +1,280 @@
+#
+# MonitoringShards.py
+#
+# Optionally spread the sites of the Monitoring_zimKnives project over
+# several worker processes (i.e. several CPU cores).
+#
+#    This file is part of the "Monitoring zimKnives" project, which is a collection
+#    of files, including this one.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of these words as published by the author.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  Use at your own risk.
+#
+# The front process (Monitoring_local.py) keeps the mqtt connection and the
+# mail dispatcher.  Each site is owned by exactly one worker, picked by a
+# stable hash (crc32) of the site's name, so a worker has its own Env's,
+# alarm logic and timers and no state is shared between processes.
+#
+# Inbound mqtt messages are passed to the owning worker on its own queue,
+# so the messages for any one parameter stay in order.  The workers send
+# what they want published (and subscribed, and mailed) back on a single
+# queue that a thread in the front process services.
+#
+# Only one worker can have the site with the local hardware ("PINS").
+#
+# The workers are spawned (a fresh python each), so they read
+# Monitoring_conf.py themselves; only their sites and the log settings are
+# passed to them.
+#
+
+import os
+import queue
+import threading
+import time
+import zlib
+import multiprocessing
+
+from Monitoring_conf import conf
+from MonitoringParameters import Env, EnvRouter, TopicTrie
+from MonitoringHistory import HistoryStore
+from MonitoringMetrics import MetricsServer
+from MonitoringLogging import setup_logging
+from MonitoringCheckpoint import Checkpoint
+import MonitoringMetrics
+from MonitoringTimers import TimerQueue
+from MonitoringSites import ManageAlarms, Site, EventLoop
+
+
+def shard_of(name, nshards):
+    """ the worker that owns the site name (the same every time, in every process) """
+    return zlib.crc32(name.encode("utf-8")) % nshards
+
+
+class QueueClient:
+    """ stands in for the mqtt client in a worker: sends requests to the front """
+
+    def __init__(self, outq):
+        self.outq = outq
+
+    def publish(self, topic, payload = None, qos = 0, retain = False):
+        self.outq.put(("pub", topic, payload, retain))
+
+    def subscribe(self, topic, qos = 0):
+        self.outq.put(("sub", topic))
+
+
+class QueueDispatcher:
+    """ stands in for the mail dispatcher in a worker """
+
+    def __init__(self, outq):
+        self.outq = outq
+
+    def send(self, subject, message, addrs):
+        self.outq.put(("mail", subject, message, list(addrs)))
+        return True
+
+
+def shard_main(index, site_confs, inq, outq, log_conf):
+    """ a worker process: run the sites it owns until told to stop (None on inq) """
+
+    # a log file of its own (two processes can't rotate the same file)
+    import logging
+    log_conf = dict(log_conf)
+    if log_conf.get("filename"):
+        log_conf["filename"] = "%s.shard%d" % (log_conf["filename"], index)
+    log_listener = setup_logging(**log_conf)
+    logging.info("Shard %d (pid %d) starting with %d site(s)", index, os.getpid(), len(site_confs))
+
+    events = queue.Queue()
+    timers = TimerQueue(lambda: events.put_nowait((time.monotonic(), None)))
+    client = QueueClient(outq)
+    dispatcher = QueueDispatcher(outq)
+
+    # each worker keeps its own history (the files can't be shared)
+    history = None
+    if conf.get("HISTORY_DIR"):
+        history = HistoryStore(logging, os.path.join(conf["HISTORY_DIR"], "shard%d" % index),
+                               conf.get("HISTORY_SEGMENT", 86400), conf.get("HISTORY_FLUSH", 60.0),
+                               keep = conf.get("HISTORY_KEEP", 30))
+
+    # ... and its own checkpoint
+    checkpoint = None
+    saved = None
+    if conf.get("CHECKPOINT_FILE"):
+        checkpoint = Checkpoint(logging, "%s.shard%d" % (conf["CHECKPOINT_FILE"], index),
+                                conf.get("CHECKPOINT_MAX_AGE", 3600.0))
+        saved = checkpoint.load()
+
+    router = EnvRouter(logging)
+    sites = []
+    for site_conf in site_confs:
+        env = Env(logging, client, events, site_conf)
+        if history is not None:
+            env.attach_store(history, conf.get("HISTORY_PRELOAD", 3600.0))
+        site = Site(env, ManageAlarms(env, dispatcher, timers))
+        if checkpoint is not None:
+            checkpoint.restore(saved, site)
+        env.data_sync(client)
+        env.physical_init(timers)
+        router.add(env)
+        env.subscribe(client)
+        sites.append(site)
+    if checkpoint is not None:
+        timers.every(conf.get("CHECKPOINT_INTERVAL", 60.0), checkpoint.save, (sites,))
+
+    loop = EventLoop(sites, events, timers)
+    if history is not None:
+        loop.on_tick.append(history.tick)
+
+    # each worker has its own metrics (see Monitoring_conf.py)
+    metrics = None
+    if conf.get("METRICS_PORT", 0) > 0:
+        metrics = MetricsServer(logging, conf["METRICS_PORT"] + 1 + index, conf.get("METRICS_ADDR", "127.0.0.1"))
+        metrics.start()
+    if conf.get("METRICS_PUBLISH", 0) > 0:
+        timers.every(conf["METRICS_PUBLISH"], MonitoringMetrics.publish,
+                     (client, conf.get("METRICS_TOPIC", "zk-env/$metrics") + "/shard" + str(index)))
+
+    def reader():
+        """ feed the inbound messages to the sites, like on_message() """
+        while True:
+            item = inq.get()
+            if item is None:
+                loop.stop()
+                return
+            if item[0] == "msg":
+                router.deliver(item[1], item[2])
+            elif item[0] == "stale":
+                # (posted to each Env; the loop forgets the published values)
+                for site in sites:
+                    site.env.mark_stale()
+
+    feeder = threading.Thread(target = reader, name = "shard-reader")
+    feeder.daemon = True
+    feeder.start()
+
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        pass # the front process tells us when to stop
+
+    loop.report()
+    if checkpoint is not None:
+        checkpoint.save(sites)
+    for site in sites:
+        site.alarms.secure_from_auto()
+        site.env.cleanup()
+    if history is not None:
+        history.close()
+    if metrics is not None:
+        metrics.stop()
+    outq.put(("stats", index, loop.stats))
+    log_listener.stop()
+
+
+class ShardPool:
+    """ the front process' side: start the workers and route messages to them """
+
+    def __init__(self, logging, site_confs, nshards, mqtt_client, dispatcher, log_conf):
+        self.logging = logging
+        self.mqtt_client = mqtt_client
+        self.dispatcher = dispatcher
+        self.nshards = nshards
+        # (a stream can't be passed to a worker; it logs to stderr without one)
+        self.log_conf = dict([(k, v) for k, v in log_conf.items() if k != "stream"])
+
+        # which sites go to which worker, and topic prefix -> worker
+        self.assigned = [[] for i in range(nshards)]
+        self.trie = TopicTrie()
+        self.cache = {}
+        for site_conf in site_confs:
+            shard = shard_of(site_conf["NAME"], nshards)
+            self.assigned[shard].append(site_conf)
+            self.trie.insert(site_conf.get("PREFIX", "zk-env") + "/#", shard)
+
+        # spawn, not fork: by now the front process has threads (paho, the
+        # mail workers, logging) and a forked worker could inherit a lock
+        # one of them holds.  a spawned worker starts from a fresh python
+        # (importing Monitoring_local.py doesn't set anything up)
+        self.mp = multiprocessing.get_context("spawn")
+        self.inqs = [self.mp.Queue() for i in range(nshards)]
+        self.outq = self.mp.Queue()
+        self.workers = []
+        self.stats = {}
+        self.routed = [0] * nshards
+
+    def start(self):
+        """ start the worker processes and the thread that services them """
+
+        for i in range(self.nshards):
+            if not self.assigned[i]:
+                continue
+            worker = self.mp.Process(target = shard_main, name = "shard-" + str(i),
+                                   args = (i, self.assigned[i], self.inqs[i], self.outq, self.log_conf))
+            worker.start()
+            self.workers.append(worker)
+            self.logging.info("Shard %d: %s", i, ", ".join([s["NAME"] for s in self.assigned[i]]))
+
+        self.service = threading.Thread(target = self.serve, name = "shard-results")
+        self.service.daemon = True
+        self.service.start()
+
+    def route(self, topic, payload):
+        """ pass an inbound message to the worker that owns its site """
+
+        shard = self.cache.get(topic)
+        if shard is None:
+            matches = self.trie.match(topic)
+            if not matches:
+                self.logging.info("Spurious topic data received ... ignored;  Topic = %s", topic)
+                return False
+            shard = matches[0]
+            self.cache[topic] = shard
+        self.inqs[shard].put(("msg", topic, payload))
+        self.routed[shard] += 1
+        return True
+
+    def mark_stale(self):
+        """ have every worker republish its values (e.g. after a reconnect) """
+
+        for inq in self.inqs:
+            inq.put(("stale",))
+
+    def serve(self):
+        """ thread: carry out the publishes, subscribes and mail from the workers """
+
+        while True:
+            item = self.outq.get()
+            if item is None:
+                return
+            kind = item[0]
+            if kind == "pub":
+                self.mqtt_client.publish(item[1], item[2], retain = item[3])
+            elif kind == "sub":
+                self.mqtt_client.subscribe(item[1])
+            elif kind == "mail":
+                self.dispatcher.send(item[1], item[2], item[3])
+            elif kind == "stats":
+                self.stats[item[1]] = item[2]
+
+    def stop(self, timeout = 5.0):
+        """ stop the workers and wait for them """
+
+        for inq in self.inqs:
+            inq.put(None)
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+            if worker.is_alive():
+                self.logging.error("%s didn't stop ... terminating", worker.name)
+                worker.terminate()
+        # let the service thread finish what the workers sent on the way out
+        self.outq.put(None)
+        self.service.join(timeout)
+        for i in sorted(self.stats):
+            self.logging.info("Shard %d: %d messages, %d passes, max latency %.1f ms", i,
+                              self.routed[i], self.stats[i]["passes"], 1000.0 * self.stats[i]["lat_max"])
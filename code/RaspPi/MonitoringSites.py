@@ -0,0 +1,541 @@
+#
+# MonitoringSites.py
+#
+# The sites (locations) being monitored by the Monitoring_zimKnives project:
+# the alarm logic for each one and the main loop that services them.
+#
+# ACKNOWLEDGEMENT:
+#    I have benefitted greatly from many more experienced python developers
+#    than I can keep track of.  So, if you see code snippets that you recognise: thanks !
+#    Sorry that I couldn't remember and/or list all of the internet community individually.
+#
+# Having said that ...
+#
+#    This file is part of the "Monitoring zimKnives" project, which is a collection
+#    of files, including this one.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of these words as published by the author.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  Use at your own risk.
+#
+# This was split out of Monitoring_local.py so that the same code can run
+# the sites in Monitoring_local.py itself or in the worker processes of
+# MonitoringShards.py.  Nothing here talks to the broker or the hardware
+# directly; that goes through the Env() and the dispatcher it is given.
+#
+
+import time
+import queue
+import logging
+from Monitoring_conf import conf
+from MonitoringLimits import LimitEngine
+from MonitoringMetrics import registry
+
+# number of seconds between periodic ticks of the main loop
+LOOP_DELAY = 2.0
+
+# what's timed here (see MonitoringMetrics.py)
+STIMULUS = registry.histogram("zk_stimulus_seconds", "stimulus and override processing", ["site"])
+LIMITS = registry.histogram("zk_limits_seconds", "limit evaluation", ["site"])
+PHYSICAL = registry.histogram("zk_physical_seconds", "local gpio i/o (physical())", ["site"])
+LATENCY = registry.histogram("zk_event_latency_seconds", "from an event to the end of the pass that handled it")
+PASS = registry.histogram("zk_loop_pass_seconds", "main loop pass")
+OVERRUN = registry.counter("zk_loop_overruns_total", "main loop passes longer than the tick")
+
+
+# a little class to manage a single, global timer
+class LocalTimer:
+    """ make the timer available more globally and terminate easier
+        (runs on the main loop's TimerQueue, not a thread of its own) """
+
+    started = False
+    
+    def __init__(self, interval, function, timers, args=[], kwargs={}, notify = None):
+        self.interval = interval
+        self.function = function
+        self.timers = timers
+        self.args = args
+        self.kwargs = kwargs
+        self.notify = notify    # e.g. Env.notify: the site gets a pass when it fires
+        self.entry = None
+
+    def create(self):
+        """ arm a timer ... need to call start() to start ... self cancelling """
+        if self.entry is not None and self.started:
+            self.timers.cancel(self.entry)
+        self.entry = None
+
+    def start(self, delay = None):
+        """ start a timer that has beed created using create()
+            (for delay seconds rather than the interval if given) """
+        if delay is None:
+            delay = self.interval
+        self.entry = self.timers.schedule(delay, self.expire)
+        self.started = True
+
+    def expire(self):
+        self.function(*self.args, **self.kwargs)
+        if self.notify is not None:
+            self.notify()
+
+    def cancel(self):
+        """ cancel a timer that has yet to complete """
+        if self.entry is not None:
+            self.timers.cancel(self.entry)
+        self.started = False
+
+    def remaining(self):
+        """ seconds until the timer fires (None if it isn't running) """
+        if self.started == False or self.entry is None:
+            return None
+        return max(0.0, self.entry.due - time.monotonic())
+        
+
+class ManageAlarms:
+    """ Manage all of the automatic alarming logic """
+    
+
+    def __init__(self, env, dispatcher, timers):
+        # the site (parameters) being looked after
+        self.env = env
+
+        # outgoing text/mail messages are handed to this
+        self.dispatcher = dispatcher
+
+        # a site may have its own lists; otherwise use the global ones
+        self.alarmlist = env.site.get("ALARMLIST", conf["ALARMLIST"])
+        self.notifications = env.site.get("NOTIFICATIONS", conf["NOTIFICATIONS"])
+
+        # used to loop through the stimulus'es to be processed
+        # >>> ADD NEW STIMULUSES TO BE PROCESSED HERE
+        self.stimulus_list = [self.motion_detected, self.temp_hum_gas, self.auto_on_off, self.set_ovrled]
+
+        # keep track of whether we are in alarming events
+        self.motion_event = False
+
+        # keep track of when the temp, humidity and gas status message was sent
+        self.thg_sent = False
+
+        # keep track of when the limit message has been sent
+        self.limit_sent = False
+
+        # instantiate the local timer class to be used over and over
+        # (the main loop only visits a site when it has something to do, so
+        # they wake it up when they fire)
+        self.mtimer = LocalTimer(conf["MOTION_HOLDOFF"], self.reset_motion_event, timers, notify = env.notify)
+        self.ttimer = LocalTimer(conf["THG_HOLDOFF"], self.reset_thg_sent, timers, notify = env.notify)
+        self.ltimer = LocalTimer(conf["LIM_HOLDOFF"], self.reset_limit_sent, timers, notify = env.notify)
+
+        # ... and republish everything every "PUB_REFRESH" seconds
+        if conf.get("PUB_REFRESH", 0.0) > 0.0:
+            timers.every(conf["PUB_REFRESH"], env.data_sync, (env.mqtt_client, True))
+
+        # the limit checks, compiled for quick evaluation
+        self.limits = LimitEngine(logging, env.site.get("LIMIT_CHECKS", conf["LIMIT_CHECKS"]), env)
+
+
+    ### stimulus processing functions
+    # >>> IF YOU ADD A NEW STIMULUS TO THE LIST (ABOVE), ADD THE HANDLER(S) HERE
+
+    # Motion sensor : ~if auto, turn on light and send a text/mail messagae
+    def motion_detected(self):
+        """ process the motion detection capability """
+
+        logging.debug("Processing motion")
+
+        # if not in auto mode don't do this stuff: count on secure_from_auto() to cleanup
+        if self.env.auto.value == True:
+            # if I am currently not in a motion event
+            if self.motion_event == False:
+                # motion detected?
+                if self.env.motion.value == True:
+                    self.light_it_up()
+                    self.send_alarm_msgs("Motion detected at " + self.env.location)
+                    self.mtimer.create()
+                    self.mtimer.start()
+                    self.motion_event = True
+                # end motion event    
+                else:
+                    self.light_it_up(True) # reset = True
+        else:
+            logging.debug("not auto mode ... doing nothing")
+
+
+    def reset_motion_event(self):
+        """ reset the motion event, usually after the timer expires """
+        logging.debug("Timer resetting motion event")
+        self.motion_event = False
+        self.mtimer.started = False
+
+    # Temp, Humidity, Gas value processing : send status text/mail a couple of times a day
+    def temp_hum_gas(self):
+        """ process the temperature, humidity and gas readings.
+            not controlled by auto mode (i.e. runs continuously) """
+
+        if self.thg_sent == False:
+            message = "T:" + str(self.env.temp.value) + \
+                      " H:" + str(self.env.humidity.value) + \
+                      " G_CO:" + str(self.env.gasco.value) + \
+                      " G_PR:" + str(self.env.gaspr.value)
+            logging.debug("Text message: " + message)
+            self.send_notif_msgs(message)
+            self.ttimer.create()
+            self.ttimer.start()
+            self.thg_sent = True
+            
+    def reset_thg_sent(self):
+        """ reset the temp, hum, gas "sent" flag, usually after the timer expires """
+        logging.debug("Timer resetting thg sent flag")
+        self.thg_sent = False
+        self.ttimer.started = False
+
+    def reset_limit_sent(self):
+        """ reset the limit sent flag, usually after the timer expires """
+        logging.debug("Timer resetting limit sent flag")
+        self.limit_sent = False
+        self.ltimer.started = False
+
+    # auto mode on/off processing
+    def auto_on_off(self):
+        """ do, sort of a three-way switch with remote and local key switch for auto mode """
+        
+        # was a new event from the key received?
+        if self.env.keysw.event == True:
+            if self.env.keysw.value == True:
+                logging.info("keysw commanded auto on ... doing it")
+                self.env.auto.value = True
+            elif self.env.keysw.value == False:
+                logging.info("keysw commanded auto off ... doing it")
+                self.env.auto.value = False
+                self.secure_from_auto()
+            else:
+                logging.error("strange value received for auto override ... ignored")
+
+            self.env.keysw.event = False # use it only once
+
+        if self.env.o_auto.event == True:
+            if self.env.o_auto.value == True:
+                logging.info("override commanded auto on ... doing it")
+                self.env.auto.value = True
+            elif self.env.o_auto.value == False:
+                logging.info("override commanded auto off ... doing it")
+                self.env.auto.value = False
+                self.secure_from_auto()
+            else:
+                logging.error("strange value received for auto override ... ignored")
+
+            self.env.o_auto.event = False # use it only once
+
+    def set_ovrled(self):
+        """ adjust the state of the auto override led """
+
+        self.env.ovrled.value = self.env.keysw.value ^ self.env.auto.value
+            
+
+    ### processing operations to perform every so often; probalby in the main while()
+        
+    def process_stimuluses(self):
+        """ loop through the list and process the stimuluses """
+        for func in self.stimulus_list:
+            func()
+
+    def process_overrides(self):
+        """ take the appropriate actions based on the override values changing """
+        
+        # process the light override first
+        # allow the override to turn it off, knowing that it will be
+        # turned back on after the holdoff if the threat continues.
+
+        # was a new event received?
+        if self.env.o_light.event == True:
+            if self.env.o_light.value == True:
+                logging.info("override commanded light on ... doing it")
+                self.env.light.value = True
+            elif self.env.o_light.value == False:
+                logging.info("override commanded light off ... doing it")
+                self.env.light.value = False
+            else:
+                logging.error("strange value received for light override ... ignored")
+
+            self.env.o_light.event = False # use it only once
+            
+
+        # automatic alarming mode
+        # code moved to stimulus section because it is combined with key switch input
+
+    def process_limits(self):
+        """ check the "LIMIT_CHECKS" dictionary from the conf file (compiled
+            into self.limits) and send messages if warranted """
+
+        logging.debug("Processing limits ...")
+
+        # a single message covering all of the exceeded limits
+        message = self.limits.evaluate()
+
+        # if a message was created (i.e. a limit was exceeded), send it
+        if message is not None:
+            # if a limit was exceeded and a message has not been sent
+            # recently (controlled by "LIM_HOLDOFF"), create and send it
+            if self.limit_sent == False:
+                logging.debug("Text message: %s", message)
+                self.send_alarm_msgs(message)
+                self.ltimer.create()
+                self.ltimer.start()
+                self.limit_sent = True
+
+
+    
+    ### alarming responses
+    # >>> IF YOU ADD A NEW ALARM OUTPUT (LIKE A SIREN), ADD THE METHOD HERE
+    
+    def send_alarm_msgs(self, message = "Alarm present"):
+        """ send text or email messages to the configured list """
+
+        logging.info("Queueing alarm message for %d recipient(s)", len(self.alarmlist))
+        self.dispatcher.send("Alarm", message, self.alarmlist)
+    
+    def send_notif_msgs(self, message = "Notification"):
+        """ send text or email messages to the configured list """
+        
+        logging.info("Queueing notification message for %d recipient(s)", len(self.notifications))
+        self.dispatcher.send("Notification", message, self.notifications)
+
+
+    def say_something(self, holdoff = 0):
+        """ use the local text to voice or play a wav file """
+                # say something if a motion event is active
+#        if motion_event == True:
+#            p1 = subprocess.Popen(["echo", "I see you"], stdout = subprocess.PIPE)
+#            p2 = subprocess.Popen(["festival", "--tts"], stdin=p1.stdout, stdout = subprocess.PIPE)
+#            p1.stdout.close()
+#            output,err = p2.communicate()
+        pass
+
+
+    def make_noise(self, reset = False, holdoff = 0):
+       """ activate the local siren """
+       pass
+
+
+    def light_it_up(self, reset = False, holdoff = 0):
+        """ implement local control of the light; respect the remote override """
+
+        # reset requested
+        if reset == True:
+            logging.debug("local reset of light/SSR requested")
+            # check the override state
+            if self.env.o_light.value == True :
+                logging.debug("... ignored")
+            else:
+                self.env.light.value = False
+                
+        # this code is asking for the light on (e.g. alarm event) ... do it
+        else:
+            self.env.light.value = True
+
+
+    def secure_from_auto(self):
+        """ clean things up after auto alarming is disabled """
+        # end all events in progress/reset alarm event timers
+        self.motion_event = False
+        if self.mtimer.started == True:
+            self.mtimer.cancel()
+
+
+    def checkpoint(self):
+        """ the holdoffs in progress as wall clock deadlines (None if not), for MonitoringCheckpoint """
+
+        state = {}
+        now = time.time()
+        for name, flag, timer in (("motion", self.motion_event, self.mtimer),
+                                  ("thg", self.thg_sent, self.ttimer),
+                                  ("limit", self.limit_sent, self.ltimer)):
+            remaining = timer.remaining()
+            state[name] = now + remaining if flag and remaining is not None else None
+        return state
+
+    def restore(self, saved):
+        """ re-arm the holdoffs from checkpoint() that haven't run out yet
+            (at start up); returns the number re-armed """
+
+        count = 0
+        now = time.time()
+        for name, timer in (("motion", self.mtimer), ("thg", self.ttimer), ("limit", self.ltimer)):
+            deadline = saved.get(name)
+            if deadline is None or deadline <= now:
+                continue
+            # never longer than the holdoff (e.g. if the clock was wrong when it was saved)
+            timer.create()
+            timer.start(min(deadline - now, timer.interval))
+            if name == "motion":
+                self.motion_event = True
+            elif name == "thg":
+                self.thg_sent = True
+            else:
+                self.limit_sent = True
+            count += 1
+        return count
+
+    def start_auto(self):
+        """ cleanly start up auto-alarming; return outputs to default """        
+        pass
+
+        
+### end of class ManageAlarms()
+
+
+class Site:
+    """ one location being monitored: its parameters and its alarm logic """
+
+    def __init__(self, env, alarms):
+        self.name = env.name
+        self.env = env
+        self.alarms = alarms
+
+    def process(self):
+        """ one pass of the alarm logic and i/o for the site """
+
+        clock = time.perf_counter
+
+        # take in what the callbacks posted since the last pass; nothing
+        # else changes the parameters while the pass works on them
+        self.env.apply_updates()
+
+        t0 = clock()
+        # process the stimuluses
+        self.alarms.process_stimuluses()
+
+        # process overrides (mostly adjust the values in the parameter data
+        self.alarms.process_overrides()
+        t1 = clock()
+    
+        # read/write the locally hosted i/o
+        self.env.physical()
+        t2 = clock()
+
+        self.env.display_parameters()
+
+        t3 = clock()
+        self.alarms.process_limits()
+        t4 = clock()
+
+        STIMULUS.observe(t1 - t0, self.name)
+        PHYSICAL.observe(t2 - t1, self.name)
+        LIMITS.observe(t4 - t3, self.name)
+
+        # publish the results right away rather than on the next pass
+        logging.debug("Main Loop ... Syncing data for %s", self.name)
+        self.env.data_sync(self.env.mqtt_client)
+
+
+class EventLoop:
+    """ the main loop: sleep until there is an event, a timer is due or it's
+        time for the periodic tick, then process the sites that need it
+
+        only the sites that posted an event (Env.notify()) get a pass; a
+        timer for a site notifies it.  the tick only runs the housekeeping
+        (on_tick), so an idle loop does next to nothing """
+
+    def __init__(self, sites, events, timers, tick = LOOP_DELAY):
+        self.sites = sites
+        self.events = events   # (time.monotonic(), Env or None) posted by the callbacks
+        self.timers = timers
+        self.tick = tick
+        self.on_tick = []      # functions to call on every periodic tick
+        self.next_tick = time.monotonic()
+        self.running = True
+
+        # stimulus-to-output latency of the main loop passes (seconds)
+        self.stats = {"passes": 0, "ticks": 0, "lat_max": 0.0, "lat_sum": 0.0, "lat_cnt": 0}
+
+        # every site gets a first pass
+        for site in sites:
+            site.env.notify()
+
+    def run(self):
+        """ loop until stop() """
+
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        """ end run() (safe from any thread) """
+
+        self.running = False
+        self.events.put_nowait((time.monotonic(), None))
+
+    def run_once(self):
+        """ wait for something to do, and do it """
+
+        # sleep until something changes, a timer is due or it's time for the periodic tick
+        wait = max(0.0, self.next_tick - time.monotonic())
+        due = self.timers.next_due()
+        if due is not None and due < wait:
+            wait = due
+        try:
+            first = self.events.get(timeout = wait)
+        except queue.Empty:
+            first = None
+
+        # collect anything else that arrived so a burst is handled in one pass
+        batch = []
+        if first is not None:
+            batch.append(first)
+            while True:
+                try:
+                    batch.append(self.events.get_nowait())
+                except queue.Empty:
+                    break
+
+        tick = time.monotonic() >= self.next_tick
+        if tick:
+            self.next_tick = time.monotonic() + self.tick
+            self.stats["ticks"] += 1
+
+        start = time.monotonic()
+
+        # expired holdoffs, etc.; what they post is handled in this pass
+        if self.timers.run_due():
+            while True:
+                try:
+                    batch.append(self.events.get_nowait())
+                except queue.Empty:
+                    break
+
+        # only the sites that posted events
+        changed = set([event[1] for event in batch])
+        for site in self.sites:
+            if site.env in changed:
+                site.process()
+
+        # keep track of how long it took from the oldest event to here
+        self.stats["passes"] += 1
+        if batch:
+            latency = time.monotonic() - min([event[0] for event in batch])
+            self.stats["lat_sum"] += latency
+            self.stats["lat_cnt"] += 1
+            if latency > self.stats["lat_max"]:
+                self.stats["lat_max"] = latency
+            LATENCY.observe(latency)
+            logging.debug("%d event(s) handled in %.1f ms", len(batch), latency * 1000.0)
+
+        if tick:
+            for func in self.on_tick:
+                func()
+
+        took = time.monotonic() - start
+        PASS.observe(took)
+        if took > self.tick:
+            OVERRUN.inc()
+            logging.debug("Main loop pass took %.1f ms", took * 1000.0)
+
+    def report(self):
+        """ log the latency statistics """
+
+        if self.stats["lat_cnt"] > 0:
+            logging.info("Event latency: avg %.1f ms, max %.1f ms over %d passes (%d ticks)",
+                         1000.0 * self.stats["lat_sum"] / self.stats["lat_cnt"], 1000.0 * self.stats["lat_max"],
+                         self.stats["passes"], self.stats["ticks"])
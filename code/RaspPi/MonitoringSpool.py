@@ -0,0 +1,164 @@
+#
+# MonitoringSpool.py
+#
+# Keep the outgoing messages of the Monitoring_zimKnives project on disk
+# until they've been sent, so an internet outage (or a reboot) doesn't
+# lose them.
+#
+#    This file is part of the "Monitoring zimKnives" project, which is a collection
+#    of files, including this one.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of these words as published by the author.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  Use at your own risk.
+#
+# The spool is a file of json lines that is only ever appended to:
+#
+#   {"seq": 12, "time": <time.time()>, "subject": "Alarm", "message": "...", "addrs": [...]}
+#   {"ack": 12}
+#
+# A message is written (and, by the "fsync" policy, fsync'ed) before it is
+# queued for sending, and acknowledged once it's been sent.  At start up the
+# messages without an "ack" are the ones still to send, in order.  When
+# everything has been acknowledged the file is emptied; a torn last line
+# (power cut) is skipped.
+#
+# fsync policy: "always" (every message and ack), "batch" (only when sync()
+# is called, e.g. on the main loop's tick) or "never" (leave it to the OS).
+#
+
+import json
+import os
+import threading
+import time
+
+
+class Spool:
+    """ an append-only file of messages waiting to be sent """
+
+    def __init__(self, logging, path, fsync = "always"):
+        self.logging = logging
+        self.path = path
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.records = {}     # seq -> record, not yet acknowledged
+        self.seq = 0          # the last sequence number used
+        self.dirty = False    # written since the last fsync
+        self.file = None
+
+    def load(self):
+        """ read the spool (at start up); returns the number of messages still to send """
+
+        records = {}
+        seq = 0
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        self.logging.error("Spool %s: unreadable entry skipped", self.path)
+                        continue
+                    if "ack" in entry:
+                        records.pop(entry["ack"], None)
+                    elif "seq" in entry:
+                        records[entry["seq"]] = entry
+                        seq = max(seq, entry["seq"])
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            self.logging.error("Spool %s not read: %s", self.path, err)
+
+        with self.lock:
+            self.records = records
+            self.seq = seq
+            self.rewrite()
+        if records:
+            self.logging.info("Spool %s: %d message(s) still to send", self.path, len(records))
+        return len(records)
+
+    def rewrite(self):
+        """ (lock held) start the file over with just the unacknowledged messages """
+
+        if self.file is not None:
+            self.file.close()
+        temp = self.path + ".tmp"
+        try:
+            with open(temp, "w") as f:
+                for seq in sorted(self.records):
+                    f.write(json.dumps(self.records[seq], separators = (",", ":")) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self.path)
+            self.file = open(self.path, "a")
+        except OSError as err:
+            self.logging.error("Spool %s not written: %s", self.path, err)
+            self.file = None
+
+    def write(self, entry):
+        """ (lock held) append an entry """
+
+        if self.file is None:
+            return False
+        try:
+            self.file.write(json.dumps(entry, separators = (",", ":")) + "\n")
+            self.file.flush()
+            if self.fsync == "always":
+                os.fsync(self.file.fileno())
+            else:
+                self.dirty = True
+        except OSError as err:
+            self.logging.error("Spool %s not written: %s", self.path, err)
+            return False
+        return True
+
+    def append(self, subject, message, addrs):
+        """ keep a message until it's acknowledged; returns its sequence number """
+
+        with self.lock:
+            self.seq += 1
+            entry = {"seq": self.seq, "time": time.time(), "subject": subject, "message": message, "addrs": list(addrs)}
+            self.records[self.seq] = entry
+            self.write(entry)
+            return self.seq
+
+    def ack(self, seq):
+        """ the message has been sent """
+
+        with self.lock:
+            if self.records.pop(seq, None) is None:
+                return
+            if self.records:
+                self.write({"ack": seq})
+            else:
+                # all sent: start over with an empty file
+                self.rewrite()
+                self.dirty = False
+
+    def pending(self):
+        """ the messages not acknowledged yet, oldest first """
+
+        with self.lock:
+            return [self.records[seq] for seq in sorted(self.records)]
+
+    def sync(self):
+        """ fsync what's been written (the "batch" policy) """
+
+        with self.lock:
+            if self.dirty and self.file is not None:
+                try:
+                    os.fsync(self.file.fileno())
+                except OSError as err:
+                    self.logging.error("Spool %s not synced: %s", self.path, err)
+                self.dirty = False
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                if self.dirty:
+                    os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
@@ -0,0 +1,131 @@
+#
+# MonitoringTimers.py
+#
+# Timers for the Monitoring_zimKnives project, run from the main loop
+# rather than from a thread per timer.
+#
+#    This file is part of the "Monitoring zimKnives" project, which is a collection
+#    of files, including this one.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of these words as published by the author.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  Use at your own risk.
+#
+# All of the timers live in one heap ordered by when they are due.  Arming
+# a timer is a heap push, O(log n).  Cancelling just marks it; cancelled
+# timers are thrown away when they get to the top of the heap (or when
+# there are too many of them).
+#
+# The main loop asks next_due() how long it can sleep and calls run_due()
+# when it wakes up, so every callback runs on the main loop's thread and
+# doesn't need any locking against it.
+#
+
+import heapq
+import threading
+import time
+
+
+class TimerEntry:
+    """ a single armed timer """
+
+    def __init__(self, due, seq, function, args, kwargs, period):
+        self.due = due          # time.monotonic() when it fires
+        self.seq = seq          # keeps the heap order stable for equal times
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.period = period    # re-arm with this interval (None for one-shot)
+        self.cancelled = False
+        self.queued = True      # still in the heap
+
+    def __lt__(self, other):
+        return (self.due, self.seq) < (other.due, other.seq)
+
+
+class TimerQueue:
+    """ a heap of timers serviced by the main loop """
+
+    def __init__(self, wake = None):
+        self.heap = []
+        self.seq = 0
+        self.ncancelled = 0
+        self.lock = threading.Lock()  # timers may be armed from other threads
+        self.wake = wake   # called when a new timer becomes the next one due
+
+    def __len__(self):
+        return len(self.heap) - self.ncancelled
+
+    def schedule(self, delay, function, args = (), kwargs = {}, period = None):
+        """ call function(*args, **kwargs) after delay seconds (and then every
+            period seconds if given); returns the entry for cancel() """
+
+        with self.lock:
+            self.seq += 1
+            entry = TimerEntry(time.monotonic() + delay, self.seq, function, args, kwargs, period)
+            heapq.heappush(self.heap, entry)
+            first = self.heap[0] is entry
+        if first and self.wake is not None:
+            self.wake()
+        return entry
+
+    def every(self, period, function, args = (), kwargs = {}):
+        """ call function every period seconds """
+        return self.schedule(period, function, args, kwargs, period)
+
+    def cancel(self, entry):
+        """ stop a timer from firing """
+
+        with self.lock:
+            if entry.cancelled:
+                return
+            entry.cancelled = True
+            if not entry.queued:
+                return
+            self.ncancelled += 1
+            # don't let a pile of dead timers build up
+            if self.ncancelled > 64 and self.ncancelled > len(self.heap) // 2:
+                for e in self.heap:
+                    if e.cancelled:
+                        e.queued = False
+                self.heap = [e for e in self.heap if not e.cancelled]
+                heapq.heapify(self.heap)
+                self.ncancelled = 0
+
+    def next_due(self):
+        """ seconds until the next timer is due (None if there aren't any) """
+
+        with self.lock:
+            while self.heap and self.heap[0].cancelled:
+                heapq.heappop(self.heap).queued = False
+                self.ncancelled -= 1
+            if not self.heap:
+                return None
+            return max(0.0, self.heap[0].due - time.monotonic())
+
+    def run_due(self):
+        """ run the callbacks of all of the timers that are due; returns how many ran """
+
+        ran = 0
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                if not self.heap or self.heap[0].due > now:
+                    break
+                entry = heapq.heappop(self.heap)
+                entry.queued = False
+                if entry.cancelled:
+                    self.ncancelled -= 1
+                    continue
+                if entry.period is not None:
+                    entry.due += entry.period
+                    if entry.due <= now:  # fell behind; don't fire a burst to catch up
+                        entry.due = now + entry.period
+                    entry.queued = True
+                    heapq.heappush(self.heap, entry)
+            entry.function(*entry.args, **entry.kwargs)
+            ran += 1
+        return ran
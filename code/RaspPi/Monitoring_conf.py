@@ -6,30 +6,122 @@ conf = {
 # location: used in various messages
 "LOCATION" : "your location string",
 
+# optional: more than one site (location) served by this program.  each has
+# its own parameters under "PREFIX" (e.g. "zk-env/temp") and its own alarm
+# logic.  only the site with "PINS" : True uses the hardware pins below.
+# "LIMIT_CHECKS", "ALARMLIST" and "NOTIFICATIONS" can be given per site;
+# otherwise the ones below are used.  without "SITES", the one site is
+# "LOCATION" on "zk-env".
+#"SITES" : [
+#    {"NAME" : "zkshop", "LOCATION" : "the shop", "PREFIX" : "zk-env", "PINS" : True},
+#    {"NAME" : "garage", "LOCATION" : "the garage", "PREFIX" : "bt-garage",
+#     "ALARMLIST" : ["your first email addr"]},
+#    ],
+
+# optional: run the sites in this many worker processes (to use more than
+# one cpu core when there are a lot of sites).  0 runs them all in the main
+# process.  a site always goes to the same worker (by a hash of its "NAME").
+"SHARDS" : 0,
+
 # Hardware pin assignments
 "MOTION_PIN" : 4,
 "SSR_PIN" : 26,
 "OVRLED_PIN" : 11,
 "KEYSW_PIN" : 17,
 
+# the inputs read on their edges (e.g. the motion detector) are filtered:
+# a new level has to last "EDGE_GLITCH" seconds to count, and after a change
+# the next one isn't taken for "EDGE_DEBOUNCE" seconds.  per parameter
+# label in "EDGE_FILTERS", e.g. {"motion" : {"glitch" : 0.05, "debounce" : 1.0}}
+"EDGE_GLITCH" : 0.002,
+"EDGE_DEBOUNCE" : 0.01,
+"EDGE_FILTERS" : {},
+
 # used by separate ping test program to make sure the internet is working
+# (it probes "PINGTEST_URL" and the other targets every "PINGTEST_INTERVAL"
+# seconds to keep the up/down state, and reboots once the internet has been
+# down for "PINGTEST_REBOOT_AFTER" seconds)
 "PINGTEST_URL" : "www.google.com",
-"PINGTEST_FAILS" : 3,
-"PINGTEST_INTERVAL" : 600, # time in seconds between ping attempts
+"PINGTEST_INTERVAL" : 10, # time in seconds between probe rounds
+"PINGTEST_REBOOT_AFTER" : 1800, # seconds of outage before rebooting
 "PINGTEST_RBTCMD" : "shutdown -r now",
 #"PINGTEST_RBTCMD" : "echo fake reboot",
 "PINGTEST_REBOOT" : True,  # False to just log the status; True to execute the RBTCMD
+"PINGTEST_REBOOT_SPOOLED" : False,  # reboot even when the messages are spooled ("SPOOL_FILE")
 "PINGTEST_BC" : "/home/pi/develop/Monitoring_reboot", # breadcrumb if reboot happens
 "PINGTEST_LOGFILE" : "/var/log/pingtest.log",
+# each probe times out after "PROBE_TIMEOUT" seconds; the internet is down
+# when fewer than "PROBE_QUORUM" of the internet targets answer.  latency and
+# loss are kept over the last "PROBE_WINDOW" rounds.  optional: the state is
+# written to "PROBE_STATE_FILE" (on a ram disk) after each round for
+# Monitoring_local (None to disable; set it to e.g. the commented out path
+# below, the same for both programs).
+# the targets are the broker, the gateway and the DNS server ("PROBE_DNS" or
+# the one in /etc/resolv.conf) as local ones, and "PINGTEST_URL", 1.1.1.1
+# (asked for "PINGTEST_URL") and 8.8.8.8 as internet ones, unless
+# "PROBE_TARGETS" lists them, e.g.
+#"PROBE_TARGETS" : [
+#    {"name" : "broker", "host" : "192.168.1.10", "port" : 1883, "scope" : "local"},
+#    {"name" : "router dns", "kind" : "dns", "host" : "192.168.1.1", "query" : "www.google.com", "scope" : "local"},
+#    {"name" : "cloudflare", "kind" : "dns", "host" : "1.1.1.1", "query" : "www.google.com"},
+#    {"name" : "quad9", "host" : "9.9.9.9", "port" : 53},
+#    ],
+"PROBE_TIMEOUT" : 0.8,
+"PROBE_QUORUM" : 2,
+"PROBE_WINDOW" : 30,
+#"PROBE_STATE_FILE" : "/dev/shm/Monitoring_net.json",
+"PROBE_STATE_FILE" : None,
 
 # MQTT constants
 "MQTT_CLIENT" : "id yourself to mosquitto",
 "MQTT_BROKER_ADDR" : "your ip address as string",
 "MQTT_BROKER_PORT" : <your mosquitto port as integer>,
 
+# topic for packets carrying many samples at once (e.g. all of a remote's readings)
+# (with "SITES", each site uses <PREFIX>/batch unless it has its own "BATCH_TOPIC")
+"BATCH_TOPIC" : "zk-env/batch",
+
+# locally sourced values are only published when they change (retained);
+# republish everything this often anyway (seconds, 0 for never)
+"PUB_REFRESH" : 300.0,
+
+# optional: don't publish numeric changes smaller than this (by parameter label)
+#"DEADBANDS" : {"temp" : 0.2},
+"DEADBANDS" : {},
+
+# number of (time, value) samples of history kept in memory per parameter
+# (16 bytes each)
+"SERIES_LEN" : 512,
+
+# optional: keep every parameter update on disk (comment out to disable)
+# a new segment file is started every "HISTORY_SEGMENT" seconds and only the
+# last "HISTORY_KEEP" segments are kept.  data is fsync'ed every "HISTORY_FLUSH"
+# seconds.  the last "HISTORY_PRELOAD" seconds are reloaded into memory at start up.
+#"HISTORY_DIR" : "/home/pi/develop/Monitoring_history",
+"HISTORY_SEGMENT" : 86400,
+"HISTORY_KEEP" : 30,
+"HISTORY_FLUSH" : 60.0,
+"HISTORY_PRELOAD" : 3600.0,
+
+# the parameter values, auto mode and holdoffs are saved here every
+# "CHECKPOINT_INTERVAL" seconds (and at the end) and restored at start up.
+# values older than "CHECKPOINT_MAX_AGE" seconds aren't restored.
+# (optional: None to disable; set it to a writable path, e.g. the commented
+# out one, to enable)
+#"CHECKPOINT_FILE" : "/home/pi/develop/Monitoring_checkpoint.json",
+"CHECKPOINT_FILE" : None,
+"CHECKPOINT_INTERVAL" : 60.0,
+"CHECKPOINT_MAX_AGE" : 3600.0,
+
 # default name of the file to log messages
 "LOGFILE" : "/var/log/Monitoring_local.log",
 #"LOGFILE" : "Monitoring_local.log",
+# start a new log file when it gets to this size, keeping "LOG_BACKUPS" old
+# ones (0 to never rotate, e.g. if logrotate does it).  the same message
+# again within "LOG_REPEAT_WINDOW" seconds is only counted (0 to log them all)
+"LOG_MAX_BYTES" : 0,
+"LOG_BACKUPS" : 5,
+"LOG_REPEAT_WINDOW" : 60.0,
 
 # list of status notifications (comma separated list)
 #"NOTIFICATIONS" : ["your first email addr", "your second email addr"],
@@ -39,6 +131,46 @@ conf = {
 #"ALARMLIST" : ["your first email addr", "your second email addr"],
 "ALARMLIST" : [],
 
+# counters and latency histograms: served at http://METRICS_ADDR:METRICS_PORT/metrics
+# (Prometheus format; 0 for off) and published as json to "METRICS_TOPIC"
+# every "METRICS_PUBLISH" seconds (0 for never).  with "SHARDS", worker n
+# serves on METRICS_PORT + 1 + n and publishes on METRICS_TOPIC/shard<n>.
+"METRICS_PORT" : 0,
+"METRICS_ADDR" : "127.0.0.1",
+"METRICS_TOPIC" : "zk-env/$metrics",
+"METRICS_PUBLISH" : 0,
+
+# sampling profiler: "start", "start <seconds>" or "stop" on "PROFILE_TOPIC"
+# (or kill -USR1 <pid> to start/stop).  samples every "PROFILE_INTERVAL"
+# seconds for at most "PROFILE_SECONDS"; the file goes next to "LOGFILE".
+"PROFILE_TOPIC" : "zk-env/$profile",
+"PROFILE_INTERVAL" : 0.01,
+"PROFILE_SECONDS" : 60.0,
+
+# messages are sent by this many worker threads, at most "MAIL_QUEUE" can
+# be waiting.  a failed message is retried "MAIL_RETRIES" times, first after
+# "MAIL_BACKOFF" seconds, doubling each time.
+"MAIL_WORKERS" : 2,
+"MAIL_QUEUE" : 100,
+"MAIL_RETRIES" : 3,
+"MAIL_BACKOFF" : 30.0,
+
+# optional: the messages are kept in "SPOOL_FILE" until they've been sent
+# (None to disable; set it to a writable path to enable): held while
+# pingtest says the internet is down ("PROBE_STATE_FILE") and sent, in
+# order, when it's back or after a restart.  one that fails all of its
+# retries is tried again every "SPOOL_RETRY" seconds.  "SPOOL_FSYNC" is
+# "always" (every message), "batch" (on the main loop's tick) or "never".
+# pingtest keeps its notifications in "PINGTEST_SPOOL" the same way.
+# (with more than one of "MAIL_WORKERS", they're started in order but the
+# mail commands can finish out of order)
+#"SPOOL_FILE" : "/home/pi/develop/Monitoring_spool.jsonl",
+"SPOOL_FILE" : None,
+"SPOOL_RETRY" : 600.0,
+"SPOOL_FSYNC" : "always",
+#"PINGTEST_SPOOL" : "/home/pi/develop/pingtest_spool.jsonl",
+"PINGTEST_SPOOL" : None,
+
 # once a response to a stimulus has been activated, holdoff for this
 # number of seconds before taking the action again i.e. event lasts this long
 "MOTION_HOLDOFF" : 300.0,
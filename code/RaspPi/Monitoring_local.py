@@ -35,6 +35,84 @@
 #  https://sourceforge.net/p/raspberry-gpio-python/wiki/BasicUsage/
 #  https://sourceforge.net/p/raspberry-gpio-python/wiki/Inputs/
 #
+# v1.1
+# + parameters are now registered in Env() and indexed by topic and label
+#   (wildcard topics like "zk-env/+/temp" are routed through a topic trie)
+# + the main loop is event driven: on_message(), the gpio edges and the timers
+#   post to a queue and the loop wakes up immediately.  LOOP_DELAY is now
+#   only the period of the housekeeping tick (e.g. the mqtt reconnect check).
+# + data_sync() only publishes values that changed (retained), with optional
+#   deadbands ("DEADBANDS") and a periodic refresh ("PUB_REFRESH")
+# + alarm and notification messages are queued to a pool of mail workers
+#   (MonitoringDispatch.py) with retries, instead of sending in the main loop
+# + each numeric parameter keeps a fixed size, in-memory history of its
+#   updates (MonitoringSeries.py, "SERIES_LEN" samples)
+# + optionally, every update is also kept on disk in "HISTORY_DIR"
+#   (MonitoringHistory.py) and the recent part is reloaded at start up
+# + "LIMIT_CHECKS" are compiled into sorted tables per parameter at start up
+#   and only re-checked when the parameter changes (MonitoringLimits.py)
+# + the holdoff timers run on a single heap serviced by the main loop
+#   (MonitoringTimers.py) instead of a new threading.Timer each time
+# + mqtt payloads are decoded by Env.ingest() with a converter chosen per
+#   parameter when it's created (and orjson/ujson if installed)
+# + accepts a packet with many samples on "BATCH_TOPIC", applied all at once
+#   (it's posted to Env.inbox as one update and apply_updates() applies it
+#   at the start of a pass, so the pass sees all of it or none)
+# + one process can serve many sites ("SITES" in Monitoring_conf.py), each with
+#   its own Env, ManageAlarms, limits and timers, sharing the mqtt connection
+#   and the mail dispatcher.  topics are built from each site's "PREFIX"
+#   (note: keysw is now published on <prefix>/keysw, it was "zk-enf/keysw")
+# + Site, ManageAlarms and the main loop moved to MonitoringSites.py; with
+#   "SHARDS" > 0 the sites run in that many worker processes
+#   (MonitoringShards.py) and this process only handles mqtt and the mail
+# + counters and latency histograms (MonitoringMetrics.py) on a local http
+#   endpoint ("METRICS_PORT", Prometheus format) and/or published as json on
+#   "METRICS_TOPIC" every "METRICS_PUBLISH" seconds
+# + a sampling profiler (MonitoringProfiler.py) started and stopped with
+#   SIGUSR1 or "start [seconds]"/"stop" on "PROFILE_TOPIC"; it writes a
+#   collapsed stack file (for flamegraph.pl) next to the log
+# + logging goes through a queue to a thread that writes the (optionally
+#   rotating, "LOG_MAX_BYTES") log file, so the mqtt callbacks and the main
+#   loop don't wait on the SD card; repeats within "LOG_REPEAT_WINDOW" are
+#   collapsed into a count
+# + the mqtt and gpio callbacks no longer change the parameters: they post
+#   immutable updates to Env.inbox and the main loop applies them at the
+#   start of each pass (Env.apply_updates()), replacing Env.lock.  a t/f
+#   parameter changes at most once per pass, so no events are lost
+# + the parameter values, auto mode and the holdoffs in progress are saved to
+#   "CHECKPOINT_FILE" every "CHECKPOINT_INTERVAL" seconds and at the end,
+#   and restored at start up (MonitoringCheckpoint.py)
+# + importing this file no longer does anything: main() sets up logging and
+#   calls start() (mqtt, sites, hardware) and shutdown() after ^C.  paho,
+#   RPi.GPIO and the optional parts are imported when first used, and the
+#   broker connection is made by paho's thread (connect_async()), so start
+#   up doesn't wait for the broker.  the import and set up times are logged,
+#   counted ("zk_startup_seconds") and benchmarked (MonitoringBench.py startup)
+# + Parm uses __slots__ (about 40% smaller) and a parameter without a physical
+#   handler has None instead of a do nothing lambda.  Env keeps pub_list and
+#   io_list, so data_sync() and physical() only visit the parameters they
+#   act on (MonitoringBench.py parms)
+# + the gpio callback only queues (pin, level, time) and the main loop runs
+#   the edges through a per pin glitch/debounce filter (MonitoringEdges.py,
+#   "EDGE_GLITCH", "EDGE_DEBOUNCE", "EDGE_FILTERS") before posting the clean
+#   transitions.  it works for any input parameter read on its edges
+#   (replaces motion_edge()); the dropped edges are counted
+# + the key switch is read on its edges too instead of every pass, and the
+#   outputs (light, ovrled) are only written when their value differs from
+#   what was last written.  the RPi.GPIO calls are counted
+#   ("zk_gpio_calls_total", MonitoringBench.py gpio)
+# + pingtest.py probes the broker, the gateway, DNS and a few internet hosts
+#   at once every "PINGTEST_INTERVAL" seconds with a short timeout and keeps
+#   their latency and loss (MonitoringProbe.py); the internet is down when
+#   fewer than "PROBE_QUORUM" answer.  its state goes to "PROBE_STATE_FILE",
+#   which is read here on the tick (net_state)
+# + the alarm and notification messages are written to a spool file
+#   ("SPOOL_FILE", MonitoringSpool.py) before they're queued and only taken
+#   off when they've been sent.  while pingtest says the internet is down
+#   they're held, and then sent in order when it's back; a message that
+#   fails all of its retries stays in the spool and is tried again every
+#   "SPOOL_RETRY" seconds.  what's left at the end is sent after the restart
+#
 # v1.0
 # + replaced gas parameter with three to support raw and PPM data from the sensor
 #   (changed in MonitoringParameters.py)
@@ -105,95 +183,101 @@
 # + add remote reboot capability
 # + add thresholds for t/h/g to change from notifications to alarm
 # + command line arguments for logging level, filename, etc
-# + configure the location and use to create the mqtt topics
-#   ... make the data class instance name a bit more generic
 # + reboot on ethernet/network loss ... seems to happen
 # + add timer and configuration parameters to allow leaving after setting auto
 #
 
-import paho.mqtt.client as mqtt
 import time
-import subprocess
+started = time.monotonic()   # for the start up time
+
 import logging
 import sys
-import threading
+import queue
+import os
+import signal
 from Monitoring_conf import conf
 from MonitoringParameters import *
-import json
+from MonitoringDispatch import Dispatcher
+from MonitoringTimers import TimerQueue
+from MonitoringSites import Site, ManageAlarms, EventLoop, LOOP_DELAY
+from MonitoringMetrics import registry
+import MonitoringMetrics
+from MonitoringProfiler import SamplingProfiler
+from MonitoringLogging import setup_logging
+from MonitoringCheckpoint import Checkpoint
+from MonitoringProbe import read_state
+from MonitoringSpool import Spool
 
 # Notes
 # time.time() returns microseconds
+# importing this file doesn't do anything (no logging, mqtt or gpio);
+# main() starts it all.  paho, RPi.GPIO and the modules for the optional
+# parts (shards, history on disk, the metrics endpoint) are imported when
+# they're first needed.
 
 
 #########
 # Constants (i.e. #define's) and global variables
 #########
 
-# Behavioral constants
-LOOP_DELAY = 2.0   # number of seconds of delay in the main loop
+# change events posted by the callbacks; the main loop blocks on this
+events = queue.Queue()
+
+# the sites (each with its environment/parameter data and alarm logic)
+# and the router from mqtt topics to them; created by start()
+sites = []
+router = EnvRouter(logging)
+
+# the worker processes, if the sites are sharded ("SHARDS")
+shards = None
+
+# the sampling profiler, started/stopped by "PROFILE_TOPIC" or SIGUSR1
+profiler = None
+profile_topic = conf.get("PROFILE_TOPIC", "")
+
+# the rest of what start() sets up (and shutdown() takes down)
+mqtt_client = None
+spool = None
+dispatcher = None
+timers = None
+history = None
+checkpoint = None
+metrics = None
+log_listener = None
+
+# the network as last seen by pingtest.py ("PROBE_STATE_FILE"), or None
+net_state = None
 
 # keep track of the mqtt broker connection status
-mqtt_con_status = False
+# (None until the first connect)
+mqtt_con_status = None
 MQTT_ERR_SUCCESS = 0
 
+# what's counted here (see MonitoringMetrics.py)
+CONNECTS = registry.counter("zk_mqtt_connects_total", "mqtt connects")
+DISCONNECTS = registry.counter("zk_mqtt_disconnects_total", "mqtt disconnects", ["clean"])
+RECONNECTS = registry.counter("zk_mqtt_reconnects_total", "mqtt reconnect attempts")
+NET_CHANGES = registry.counter("zk_internet_changes_total", "internet up/down changes seen from pingtest", ["up"])
+STARTUP = registry.histogram("zk_startup_seconds", "time to import this program and to set up the sites", ["phase"])
+
 # set up the callback for mqtt messages
 # keep it clean and don't do any long processing here
 def on_message(mqtt_client, userdata, message):
     """ handler for inbound mqtt messages """
     
-    # what message did we get?
-    logging.debug("MQTT message received:"+ message.topic)
-    logging.debug("Raw Payload:"+ str(message.payload))
+    # what message did we get? (don't build the strings unless they'll be logged)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("MQTT message received: %s; Raw Payload: %r", message.topic, message.payload)
 
-    parm = zkshop.get_parameter(message.topic)
-    if parm == None:
-        logging.info("Spurious topic data received ... ignored;  Topic = "+message.topic)
+    if message.topic == profile_topic:
+        profiler.command(message.payload)
+        return
 
-    # found it in the list
+    # hand it to the site it's for (or the worker process that has the site)
+    if shards is not None:
+        shards.route(message.topic, message.payload)
     else:
-        logging.debug("Matched " + message.topic + " to " + parm.label)
-        parm.event = True
-        if parm.jflag == True:
-            # convert to a string ... note: contains a 'b' before the data
-            jstring = message.payload.decode('utf-8')
-            jdict = json.loads(jstring)
-            value = jdict[list(jdict)[0]]["value"] # only reliable because there is only one object
-            parm.when = jdict[list(jdict)[0]]["tstamp"]
-        else:
-            value = message.payload.decode('utf-8')
-
-        # check the type
-        # do nothing if the topic is not found in the parm list
-        parm_type = type(parm.value)
-        logging.debug("Setting " + message.topic + " as " + str(parm_type) + " to " + str(value))
-        if parm_type == float:
-            parm.pvalue = parm.value
-            parm.value = float(value)
-            
-        # be careful using bool() on strings !
-        elif parm_type == bool:
-            if value == "True":
-                if parm.pvalue == False:
-                    parm.event = True
-                parm.pvalue = parm.value
-                parm.value = True
-            elif value == "False":
-                if parm.pvalue == True:
-                    parm.event = True
-                parm.pvalue = parm.value
-                parm.value = False
-            else:
-                logging.error("on_message():Strange value on bool from " + message.topic)
-            
-        elif parm_type == int:
-            parm.pvalue = parm.value
-            parm.value =  int(value)
-            
-        elif parm_type == str:
-            parm.pvalue = parm.value
-            parm.value = value
-
-        # do nothing if the topic is not found (i.e. weird type returned)
+        router.deliver(message.topic, message.payload)
 
 
 ### end on_message()
@@ -204,6 +288,7 @@ def on_disconnect(client, userdata, rc):
 
     global mqtt_con_status
     # remember, this is a disconnect status
+    DISCONNECTS.inc(str(rc == MQTT_ERR_SUCCESS))
     if rc == MQTT_ERR_SUCCESS:
         mqtt_con_status = False
         logging.info("Clean MTT disconnece")
@@ -218,319 +303,48 @@ def on_connect(client, userdata, flags, rc):
     
     if rc == MQTT_ERR_SUCCESS:
         logging.info("MQTT connect success")
+        CONNECTS.inc()
         mqtt_con_status = True
+        # the broker may have restarted: make sure it gets our values again
+        for site in sites:
+            site.env.mark_stale()
+        if shards is not None:
+            shards.mark_stale()
     else:
         logging.error("Error connecting to MQTT broker")
 
 
+def check_connection():
+    """ called on the periodic tick: try to get the broker back after a clean
+        disconnect (paho's thread retries the first connect and the unexpected
+        disconnects on its own) """
 
-# a little class to manage a single, global timer
-class LocalTimer:
-    """ make the timer available more globally and terminate easier """
-
-    started = False
-    
-    def __init__(self, interval, function, args=[], kwargs={}):
-        self.interval = interval
-        self.function = function
-        self.args = args
-        self.kwargs = kwargs
-
-    def create(self):
-        """ arm a timer ... need to call start() to start ... self cancelling """
-        self.timer = threading.Timer(self.interval, self.function, self.args, self.kwargs)
-        self.timer.daemon = True  # helps with ^c behavior
-
-    def start(self):
-        """ start a timer that has beed created using create() """
-        self.timer.start()
-        self.started = True
-
-    def cancel(self):
-        """ cancel a timer that has yet to complete """
-        self.timer.cancel()
-        self.started = False
-        
-
-class ManageAlarms:
-    """ Manage all of the automatic alarming logic """
-    
+    if mqtt_con_status == False:
+        RECONNECTS.inc()
+        try:
+            mqtt_client.reconnect()
+        except OSError:
+            logging.debug("MQTT connection error on reconnect attempt")
 
-    def __init__(self):
-        # used to loop through the stimulus'es to be processed
-        # >>> ADD NEW STIMULUSES TO BE PROCESSED HERE
-        self.stimulus_list = [self.motion_detected, self.temp_hum_gas, self.auto_on_off, self.set_ovrled]
-
-        # keep track of whether we are in alarming events
-        self.motion_event = False
-
-        # keep track of when the temp, humidity and gas status message was sent
-        self.thg_sent = False
-
-        # keep track of when the limit message has been sent
-        self.limit_sent = False
-
-        # instantiate the local timer class to be used over and over
-        self.mtimer = LocalTimer(conf["MOTION_HOLDOFF"], self.reset_motion_event)
-        self.ttimer = LocalTimer(conf["THG_HOLDOFF"], self.reset_thg_sent)
-        self.ltimer = LocalTimer(conf["LIM_HOLDOFF"], self.reset_limit_sent)
-
-
-    ### stimulus processing functions
-    # >>> IF YOU ADD A NEW STIMULUS TO THE LIST (ABOVE), ADD THE HANDLER(S) HERE
-
-    # Motion sensor : ~if auto, turn on light and send a text/mail messagae
-    def motion_detected(self):
-        """ process the motion detection capability """
-
-        logging.debug("Processing motion")
-
-        # if not in auto mode don't do this stuff: count on secure_from_auto() to cleanup
-        if zkshop.auto.value == True:
-            # if I am currently not in a motion event
-            if self.motion_event == False:
-                # motion detected?
-                if zkshop.motion.value == True:
-                    self.light_it_up()
-                    self.send_alarm_msgs("Motion detected at " + conf["LOCATION"])
-                    self.mtimer.create()
-                    self.mtimer.start()
-                    self.motion_event = True
-                # end motion event    
-                else:
-                    self.light_it_up(True) # reset = True
-        else:
-            logging.debug("not auto mode ... doing nothing")
-
-
-    def reset_motion_event(self):
-        """ reset the motion event, usually after the timer expires """
-        logging.debug("Timer resetting motion event")
-        self.motion_event = False
-        self.mtimer.started = False
-
-    # Temp, Humidity, Gas value processing : send status text/mail a couple of times a day
-    def temp_hum_gas(self):
-        """ process the temperature, humidity and gas readings.
-            not controlled by auto mode (i.e. runs continuously) """
-
-        if self.thg_sent == False:
-            message = "T:" + str(zkshop.temp.value) + \
-                      " H:" + str(zkshop.humidity.value) + \
-                      " G_CO:" + str(zkshop.gasco.value) + \
-                      " G_PR:" + str(zkshop.gaspr.value)
-            logging.debug("Text message: " + message)
-            self.send_notif_msgs(message)
-            self.ttimer.create()
-            self.ttimer.start()
-            self.thg_sent = True
-            
-    def reset_thg_sent(self):
-        """ reset the temp, hum, gas "sent" flag, usually after the timer expires """
-        logging.debug("Timer resetting thg sent flag")
-        self.thg_sent = False
-        self.ttimer.started = False
-
-    def reset_limit_sent(self):
-        """ reset the limit sent flag, usually after the timer expires """
-        logging.debug("Timer resetting limit sent flag")
-        self.limit_sent = False
-        self.ltimer.started = False
-
-    # auto mode on/off processing
-    def auto_on_off(self):
-        """ do, sort of a three-way switch with remote and local key switch for auto mode """
-        
-        # was a new event from the key received?
-        if zkshop.keysw.event == True:
-            if zkshop.keysw.value == True:
-                logging.info("keysw commanded auto on ... doing it")
-                zkshop.auto.value = True
-            elif zkshop.keysw.value == False:
-                logging.info("keysw commanded auto off ... doing it")
-                zkshop.auto.value = False
-                self.secure_from_auto()
-            else:
-                logging.error("strange value received for auto override ... ignored")
-
-            zkshop.keysw.event = False # use it only once
-
-        if zkshop.o_auto.event == True:
-            if zkshop.o_auto.value == True:
-                logging.info("override commanded auto on ... doing it")
-                zkshop.auto.value = True
-            elif zkshop.o_auto.value == False:
-                logging.info("override commanded auto off ... doing it")
-                zkshop.auto.value = False
-                self.secure_from_auto()
-            else:
-                logging.error("strange value received for auto override ... ignored")
-
-            zkshop.o_auto.event = False # use it only once
-
-    def set_ovrled(self):
-        """ adjust the state of the auto override led """
-
-        zkshop.ovrled.value = zkshop.keysw.value ^ zkshop.auto.value
-            
-
-    ### processing operations to perform every so often; probalby in the main while()
-        
-    def process_stimuluses(self):
-        """ loop through the list and process the stimuluses """
-        for func in self.stimulus_list:
-            func()
-
-    def process_overrides(self):
-        """ take the appropriate actions based on the override values changing """
-        
-        # process the light override first
-        # allow the override to turn it off, knowing that it will be
-        # turned back on after the holdoff if the threat continues.
-
-        # was a new event received?
-        if zkshop.o_light.event == True:
-            if zkshop.o_light.value == True:
-                logging.info("override commanded light on ... doing it")
-                zkshop.light.value = True
-            elif zkshop.o_light.value == False:
-                logging.info("override commanded light off ... doing it")
-                zkshop.light.value = False
-            else:
-                logging.error("strange value received for light override ... ignored")
-
-            zkshop.o_light.event = False # use it only once
-            
-
-        # automatic alarming mode
-        # code moved to stimulus section because it is combined with key switch input
-
-    def process_limits(self):
-        """ loop through the "LIMIT_CHECKS" dictionary from the conf file and
-            take send messages if warranted """
-
-        logging.debug("Processing limits ...")
-
-        message = "LIMIT"
-
-        # loop through all of the limit checks from the config file
-        # build up a single message to be sent after all are processed
-        for item in conf["LIMIT_CHECKS"]:
-                parm = zkshop.get_parameter_by_label(conf["LIMIT_CHECKS"][item]["parm"])
-                if parm == None:
-                    logging.info("Spurious label in LIMIT_CHECKS... ignored;  label = " + conf["LIMIT_CHECKS"][item]["parm"])
-                else:
-                    if conf["LIMIT_CHECKS"][item]["sense"] == "high":
-                        if parm.value >= conf["LIMIT_CHECKS"][item]["limit"]:
-                            logging.info("Limit message: " + conf["LIMIT_CHECKS"][item]["message"] + \
-                            " (parm:" + conf["LIMIT_CHECKS"][item]["parm"] + \
-                            " limit:" + str(conf["LIMIT_CHECKS"][item]["limit"]) + \
-                            " value: " + str(parm.value) + " " + parm.units)
-
-                            message = message + "\n" + conf["LIMIT_CHECKS"][item]["message"]
-
-                    elif conf["LIMIT_CHECKS"][item]["sense"] == "low":
-                        if parm.value <= conf["LIMIT_CHECKS"][item]["limit"]:
-                            logging.info("Limit message: " + conf["LIMIT_CHECKS"][item]["message"] + \
-                            " (parm:" + conf["LIMIT_CHECKS"][item]["parm"] + \
-                            " limit:" + str(conf["LIMIT_CHECKS"][item]["limit"]) + \
-                            " value: " + str(parm.value) + " " + parm.units)
-
-                            message = message + "\n" + conf["LIMIT_CHECKS"][item]["message"]
-                            
-                    else:
-                        logging.info("Bad sense in LIMIT_CHECKS ... ignored; sense = " + conf["LIMIT_CHECKS"][item]["sense"])
-
-        # if a message was created (i.e. a limit was exceeded), send it
-        if message != "LIMIT":            
-            # if a limit was exceeded and a message has not been sent
-            # recently (controlled by "LIM_HOLDOFF"), create and send it
-            if self.limit_sent == False:
-                logging.debug("Text message: " + message)
-                self.send_alarm_msgs(message)
-                self.ltimer.create()
-                self.ltimer.start()
-                self.limit_sent = True
 
+def check_network():
+    """ called on the periodic tick: pick up the network state from pingtest.py """
 
-    
-    ### alarming responses
-    # >>> IF YOU ADD A NEW ALARM OUTPUT (LIKE A SIREN), ADD THE METHOD HERE
-    
-    def send_alarm_msgs(self, message = "Alarm present"):
-        """ send text or email messages to the configured list """
-
-        logging.info("Begin sending alarm messages")
-        for addr in conf["ALARMLIST"]:
-            logging.info("Sending alarm message to: " + addr)
-            # p1 piped into p2 then executed in a shell
-            p1 = subprocess.Popen(["echo", message], stdout = subprocess.PIPE)
-            p2 = subprocess.Popen(["mail", "-sAlarm", addr], stdin=p1.stdout, stdout = subprocess.PIPE)
-            p1.stdout.close()
-            output,err = p2.communicate()
-            logging.error("output from mail attempt, output = " + str(output) + ";err = " + str(err))
-    
-    def send_notif_msgs(self, message = "Notification"):
-        """ send text or email messages to the configured list """
-        
-        logging.info("Begin sending notification messages")
-        for addr in conf["NOTIFICATIONS"]:
-            logging.info("Sending notification messages message to: " + addr)
-            # p1 piped into p2 then executed in a shell
-            p1 = subprocess.Popen(["echo", message], stdout = subprocess.PIPE)
-            p2 = subprocess.Popen(["mail", "-sNotification", addr], stdin=p1.stdout, stdout = subprocess.PIPE)
-            p1.stdout.close()
-            output,err = p2.communicate()
-            logging.error("output from mail attempt, output = " + str(output) + ";err = " + str(err))
-
-
-    def say_something(self, holdoff = 0):
-        """ use the local text to voice or play a wav file """
-                # say something if a motion event is active
-#        if motion_event == True:
-#            p1 = subprocess.Popen(["echo", "I see you"], stdout = subprocess.PIPE)
-#            p2 = subprocess.Popen(["festival", "--tts"], stdin=p1.stdout, stdout = subprocess.PIPE)
-#            p1.stdout.close()
-#            output,err = p2.communicate()
-        pass
-
-
-    def make_noise(self, reset = False, holdoff = 0):
-       """ activate the local siren """
-       pass
-
-
-    def light_it_up(self, reset = False, holdoff = 0):
-        """ implement local control of the light; respect the remote override """
-
-        # reset requested
-        if reset == True:
-            logging.debug("local reset of light/SSR requested")
-            # check the override state
-            if zkshop.o_light.value == True :
-                logging.debug("... ignored")
-            else:
-                zkshop.light.value = False
-                
-        # this code is asking for the light on (e.g. alarm event) ... do it
+    global net_state
+    state = read_state(conf["PROBE_STATE_FILE"], 3.0 * conf.get("PINGTEST_INTERVAL", 10))
+    was = net_state["internet"] if net_state is not None else None
+    now = state["internet"] if state is not None else None
+    if now != was:
+        NET_CHANGES.inc(str(now))
+        if state is None:
+            logging.warning("No network state from pingtest (is it running?)")
         else:
-            zkshop.light.value = True
-
-
-    def secure_from_auto(self):
-        """ clean things up after auto alarming is disabled """
-        # end all events in progress/reset alarm event timers
-        self.motion_event = False
-        if self.mtimer.started == True:
-            self.mtimer.cancel()
-
-
-    def start_auto(self):
-        """ cleanly start up auto-alarming; return outputs to default """        
-        pass
+            logging.info("Internet is %s: %d of %d targets answered", "up" if now else "down", state["up"], state["of"])
+        # hold the messages (in the spool) while it's down
+        if dispatcher is not None:
+            dispatcher.set_online(now is not False)
+    net_state = state
 
-        
-### end of class ManageAlarms()
 
 
 #########
@@ -555,52 +369,173 @@ class ManageAlarms:
 #
 
 # choose one of the next two lines before deployment to send logging to a file
-logging.basicConfig(filename=conf["LOGFILE"], level=logging.INFO, format='%(asctime)s - Monitoring_local - %(levelname)s - %(message)s')
-#logging.basicConfig(stream=sys.stderr,
-#                    level=logging.DEBUG,
-#                    format='%(asctime)s - Monitoring_local - %(levelname)s - %(message)s'
-#                    )
-
-#logging.basicConfig(stream=sys.stderr,
-#                    level=logging.INFO,
-#                    format='%(asctime)s - Monitoring_local - %(levelname)s - %(message)s'
-#                    )
-
-# announce the start
-logging.info("Starting up ...")
-
-# Instantiate MQTT
-mqtt_client = mqtt.Client(conf["MQTT_CLIENT"])
-
-#
-# connect to the MQTT broker
-#
-logging.info("Connecting to mqtt broker ...")
-try:
-    mqtt_client.connect(conf["MQTT_BROKER_ADDR"], conf["MQTT_BROKER_PORT"])
-except ConnectionRefusedError:
-    logging.error("MQTT connection error on first attempt")
-
-# connect the message handlers to the mqtt_client instance
-mqtt_client.on_message = on_message
-mqtt_client.on_disconnect = on_disconnect
-mqtt_client.on_connect = on_connect
-
-# start the thread to service mqtt traffic
-mqtt_client.loop_start()
-
-# local storage of parameters; sets up the local hardware too
-zkshop = Env(logging, mqtt_client)
-zkshop.data_sync(mqtt_client)
-
-# initialize the locally connected hardware
-zkshop.physical_init()
-
-# subscribe to those which will be read
-zkshop.subscribe(mqtt_client)
-
-# Instantiate the alarm management
-manage_alarms = ManageAlarms()
+# (the worker processes, if any, log the same way)
+# the records are written by a thread of their own (MonitoringLogging.py)
+log_conf = dict(filename=conf["LOGFILE"], level=logging.INFO, format='%(asctime)s - Monitoring_local - %(levelname)s - %(message)s',
+                max_bytes=conf.get("LOG_MAX_BYTES", 0), backups=conf.get("LOG_BACKUPS", 5),
+                window=conf.get("LOG_REPEAT_WINDOW", 60.0))
+#log_conf = dict(stream=sys.stderr,
+#                level=logging.DEBUG,
+#                format='%(asctime)s - Monitoring_local - %(levelname)s - %(message)s'
+#                )
+
+#log_conf = dict(stream=sys.stderr,
+#                level=logging.INFO,
+#                format='%(asctime)s - Monitoring_local - %(levelname)s - %(message)s'
+#                )
+
+
+def connect():
+    """ the paho client, connecting in the background: loop_start()'s thread
+        makes the connection (retrying until the broker answers) and
+        on_connect() is called when it's up (start() sets the callbacks) """
+
+    import paho.mqtt.client as mqtt
+
+    client = mqtt.Client(conf["MQTT_CLIENT"])
+
+    logging.info("Connecting to mqtt broker ...")
+    client.connect_async(conf["MQTT_BROKER_ADDR"], conf["MQTT_BROKER_PORT"])
+    return client
+
+
+def start(client = None):
+    """ set up everything; returns the main loop, ready to run.  client is
+        an mqtt client to use instead of the broker: it gets the callbacks
+        here like the paho one, but connecting it (if it needs it) is up to
+        the caller.  without one, connect() makes the paho client """
+
+    global mqtt_client, spool, dispatcher, timers, history, checkpoint, metrics, profiler, shards
+    setup = time.monotonic()
+
+    # announce the start
+    logging.info("Starting up ...")
+
+    # start the thread to service mqtt traffic (and make the connection);
+    # what's subscribed and published before it's up is sent once it is
+    mqtt_client = client if client is not None else connect()
+    mqtt_client.on_message = on_message
+    mqtt_client.on_disconnect = on_disconnect
+    mqtt_client.on_connect = on_connect
+    mqtt_client.loop_start()
+
+    # the text/mail messages are sent from their own threads, kept on disk
+    # until they've gone (what the last run didn't send goes first)
+    if conf.get("SPOOL_FILE"):
+        spool = Spool(logging, conf["SPOOL_FILE"], conf.get("SPOOL_FSYNC", "always"))
+        spool.load()
+    dispatcher = Dispatcher(logging, conf.get("MAIL_WORKERS", 2), conf.get("MAIL_QUEUE", 100),
+                            conf.get("MAIL_RETRIES", 3), conf.get("MAIL_BACKOFF", 30.0), spool = spool)
+    if conf.get("PROBE_STATE_FILE"):
+        check_network()     # (held from the start if the internet is down)
+    dispatcher.start()
+
+    # the holdoff timers (for all of the sites) are run by the main loop
+    timers = TimerQueue(lambda: events.put_nowait((time.monotonic(), None)))
+    if spool is not None:
+        timers.every(conf.get("SPOOL_RETRY", 600.0), dispatcher.flush)
+
+    # the profiler writes its files next to the log
+    profiler = SamplingProfiler(logging, os.path.dirname(os.path.abspath(conf["LOGFILE"])),
+                                conf.get("PROFILE_INTERVAL", 0.01), conf.get("PROFILE_SECONDS", 60.0))
+    signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.toggle())
+    if profile_topic:
+        mqtt_client.subscribe(profile_topic)
+
+    # the counters and latencies, over http and/or mqtt
+    if conf.get("METRICS_PORT", 0) > 0:
+        from MonitoringMetrics import MetricsServer
+        metrics = MetricsServer(logging, conf["METRICS_PORT"], conf.get("METRICS_ADDR", "127.0.0.1"))
+        metrics.start()
+    if conf.get("METRICS_PUBLISH", 0) > 0:
+        timers.every(conf["METRICS_PUBLISH"], MonitoringMetrics.publish,
+                     (mqtt_client, conf.get("METRICS_TOPIC", "zk-env/$metrics")))
+
+    if conf.get("SHARDS", 0) > 0:
+        # the sites live in the worker processes; this one just passes the
+        # mqtt traffic and the mail back and forth (and keeps the connection up)
+        from MonitoringShards import ShardPool
+        shards = ShardPool(logging, site_list(), conf["SHARDS"], mqtt_client, dispatcher, log_conf)
+        shards.start()
+    else:
+        # keep the history on disk if configured
+        if conf.get("HISTORY_DIR"):
+            from MonitoringHistory import HistoryStore
+            history = HistoryStore(logging, conf["HISTORY_DIR"], conf.get("HISTORY_SEGMENT", 86400),
+                                   conf.get("HISTORY_FLUSH", 60.0), keep = conf.get("HISTORY_KEEP", 30))
+
+        # pick up where we left off (values, auto mode, holdoffs) if there's a checkpoint
+        saved = None
+        if conf.get("CHECKPOINT_FILE"):
+            checkpoint = Checkpoint(logging, conf["CHECKPOINT_FILE"], conf.get("CHECKPOINT_MAX_AGE", 3600.0))
+            saved = checkpoint.load()
+
+        for site_conf in site_list():
+            # local storage of parameters; sets up the local hardware too
+            env = Env(logging, mqtt_client, events, site_conf)
+
+            if history is not None:
+                env.attach_store(history, conf.get("HISTORY_PRELOAD", 3600.0))
+
+            # Instantiate the alarm management
+            site = Site(env, ManageAlarms(env, dispatcher, timers))
+            if checkpoint is not None:
+                checkpoint.restore(saved, site)
+            env.data_sync(mqtt_client)
+
+            # initialize the locally connected hardware
+            env.physical_init(timers)
+
+            # subscribe to those which will be read
+            router.add(env)
+            env.subscribe(mqtt_client)
+
+            sites.append(site)
+            logging.info("Site %s (%s) on %s/...", env.name, env.location, env.prefix)
+
+        if checkpoint is not None:
+            timers.every(conf.get("CHECKPOINT_INTERVAL", 60.0), checkpoint.save, (sites,))
+
+    loop = EventLoop(sites, events, timers, LOOP_DELAY)
+    if history is not None:
+        loop.on_tick.append(history.tick)
+    if spool is not None and spool.fsync == "batch":
+        loop.on_tick.append(spool.sync)
+    loop.on_tick.append(check_connection)
+    if conf.get("PROBE_STATE_FILE"):
+        loop.on_tick.append(check_network)
+
+    STARTUP.observe(time.monotonic() - setup, "setup")
+    return loop
+
+
+def shutdown(loop):
+    """ save what's to be saved, secure the sites and stop the threads """
+
+    loop.report()
+    # (before secure_from_auto() ends the holdoffs)
+    if checkpoint is not None:
+        checkpoint.save(sites)
+    for site in sites:
+        logging.info("%s: published %d values, %d unchanged values suppressed",
+                     site.name, site.env.pub_count, site.env.pub_suppressed)
+        site.alarms.secure_from_auto()
+        site.env.cleanup()
+    if shards is not None:
+        shards.stop()
+    if history is not None:
+        history.close()
+    if metrics is not None:
+        metrics.stop()
+    if profiler.running():
+        profiler.stop()
+    dispatcher.stop()
+    if spool is not None:
+        spool.close()
+    logging.info("Messages: %(queued)d queued, %(sent)d sent, %(retried)d retried, %(failed)d failed, %(dropped)d dropped, "
+                 "%(spooled)d spooled", dispatcher.stats)
+    mqtt_client.loop_stop()
+    mqtt_client.disconnect()
 
 
 
@@ -608,38 +543,28 @@ manage_alarms = ManageAlarms()
 # Main Loop
 #############
 
-logging.info("Press CTRL+C to exit")
+def main():
+    """ run until ^C """
 
-try:
-    while True :
-        logging.debug("Main Loop ... Syncing data")
-        zkshop.data_sync(mqtt_client)
+    global log_listener
+    log_listener = setup_logging(**log_conf)
+    STARTUP.observe(time.monotonic() - started, "import")
 
-        # process the stimuluses
-        manage_alarms.process_stimuluses()
+    setup = time.monotonic()
+    loop = start()
+    logging.info("Started in %.3f s (%.3f s since the imports began)",
+                 time.monotonic() - setup, time.monotonic() - started)
+    logging.info("Press CTRL+C to exit")
 
-        # process overrides (mostly adjust the values in the parameter data
-        manage_alarms.process_overrides()
-        
-        # read/write the locally hosted i/o
-        zkshop.physical()
+    try:
+        loop.run()
 
-        zkshop.display_parameters()
+    # ^C cleanup
+    except KeyboardInterrupt:
+        logging.info("Cleaning up ... goodbye.")
+        shutdown(loop)
+        log_listener.stop()
 
-        manage_alarms.process_limits()
 
-        if mqtt_con_status == False:
-            try:
-                mqtt_client.reconnect()
-            except ConnectionRefusedError:
-                logging.debug("MQTT connection error on reconnect attempt")
-
-        time.sleep(LOOP_DELAY)
-
-# ^C cleanup
-except KeyboardInterrupt:
-    logging.info("Cleaning up ... goodbye.")
-    manage_alarms.secure_from_auto()
-    zkshop.cleanup()
-    mqtt_client.loop_stop()
-    mqtt_client.disconnect()
+if __name__ == "__main__":
+    main()
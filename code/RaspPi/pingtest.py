@@ -2,8 +2,13 @@
 # a simple program to test the condition of the link to the internet
 # and reboot if necessary.
 #
-# ping is used to test the link to a common URL (e.g. www.google.com) a
-# number of times and if failure persists, reboot the pi.
+# the broker, the gateway, a DNS server and a few hosts on the internet
+# (e.g. "PINGTEST_URL") are probed every "PINGTEST_INTERVAL" seconds, all at
+# once with a short timeout (MonitoringProbe.py).  the internet is down
+# while fewer than "PROBE_QUORUM" of the internet ones answer; once it has
+# been down for "PINGTEST_REBOOT_AFTER" seconds, reboot the pi (a short blip
+# doesn't).  the state after each round (up/down, latency and
+# loss per target) is written to "PROBE_STATE_FILE" (if set) for Monitoring_local.py.
 #
 # it is expected to be run as su so that the shutdown command works.
 #
@@ -15,6 +20,17 @@
 # system reboots when there is no internet, so that's why you have to 
 # wait for the reboot (internet restore) to send the notification.
 #
+# with "PINGTEST_SPOOL", the notifications are kept in that file
+# (MonitoringSpool.py) until they've been sent: they're held while the
+# internet is down and sent when the probes see it back, even after a
+# reboot.  the reboot notification is spooled before rebooting (no breadcrumb).
+#
+# with a spool ("SPOOL_FILE" or "PINGTEST_SPOOL"), an outage no longer
+# costs messages, so the reboot is opt-in: it only happens with
+# "PINGTEST_REBOOT_SPOOLED" set too.  otherwise (and with "PINGTEST_REBOOT"
+# off) it just keeps probing, and the spooled messages go out when the
+# internet is back.
+#
 # DJZ 040118
 #
 
@@ -23,22 +39,19 @@ import os
 import time
 import logging
 import sys
-import subprocess
+import asyncio
 from Monitoring_conf import conf
+from MonitoringProbe import Prober, targets_from_conf
+from MonitoringDispatch import Dispatcher
+from MonitoringSpool import Spool
 
     
 def send_notif_msgs(message = "Notification"):
-    """ send text or email messages to the configured list """
+    """ send text or email messages to the configured list
+        (queued; sent by the dispatcher's thread) """
     
-    logging.info("Begin sending notification messages")
-    for addr in conf["NOTIFICATIONS"]:
-        logging.info("Sending notification messages message to: " + addr)
-        # p1 piped into p2 then executed in a shell
-        p1 = subprocess.Popen(["echo", message], stdout = subprocess.PIPE)
-        p2 = subprocess.Popen(["mail", "-sNotification", addr], stdin=p1.stdout, stdout = subprocess.PIPE)
-        p1.stdout.close()
-        output,err = p2.communicate()
-        logging.error("output from mail attempt, output = " + str(output) + ";err = " + str(err))
+    logging.info("Sending notification to %d recipient(s): %s", len(conf["NOTIFICATIONS"]), message)
+    dispatcher.send("Notification", message, conf["NOTIFICATIONS"])
 
 #
 # set up the debugging message level
@@ -65,6 +78,18 @@ logging.basicConfig(filename=conf["PINGTEST_LOGFILE"], level=logging.INFO, forma
 # announce the start
 logging.info("Starting up pingtest ...")
 
+# the notifications are sent by a thread of their own, from the spool if there's one
+# (held until the first round of probes says the internet is up)
+spool = None
+if conf.get("PINGTEST_SPOOL"):
+  spool = Spool(logging, conf["PINGTEST_SPOOL"], conf.get("SPOOL_FSYNC", "always"))
+  spool.load()
+dispatcher = Dispatcher(logging, 1, conf.get("MAIL_QUEUE", 100), conf.get("MAIL_RETRIES", 3),
+                        conf.get("MAIL_BACKOFF", 30.0), spool = spool)
+if spool is not None:
+  dispatcher.set_online(False)
+dispatcher.start()
+
 #
 # check if this program caused the last reboot (i.e. does the breadcrumb exist)
 # if the breadcrumb exists, send a notification text per the list in the config file
@@ -77,25 +102,40 @@ if os.path.isfile(conf["PINGTEST_BC"]):
   send_notif_msgs("System was rebooted because of internet outage")
   
 
-hostname = conf["PINGTEST_URL"]
-retries = conf["PINGTEST_FAILS"]
-
-ret_cnt = retries
-while ret_cnt > 0:
-  response = os.system("ping -c 1 " + hostname + " 2>&1 >/dev/null")
+prober = Prober(logging, targets_from_conf(conf), conf.get("PROBE_TIMEOUT", 0.8), conf.get("PROBE_QUORUM", 2))
+for target in prober.targets:
+  logging.info("Probing %s (%s %s%s, %s)", target.name, target.kind, target.host,
+               ":" + str(target.port) if target.port else "", target.scope)
 
-  #and then check the response...
-  if response == 0:
-    ret_cnt = retries
-    logging.debug(hostname + " is up!")
-  else:
-    ret_cnt -= 1
-    logging.warning(hostname + " is down! tries left = " + str(ret_cnt))
+# reboot?  (not by default if the messages are spooled)
+reboot = conf["PINGTEST_REBOOT"] == True
+if reboot and (conf.get("SPOOL_FILE") or conf.get("PINGTEST_SPOOL")) and not conf.get("PINGTEST_REBOOT_SPOOLED", False):
+  logging.info("Messages are spooled: not rebooting on an outage (PINGTEST_REBOOT_SPOOLED)")
+  reboot = False
 
-  time.sleep(conf["PINGTEST_INTERVAL"])
+# returns when the internet has been down for "PINGTEST_REBOOT_AFTER" seconds
+# (never, if it isn't going to reboot); the messages are held while it's
+# down and sent when it's back
+state = asyncio.run(prober.run(conf["PINGTEST_INTERVAL"], conf.get("PINGTEST_REBOOT_AFTER", 1800) if reboot else None,
+                               conf.get("PROBE_STATE_FILE"),
+                               lambda state: dispatcher.set_online(state["internet"] or spool is None)))
+logging.warning("Internet down for %.0f s (%d rounds): %d of %d targets answered",
+                prober.down_for(), state["down_rounds"], state["up"], state["of"])
   
-if conf["PINGTEST_REBOOT"] == True:
+if reboot:
   logging.critical("system will be rebooted in 5 seconds")
-  os.system("date | cat > " + conf["PINGTEST_BC"])
+  if spool is not None:
+    # sent once the internet is back after the reboot
+    send_notif_msgs("System was rebooted because of internet outage (down since " +
+                    time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(prober.changed)) + ")")
+  else:
+    os.system("date | cat > " + conf["PINGTEST_BC"])
   time.sleep(5)
+
+# what hasn't been sent stays in the spool
+dispatcher.stop()
+if spool is not None:
+  spool.close()
+
+if reboot:
   os.system(conf["PINGTEST_RBTCMD"])